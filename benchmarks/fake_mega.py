@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+from pathlib import Path
+
+# Stands in for MEGAcmd, called by the `mega-*` scripts in `benchmarks/bin`.
+# Uploads are sparse files in FAKE_MEGA_ROOT, so `mega-du` and `mega-ls` see
+# them without the disk space, and take the time the scenario sets.
+# Like the mega-cmd-server, one session is shared by every process of a run.
+NOT_FOUND_CODE = 53
+ALREADY_LOGGED_IN_CODE = 54
+NOT_LOGGED_IN_CODE = 57
+
+
+def get_remote_path(path: str) -> Path:
+    return Path(os.environ["FAKE_MEGA_ROOT"]) / path.strip("/")
+
+
+def get_session_path() -> Path:
+    return Path(f"{os.environ['FAKE_MEGA_ROOT']}.session")
+
+
+def change_session(command: str) -> int:  # `login` or `logout`
+    is_logged_in = get_session_path().exists()
+    if command == "login":
+        if is_logged_in:
+            return ALREADY_LOGGED_IN_CODE
+        get_session_path().touch()
+    elif not is_logged_in:
+        return NOT_LOGGED_IN_CODE
+    else:
+        get_session_path().unlink()
+    return 0
+
+
+def du(path: str) -> int:
+    remote_path = get_remote_path(path)
+    if not remote_path.exists():
+        return NOT_FOUND_CODE
+
+    size = sum(file.stat().st_size for file in remote_path.rglob("*") if file.is_file())
+    sys.stdout.write(f"{path}: {size}\nTotal storage used:          {size}\n")
+    return 0
+
+
+def ls(path: str) -> int:
+    remote_path = get_remote_path(path)
+    if remote_path.is_file():
+        sys.stdout.write(f"{remote_path.name}\n")
+    elif remote_path.is_dir():
+        sys.stdout.writelines(
+            f"{file.name}\n" for file in sorted(remote_path.iterdir())
+        )
+    else:
+        return NOT_FOUND_CODE
+    return 0
+
+
+def put(*args: str) -> int:
+    *local_paths, target = [arg for arg in args if not arg.startswith("-")]
+    is_dir_target = target.endswith("/") or len(local_paths) > 1
+    remote_dir = get_remote_path(target if is_dir_target else str(Path(target).parent))
+    remote_dir.mkdir(parents=True, exist_ok=True)  # like `-c`
+
+    sizes = [Path(local_path).stat().st_size for local_path in local_paths]
+    bytes_per_s = float(os.environ.get("FAKE_MEGA_MB_PER_S", "0")) * 1024 * 1024
+    time.sleep(
+        float(os.environ.get("FAKE_MEGA_PUT_LATENCY_S", "0"))
+        + (sum(sizes) / bytes_per_s if bytes_per_s else 0)
+    )
+
+    for local_path, size in zip(local_paths, sizes, strict=True):
+        name = Path(local_path).name if is_dir_target else Path(target).name
+        with (remote_dir / name).open("wb") as f:
+            f.truncate(size)
+    return 0
+
+
+def main() -> int:
+    command, *args = sys.argv[1:]
+    match command:
+        case "login" | "logout":
+            return change_session(command)
+        case _ if not get_session_path().exists():
+            sys.stderr.write("Not logged in.\n")
+            return NOT_LOGGED_IN_CODE
+        case "du":
+            return du(args[0])
+        case "ls":
+            return ls(args[0])
+        case _:
+            return put(*args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,388 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from urllib.parse import parse_qs, urlsplit
+
+from scenarios import Scenario
+
+CHUNK_SIZE = 64 * 1024
+IMAGE_WIDTHS = (1280, 400)  # the original first, as `alt_sizes` lists them
+
+
+@dataclass
+class Media:
+    size: int
+    etag: str
+    seed: bytes  # the bytes of the file repeat it
+
+    def read(self, start: int, length: int) -> bytes:
+        offset = start % len(self.seed)
+        pattern = self.seed * (length // len(self.seed) + 2)
+        return pattern[offset : offset + length]
+
+    def get_variant(self, width: int) -> "Media":  # a smaller size of an image
+        scale = min(1.0, width / IMAGE_WIDTHS[0])
+        return Media(
+            size=max(1, int(self.size * scale**2)),
+            etag=f"{self.etag}-{width}",
+            seed=self.seed,
+        )
+
+
+class FakeTumblr:
+    # Synthetic blogs, posts and files generated from the scenario seed
+    def __init__(self, scenario: Scenario) -> None:
+        self.scenario = scenario
+        self.rng = random.Random(scenario.seed)  # noqa: S311
+        self.media: dict[str, Media] = {}
+        self.posts_by_blog: dict[str, list[dict[str, Any]]] = {}
+        self.lock = threading.Lock()
+        self.stats = {"api": 0, "head": 0, "get": 0, "range": 0, "bytes_sent": 0}
+        self.base_url = ""
+        self._generate()
+
+    @property
+    def posts(self) -> list[dict[str, Any]]:  # the dashboard, the newest first
+        return sorted(
+            (post for posts in self.posts_by_blog.values() for post in posts),
+            key=lambda post: post["id"],
+            reverse=True,
+        )
+
+    def count(self, stat: str, value: int = 1) -> None:
+        with self.lock:
+            self.stats[stat] += value
+
+    def _generate(self) -> None:
+        now = int(time.time())
+        post_id = 10**9
+        blog_names = [f"blog{i:03d}" for i in range(self.scenario.blog_cnt)]
+        for blog_name in blog_names:
+            self.posts_by_blog[blog_name] = []
+
+        # Blogs post in turn, so the dashboard mixes them like the real one
+        for post_i in range(self.scenario.posts_per_blog):
+            for blog_name in blog_names:
+                post_id += 1
+                timestamp = now - (self.scenario.posts_per_blog - post_i) * 3600
+                post = self._generate_post(blog_name, post_id, timestamp)
+                self.posts_by_blog[blog_name].insert(0, post)
+
+    def _generate_post(
+        self, blog_name: str, post_id: int, timestamp: int
+    ) -> dict[str, Any]:
+        post: dict[str, Any] = {
+            "id": post_id,
+            "id_string": str(post_id),
+            "blog_name": blog_name,
+            "timestamp": timestamp,
+            "slug": f"post-{post_id}",
+        }
+        scenario = self.scenario
+        shares = {
+            "reblog": scenario.reblog_share,
+            "answer": scenario.answer_share,
+            "video": scenario.video_share,
+            "photo": scenario.photo_share,
+        }
+        shares["text"] = max(0.0, 1 - sum(shares.values()))
+        post_type = self.rng.choices(list(shares), weights=list(shares.values()))[0]
+
+        # The same post in the Neue Post Format, sent for `npf=true`
+        npf: dict[str, Any] = {"type": "blocks", "content": [], "layout": []}
+        match post_type:
+            case "reblog":
+                path = self._add_image(blog_name, post_id, 0)
+                post["type"] = "photo"
+                post["parent_post_url"] = f"https://other.tumblr.com/post/{post_id}"
+                post["photos"] = [self._photo(path)]
+                npf["trail"] = [{"content": [self._image_block(path)]}]
+            case "answer":
+                post["type"] = "answer"
+                post["question"] = "What do you draw with?"
+                post["answer"] = "<p>Pencils.</p>"
+                npf["content"] = [
+                    {"type": "text", "text": post["question"]},
+                    {"type": "text", "text": "Pencils."},
+                ]
+                npf["layout"] = [{"type": "ask", "blocks": [0]}]
+            case "video":
+                path = self._add_media(
+                    f"{blog_name}/{post_id}.mp4",
+                    self.rng.randint(*scenario.video_mb) * 1024 * 1024,
+                )
+                post["type"] = "text"
+                post["trail"] = [
+                    {
+                        "content_raw": (
+                            f'<figure><video><source src="{path}" type="video/mp4">'
+                            "</video></figure>"
+                        )
+                    }
+                ]
+                npf["content"] = [
+                    {
+                        "type": "video",
+                        "provider": "tumblr",
+                        "media": {
+                            "url": path,
+                            "type": "video/mp4",
+                            "width": 1280,
+                            "height": 720,
+                        },
+                    }
+                ]
+            case "photo":
+                path = self._get_image(blog_name, post_id)
+                post["type"] = "photo"
+                post["photos"] = [self._photo(path)]
+                npf["content"] = [self._image_block(path)]
+            case _:
+                images = [
+                    self._get_image(blog_name, post_id, image_i)
+                    for image_i in range(self.rng.randint(1, 3))
+                ]
+                post["type"] = "text"
+                post["trail"] = [
+                    {
+                        "content_raw": "".join(
+                            f'<figure><img src="{path}" srcset="{path}?w=400 400w, '
+                            f'{path} 1280w"></figure>'
+                            for path in images
+                        )
+                    }
+                ]
+                npf["content"] = [
+                    {"type": "text", "text": "A new drawing."},
+                    *(self._image_block(path) for path in images),
+                ]
+        post["npf"] = npf
+        return post
+
+    def to_format(self, post: dict[str, Any], is_npf: bool) -> dict[str, Any]:
+        legacy_post = {key: value for key, value in post.items() if key != "npf"}
+        if not is_npf:
+            return legacy_post
+        npf_post: dict[str, Any] = post["npf"]
+        return {
+            key: value
+            for key, value in legacy_post.items()
+            if key
+            in {"id", "id_string", "blog_name", "timestamp", "slug", "parent_post_url"}
+        } | npf_post
+
+    def _get_image(self, blog_name: str, post_id: int, image_i: int = 0) -> str:
+        roll = self.rng.random()
+        if self.media and roll < self.scenario.repost_share:
+            return self.rng.choice(list(self.media))  # posted by another blog
+        path = self._add_image(blog_name, post_id, image_i)
+        if (
+            self.media
+            and roll < self.scenario.repost_share + self.scenario.reupload_share
+        ):
+            # The same bytes under a new URL and ETag, only the content hash finds it
+            source = self.media[self.rng.choice(list(self.media))]
+            self.media[path].seed = source.seed
+            self.media[path].size = source.size
+        return path
+
+    def _add_image(self, blog_name: str, post_id: int, image_i: int) -> str:
+        return self._add_media(
+            f"{blog_name}/{post_id}_{image_i}.jpg",
+            self.rng.randint(*self.scenario.image_kb) * 1024,
+        )
+
+    def _add_media(self, path: str, size: int) -> str:
+        digest = hashlib.sha256(path.encode()).digest()
+        self.media[path] = Media(size=size, etag=digest.hex()[:16], seed=digest)
+        return path
+
+    def _photo(self, path: str) -> dict[str, Any]:
+        sizes = [
+            {
+                "url": path if width == IMAGE_WIDTHS[0] else f"{path}?w={width}",
+                "width": width,
+            }
+            for width in IMAGE_WIDTHS
+        ]
+        return {"original_size": sizes[0], "alt_sizes": sizes}
+
+    def _image_block(self, path: str) -> dict[str, Any]:
+        return {
+            "type": "image",
+            "media": [
+                {"url": path, "type": "image/jpeg", "width": 1280, "height": 960},
+                {
+                    "url": f"{path}?w=400",
+                    "type": "image/jpeg",
+                    "width": 400,
+                    "height": 300,
+                },
+            ],
+        }
+
+    def with_base_url(self, value: Any) -> Any:  # noqa: ANN401
+        # Media paths get the server address only when they are sent
+        if isinstance(value, dict):
+            return {key: self.with_base_url(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.with_base_url(item) for item in value]
+        if isinstance(value, str) and value.split("?")[0] in self.media:
+            return f"{self.base_url}/media/{value}"
+        if isinstance(value, str) and "<figure>" in value:
+            return re.sub(
+                r'(src|srcset)="([^"]+)"',
+                lambda m: f'{m[1]}="{self._prefix_urls(m[2])}"',
+                value,
+            )
+        return value
+
+    def _prefix_urls(self, urls: str) -> str:
+        return re.sub(
+            r"(^|, )([^ ,]+)", lambda m: f"{m[1]}{self.base_url}/media/{m[2]}", urls
+        )
+
+
+class FakeTumblrHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # connections are kept alive like on the real hosts
+    server: "FakeTumblrServer"
+
+    def do_GET(self) -> None:
+        self._handle(is_head=False)
+
+    def do_HEAD(self) -> None:
+        self._handle(is_head=True)
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002, ANN401
+        pass  # the pipeline's log is the one to read
+
+    def _handle(self, is_head: bool) -> None:
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path.startswith("/v2/"):
+            self._send_api(url.path.removeprefix("/v2/"), params)
+        elif url.path.startswith("/media/"):
+            self._send_media(url.path.removeprefix("/media/"), params, is_head)
+        else:
+            self.send_error(404)
+
+    def _send_api(self, path: str, params: dict[str, str]) -> None:
+        fake = self.server.fake
+        fake.count("api")
+        time.sleep(fake.scenario.api_latency_ms / 1000)
+        limit = int(params.get("limit", 20))
+        offset = int(params.get("offset", 0))
+        is_npf = params.get("npf") == "true"
+
+        blog_match = re.fullmatch(r"blog/([^.]+)\.tumblr\.com/posts", path)
+        if path == "user/info":
+            response: dict[str, Any] = {
+                "user": {"name": "benchmark", "following": len(fake.posts_by_blog)}
+            }
+        elif path == "user/following":
+            names = sorted(fake.posts_by_blog)[offset : offset + limit]
+            response = {"blogs": [{"name": name} for name in names]}
+        elif path == "user/dashboard":
+            since_id = int(params.get("since_id", 0))
+            posts = [post for post in fake.posts if post["id"] > since_id]
+            response = {
+                "posts": [
+                    fake.to_format(post, is_npf)
+                    for post in posts[offset : offset + limit]
+                ]
+            }
+        elif blog_match and blog_match[1] in fake.posts_by_blog:
+            posts = fake.posts_by_blog[blog_match[1]]
+            if "before" in params:
+                posts = [p for p in posts if p["timestamp"] < int(params["before"])]
+            if "after" in params:
+                posts = [p for p in posts if p["timestamp"] > int(params["after"])]
+            response = {
+                "posts": [
+                    fake.to_format(post, is_npf)
+                    for post in posts[offset : offset + limit]
+                ]
+            }
+        else:
+            self.send_error(404)
+            return
+
+        body = json.dumps({
+            "meta": {"status": 200, "msg": "OK"},
+            "response": fake.with_base_url(response),
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_media(self, path: str, params: dict[str, str], is_head: bool) -> None:
+        fake = self.server.fake
+        media = fake.media.get(path)
+        if media is None:
+            self.send_error(404)
+            return
+        if "w" in params:
+            media = media.get_variant(int(params["w"]))
+
+        fake.count("head" if is_head else "get")
+        time.sleep(fake.scenario.media_latency_ms / 1000)
+        start, end = 0, media.size - 1
+        range_match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if range_match and not is_head:
+            fake.count("range")
+            start, end = int(range_match[1]), min(int(range_match[2]), end)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{media.size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{media.etag}"')
+        self.end_headers()
+        if is_head:
+            return
+
+        # Sent at the scenario bandwidth of a single connection
+        bytes_per_s = fake.scenario.media_mb_per_s * 1024 * 1024
+        started_at = time.monotonic()
+        sent_bytes = 0
+        while start + sent_bytes <= end:
+            length = min(CHUNK_SIZE, end + 1 - start - sent_bytes)
+            self.wfile.write(media.read(start + sent_bytes, length))
+            sent_bytes += length
+            if bytes_per_s:
+                time.sleep(
+                    max(0.0, sent_bytes / bytes_per_s - (time.monotonic() - started_at))
+                )
+        fake.count("bytes_sent", sent_bytes)
+
+
+class FakeTumblrServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, scenario: Scenario) -> None:
+        super().__init__(("127.0.0.1", 0), FakeTumblrHandler)
+        self.fake = FakeTumblr(scenario)
+        self.fake.base_url = f"http://127.0.0.1:{self.server_port}"
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.fake.base_url}/v2"
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def close(self) -> None:
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
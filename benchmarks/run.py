@@ -0,0 +1,238 @@
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+from fake_tumblr import FakeTumblrServer
+from scenarios import SCENARIOS, Scenario
+
+# Runs `scripts/pipeline.py` against a local Tumblr and a fake MEGAcmd,
+# so a change can be measured without the network or any account.
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCHMARKS_DIR.parent
+MB = 1024 * 1024
+
+
+def get_env(
+    scenario: Scenario, server: FakeTumblrServer, work_dir: Path
+) -> dict[str, str]:
+    # Only what the pipeline needs, the developer's own settings must not leak in
+    env = {
+        key: os.environ[key] for key in ("HOME", "LANG", "TMPDIR") if key in os.environ
+    }
+    env.update({
+        "PATH": f"{BENCHMARKS_DIR / 'bin'}{os.pathsep}{os.environ.get('PATH', '')}",
+        "FAKE_MEGA_PYTHON": sys.executable,
+        "FAKE_MEGA_ROOT": str(work_dir / "mega"),
+        "FAKE_MEGA_PUT_LATENCY_S": str(scenario.mega_put_latency_ms / 1000),
+        "FAKE_MEGA_MB_PER_S": str(scenario.mega_mb_per_s),
+        "TUMBLR_API_URL": server.api_url,
+        "TUMBLR_CONSUMER_KEY": "benchmark",
+        "TUMBLR_CONSUMER_SECRET": "benchmark",
+        "TUMBLR_OAUTH_TOKEN": "benchmark",
+        "TUMBLR_OAUTH_SECRET": "benchmark",
+        "TUMBLR_COLLECT_VIDEOS": "True",
+        "TUMBLR_FILE_LIMIT_PER_BLOG": str(scenario.posts_per_blog * 3),
+        "SAVE_TO_MEGA": "True",
+        "MEGA_EMAIL": "benchmark@example.com",
+        "MEGA_PASSWORD": "benchmark",
+        "MEGA_FOLDER_SIZE_LIMIT_MB": "1000000",
+        "LOCAL_FILE_SIZE_LIMIT_MB": str(scenario.video_mb[1] + 1),
+        "CONFIG_FILE": str(work_dir / "config.json"),
+        "DEDUP_DB_FILE": str(work_dir / "dedup.sqlite3"),
+        "SHARD_STATE_FILE": str(work_dir / "shard_state.sqlite3"),
+        "METRICS_REPORT_FILE": str(work_dir / "run_report.json"),
+        "SPOOL_DIR": "",  # runs must not share memory with each other
+    })
+    env.update(scenario.settings)
+    return env
+
+
+def run_scenario(scenario: Scenario, timeout_s: float) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix=f"art_collector_{scenario.name}_") as tmp:
+        # The pipeline writes its log and temp files relative to the working dir
+        work_dir = Path(tmp)
+        for dir_name in ("logs", "temp", "mega/art_collector"):
+            (work_dir / dir_name).mkdir(parents=True)  # an account used before
+        (work_dir / "config.json").write_text(
+            json.dumps({
+                "last_runtime": datetime.datetime.now(datetime.UTC).isoformat(),
+                "current_tumblr_blogs": [],
+            })
+        )
+
+        server = FakeTumblrServer(scenario)
+        server.start()
+        try:
+            started_at = time.monotonic()
+            result = subprocess.run(
+                [sys.executable, str(REPO_DIR / "scripts" / "pipeline.py")],
+                cwd=work_dir,
+                env=get_env(scenario, server, work_dir),
+                capture_output=True,
+                text=True,
+                timeout=timeout_s,
+                check=False,
+            )
+            runtime_s = time.monotonic() - started_at
+        finally:
+            server.close()
+
+        if result.returncode != 0:
+            log_tail = (work_dir / "logs" / "art_collector.log").read_text()[-2000:]
+            msg = (
+                f"The scenario {scenario.name} failed:\n{result.stderr[-2000:]}"
+                f"\n{log_tail}"
+            )
+            raise RuntimeError(msg)
+
+        report = json.loads((work_dir / "run_report.json").read_text())
+
+    return summarize(scenario, runtime_s, report, server.fake.stats)
+
+
+def summarize(
+    scenario: Scenario,
+    runtime_s: float,
+    report: dict[str, Any],
+    server_stats: dict[str, int],
+) -> dict[str, Any]:
+    collected_bytes = sum(blog["bytes"] for blog in report["blogs"].values())
+    return {
+        "scenario": scenario.name,
+        "runtime_s": round(runtime_s, 3),
+        "files": sum(blog["files"] for blog in report["blogs"].values()),
+        "bytes": collected_bytes,
+        "mb_per_s": round(collected_bytes / MB / runtime_s, 3),
+        "stages": report["stages"],
+        "skipped": report["skipped"],
+        "queue_depth": {
+            key: value
+            for key, value in report["queue_depth"].items()
+            if key != "samples"
+        },
+        "server": server_stats,
+    }
+
+
+def format_result(result: dict[str, Any]) -> list[str]:
+    lines = [
+        f"{result['scenario']}: {result['runtime_s']:.2f}s, {result['files']} files, "
+        f"{result['bytes'] / MB:.1f} MB, {result['mb_per_s']:.2f} MB/s, "
+        f"queue depth {result['queue_depth']['mean']} on average"
+    ]
+    for stage, stats in result["stages"].items():
+        throughput = (
+            f", {stats['run_bytes_per_s'] / MB:.2f} MB/s" if stats["bytes"] else ""
+        )
+        lines.append(
+            f"    {stage:<12} {stats['count']:>6} calls {stats['errors']:>4} failed  "
+            f"p50 {stats['p50_s']:.3f}s  p95 {stats['p95_s']:.3f}s  "
+            f"max {stats['max_s']:.3f}s{throughput}"
+        )
+    if result["skipped"]:
+        skipped = ", ".join(
+            f"{reason} {cnt}" for reason, cnt in result["skipped"].items()
+        )
+        lines.append(f"    skipped: {skipped}")
+    return lines
+
+
+def check_skips(scenario: Scenario, result: dict[str, Any]) -> list[str]:
+    # The failures, a code path the scenario relies on may have stopped working
+    return [
+        f"{scenario.name}: {result['skipped'].get(reason, 0)} files were skipped "
+        f"as {reason} instead of at least {min_cnt}"
+        for reason, min_cnt in scenario.min_skips.items()
+        if result["skipped"].get(reason, 0) < min_cnt
+    ]
+
+
+def compare(
+    results: list[dict[str, Any]], baseline: list[dict[str, Any]], tolerance: float
+) -> list[str]:  # the regressions
+    baseline_by_name = {result["scenario"]: result for result in baseline}
+    regressions: list[str] = []
+    for result in results:
+        previous = baseline_by_name.get(result["scenario"])
+        if previous is None:
+            continue
+        if result["runtime_s"] > previous["runtime_s"] * (1 + tolerance):
+            regressions.append(
+                f"{result['scenario']}: the runtime grew from "
+                f"{previous['runtime_s']:.2f}s to {result['runtime_s']:.2f}s"
+            )
+        if result["files"] != previous["files"]:
+            regressions.append(
+                f"{result['scenario']}: {result['files']} files were collected "
+                f"instead of {previous['files']}"
+            )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Runs the pipeline against a local Tumblr and MEGA."
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        help=f"the scenarios to run, all of them by default: {', '.join(SCENARIOS)}",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs per scenario, the median is kept"
+    )
+    parser.add_argument("--timeout", type=float, default=600, help="seconds per run")
+    parser.add_argument("--output", type=Path, help="a JSON file for the results")
+    parser.add_argument(
+        "--baseline", type=Path, help="the results of a previous run to compare with"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.15,
+        help="a slowdown above this share of the baseline runtime fails the run",
+    )
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+
+    results: list[dict[str, Any]] = []
+    failures: list[str] = []
+    for name in args.scenarios or SCENARIOS:
+        scenario = SCENARIOS[name]
+        sys.stdout.write(f"Running {name}: {scenario.description}\n")
+        runs = [run_scenario(scenario, args.timeout) for _ in range(args.repeat)]
+        median_runtime_s = statistics.median_low(run["runtime_s"] for run in runs)
+        result = next(run for run in runs if run["runtime_s"] == median_runtime_s)
+        results.append(result)
+        failures.extend(check_skips(scenario, result))
+        sys.stdout.write("\n".join(format_result(result)) + "\n")
+
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(results, indent=2))
+
+    for failure in failures:
+        sys.stdout.write(f"FAILED {failure}\n")
+
+    regressions: list[str] = []
+    if args.baseline:
+        regressions = compare(
+            results, json.loads(args.baseline.read_text()), args.tolerance
+        )
+        for regression in regressions:
+            sys.stdout.write(f"REGRESSION {regression}\n")
+    return 1 if failures or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
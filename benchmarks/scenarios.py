@@ -0,0 +1,105 @@
+from dataclasses import dataclass, field
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    description: str
+    seed: int = 42  # the same posts and files on every run
+    blog_cnt: int = 20
+    posts_per_blog: int = 20
+    # Shares of the posts, the rest are text posts with 1-3 images
+    photo_share: float = 0.4
+    video_share: float = 0.03
+    reblog_share: float = 0.1  # skipped by the collector without any request
+    answer_share: float = 0.05
+    repost_share: float = 0.05  # a file another blog has posted, the same URL
+    reupload_share: float = 0.03  # the bytes of another file under a new URL
+    image_kb: tuple[int, int] = (50, 500)
+    video_mb: tuple[int, int] = (2, 10)
+    api_latency_ms: int = 50
+    media_latency_ms: int = 30  # until the headers are sent
+    media_mb_per_s: float = 20  # per connection, 0 for unlimited
+    mega_put_latency_ms: int = 300  # per `mega-put` call
+    mega_mb_per_s: float = 50  # 0 for unlimited
+    settings: dict[str, str] = field(default_factory=dict)  # the pipeline's .env
+    # The fewest skips of a reason the run must report, or it fails
+    min_skips: dict[str, int] = field(default_factory=dict)
+
+
+SCENARIOS = {
+    scenario.name: scenario
+    for scenario in (
+        Scenario(name="baseline", description="The default settings."),
+        Scenario(
+            name="asyncio",
+            description="The baseline on the asyncio engine.",
+            settings={"PIPELINE_ENGINE": "asyncio"},
+        ),
+        Scenario(
+            name="get_mode",
+            description="The baseline without HEAD requests.",
+            settings={"FETCH_MODE": "get"},
+        ),
+        Scenario(
+            name="dedup_across_blogs",
+            description="The baseline, a file posted by several blogs is kept once.",
+            settings={"DEDUP_ACROSS_BLOGS": "True"},
+            # Reuploads copy the bytes of a file, often from another blog
+            min_skips={"duplicate_content": 1},
+        ),
+        Scenario(
+            name="npf",
+            description="The baseline with posts in the Neue Post Format.",
+            settings={"TUMBLR_POST_FORMAT": "npf"},
+        ),
+        Scenario(
+            name="image_budget",
+            description="The baseline with a smaller size for images over 300 KB.",
+            settings={"TUMBLR_IMAGE_MAX_KB": "300"},
+        ),
+        Scenario(
+            name="sharded",
+            description="The baseline split between 2 processes.",
+            settings={"SHARD_COUNT": "2"},
+        ),
+        Scenario(
+            name="small_images",
+            description="Many blogs with small images only.",
+            blog_cnt=60,
+            posts_per_blog=20,
+            photo_share=0.6,
+            video_share=0,
+            image_kb=(10, 200),
+        ),
+        Scenario(
+            name="large_videos",
+            description="Mostly videos, downloaded in Range segments.",
+            blog_cnt=4,
+            posts_per_blog=10,
+            photo_share=0.2,
+            video_share=0.6,
+            video_mb=(10, 40),
+        ),
+        Scenario(
+            name="slow_cdn",
+            description="A slow media host, more consumers should help.",
+            media_latency_ms=300,
+            media_mb_per_s=2,
+        ),
+        Scenario(
+            name="scaled_consumers",
+            description="A slow media host, consumers scaled between 2 and 32.",
+            media_latency_ms=300,
+            media_mb_per_s=2,
+            settings={"MIN_WORKERS": "2", "MAX_WORKERS": "32"},
+        ),
+        Scenario(
+            name="slow_mega",
+            description="Slow uploads, batching should help.",
+            blog_cnt=10,
+            mega_put_latency_ms=2000,
+            mega_mb_per_s=10,
+        ),
+    )
+}
@@ -0,0 +1,600 @@
+import asyncio
+import logging
+import subprocess
+import time
+from collections import deque
+from collections.abc import Coroutine, Generator, Iterable
+from pathlib import Path
+from typing import Any, BinaryIO
+
+import httpx
+from config import settings
+from consumer import Consumer
+from content_hash import BlockHasher, combine_block_hashes
+from file_metadata import FileCandidate, FileMetadata
+from file_queue import AsyncFileQueue, create_queue_policy
+from helper import RangeNotSupportedError
+from metrics import metrics
+from oauthlib.oauth1 import Client
+from tumblr import BlogCursor, DashboardCursor, TumblrCollector
+from tumblr_api import tumblr_api
+
+
+class OAuth1Auth(httpx.Auth):
+    # Signs Tumblr API requests the same way `requests_oauthlib.OAuth1` does
+    def __init__(self) -> None:
+        self.client = Client(
+            client_key=settings.TUMBLR_CONSUMER_KEY or "",
+            client_secret=settings.TUMBLR_CONSUMER_SECRET,
+            resource_owner_key=settings.TUMBLR_OAUTH_TOKEN,
+            resource_owner_secret=settings.TUMBLR_OAUTH_SECRET,
+        )
+
+    def auth_flow(
+        self, request: httpx.Request
+    ) -> Generator[httpx.Request, httpx.Response, None]:
+        # The Tumblr API is only read from
+        _, headers, _ = self.client.sign(str(request.url), http_method="GET")
+        request.headers.update(headers)
+        yield request
+
+
+class AsyncPipeline:
+    # Crawling, HEAD requests, downloads and uploads run as coroutines on one thread,
+    # so hundreds of files can be in flight without a thread per file.
+    # Limits, dedup and checkpoints are shared with the threaded pipeline
+    # through `TumblrCollector` and `Consumer`.
+    def __init__(self, tumblr: TumblrCollector, consumer: Consumer) -> None:
+        self.tumblr = tumblr
+        self.consumer = consumer
+        self.file_meta = tumblr.resolver.file_meta
+        self.file_queue = AsyncFileQueue(
+            create_queue_policy(tumblr.ledger),
+            maxsize=settings.ASYNC_DOWNLOAD_CONCURRENCY * 2,
+        )
+        self.upload_queue: asyncio.Queue[FileMetadata] = asyncio.Queue(
+            maxsize=settings.ASYNC_UPLOAD_CONCURRENCY * settings.MEGA_UPLOAD_BATCH_FILES
+        )
+        self.head_slots = asyncio.Semaphore(settings.METADATA_RESOLVER_WORKERS)
+        self.api_client = httpx.AsyncClient(
+            auth=OAuth1Auth(),
+            timeout=10,
+            limits=httpx.Limits(max_connections=settings.TUMBLR_CRAWLER_WORKERS),
+        )
+        # Downloads and HEAD requests share the media connections
+        self.media_client = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(
+                max_connections=settings.ASYNC_DOWNLOAD_CONCURRENCY
+                + settings.METADATA_RESOLVER_WORKERS
+            ),
+        )
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    async def run(self, blog_names: set[str]) -> None:
+        await self._run(self._produce_files(blog_names))
+
+    async def run_planned(self, files: Iterable[FileMetadata]) -> None:
+        await self._run(self._produce_planned_files(files))
+
+    async def _run(self, producer: Coroutine[Any, Any, None]) -> None:
+        workers = [
+            *(
+                asyncio.create_task(self._download_worker())
+                for _ in range(settings.ASYNC_DOWNLOAD_CONCURRENCY)
+            ),
+            *(
+                asyncio.create_task(self._upload_worker())
+                for _ in range(settings.ASYNC_UPLOAD_CONCURRENCY)
+            ),
+        ]
+        try:
+            await producer
+            await self.file_queue.join()
+            await self.upload_queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def close(self) -> None:
+        # Clients are kept between runs in watch mode
+        await self.api_client.aclose()
+        await self.media_client.aclose()
+
+    async def _get_api(
+        self, path: str, params: dict[str, Any] | None = None
+    ) -> dict[str, Any]:
+        # The same budget and backoff as `tumblr_api.get`, only the waiting is async
+        for attempt in range(settings.TUMBLR_API_MAX_RETRIES + 1):
+            wait_s = tumblr_api.schedule_call()
+            if wait_s > 0:
+                await asyncio.sleep(wait_s)
+
+            with metrics.measure("api"):
+                resp = await self.api_client.get(
+                    tumblr_api.get_url(path), params=params
+                )
+            if not tumblr_api.should_retry(path, resp, attempt):
+                break
+
+        response: dict[str, Any] = tumblr_api.read_response(resp)
+        return response
+
+    async def _produce_files(self, blog_names: set[str]) -> None:
+        self.logger.info("Start extracting files...")
+        processed_keys: dict[str, set[str]] = {
+            blog_name: set() for blog_name in blog_names
+        }
+        cursors, is_first_run = self.tumblr.prepare_cursors(blog_names)
+
+        dashboard_since_id = self.tumblr.runtime_config.get_dashboard_since_id()
+        self.tumblr.dashboard_since_id = dashboard_since_id
+        if settings.TUMBLR_USE_DASHBOARD and dashboard_since_id and not is_first_run:
+            followed_cursors = self.tumblr.get_dashboard_cursors(cursors)
+            is_dashboard_complete = await self._add_dashboard_files(
+                processed_keys, followed_cursors, dashboard_since_id
+            )
+            if is_dashboard_complete:
+                cursors = [
+                    cursor
+                    for cursor in cursors
+                    if cursor.blog_name not in followed_cursors
+                ]
+
+        elif settings.TUMBLR_USE_DASHBOARD:
+            # Posts published during this run will be read from the dashboard next time
+            response = await self._get_api(
+                "user/dashboard", params=self.tumblr.dashboard_head_params
+            )
+            self.tumblr.dashboard_since_id = self.tumblr.read_dashboard_head_id(
+                response
+            )
+
+        # Blogs are crawled a page at a time and put back at the end of the queue
+        blog_queue: asyncio.Queue[BlogCursor] = asyncio.Queue()
+        for cursor in cursors:
+            blog_queue.put_nowait(cursor)
+
+        crawlers = [
+            asyncio.create_task(
+                self._blog_crawler_worker(blog_queue, processed_keys, is_first_run)
+            )
+            for _ in range(min(settings.TUMBLR_CRAWLER_WORKERS, len(cursors)))
+        ]
+        try:
+            await blog_queue.join()
+        finally:
+            for crawler in crawlers:
+                crawler.cancel()
+            await asyncio.gather(*crawlers, return_exceptions=True)
+
+        self.logger.info("All files have been produced.")
+
+    async def _produce_planned_files(self, files: Iterable[FileMetadata]) -> None:
+        # The crawl was done by the planner, but reading the plan still hits
+        # SQLite and `config.json`, so it's done off the loop
+        planned_files = iter(files)
+        while file := await asyncio.to_thread(next, planned_files, None):
+            await self.file_queue.put(file)
+
+    async def _add_dashboard_files(
+        self,
+        processed_keys: dict[str, set[str]],
+        cursors: dict[str, BlogCursor],
+        since_id: int,
+    ) -> bool:  # False if the dashboard didn't reach `since_id`
+        self.logger.info(f"Start reading the dashboard since the post {since_id}...")
+        dashboard_cursor = DashboardCursor(since_id=since_id)
+
+        while not await asyncio.to_thread(self.tumblr.is_crawl_stopped):
+            response = await self._get_api(
+                "user/dashboard",
+                params=self.tumblr.get_dashboard_params(dashboard_cursor),
+            )
+            candidates_by_blog = self.tumblr.route_dashboard_posts(
+                response["posts"], cursors
+            )
+            for blog_name, candidates in candidates_by_blog.items():
+                await self._add_files(processed_keys, cursors[blog_name], candidates)
+
+            if not self.tumblr.advance_dashboard(dashboard_cursor, response):
+                break
+
+        is_complete: bool = dashboard_cursor.is_complete
+        return is_complete
+
+    async def _blog_crawler_worker(
+        self,
+        blog_queue: asyncio.Queue[BlogCursor],
+        processed_keys: dict[str, set[str]],
+        is_first_run: bool,
+    ) -> None:
+        while True:
+            cursor = await blog_queue.get()
+            try:
+                has_next_page = await self._add_blog_page(
+                    processed_keys, cursor, is_first_run
+                )
+                if has_next_page:
+                    blog_queue.put_nowait(cursor)
+                else:
+                    self.tumblr.finish_blog(cursor)
+
+            except Exception:
+                self.logger.exception(f"Failed to crawl {cursor.blog_name}")
+                self.tumblr.runtime_config.fail_blog(cursor.blog_name)
+
+            finally:
+                blog_queue.task_done()
+
+    async def _add_blog_page(
+        self,
+        processed_keys: dict[str, set[str]],
+        cursor: BlogCursor,
+        is_first_run: bool,
+    ) -> bool:  # True if the blog has more pages to crawl
+        # The ledger of a shard is in SQLite
+        if await asyncio.to_thread(
+            self.tumblr.is_blog_done, processed_keys, cursor.blog_name
+        ):
+            return False
+
+        params = self.tumblr.get_page_params(cursor, is_first_run)
+        response = await self._get_api(
+            f"blog/{cursor.blog_name}.tumblr.com/posts", params=params
+        )
+        candidates = self.tumblr.get_page_candidates(cursor, response["posts"])
+        await self._add_files(processed_keys, cursor, candidates)
+        has_next_page: bool = self.tumblr.advance_cursor(cursor, params, response)
+        return has_next_page
+
+    async def _add_files(
+        self,
+        processed_keys: dict[str, set[str]],
+        cursor: BlogCursor,
+        candidates: list[FileCandidate],
+    ) -> None:
+        # Known files are looked up and claimed in the dedup store, off the loop
+        pending_candidates = deque(candidates)
+        while batch := await asyncio.to_thread(
+            self.tumblr.select_candidates, processed_keys, cursor, pending_candidates
+        ):
+            files = iter(
+                await asyncio.gather(
+                    *(
+                        self._resolve(candidate)
+                        for candidate, is_known in batch
+                        if not is_known
+                    )
+                )
+            )
+            # Files are added in the crawl order, as the threaded crawlers do
+            for candidate, is_known in batch:
+                if is_known:
+                    await asyncio.to_thread(
+                        self.tumblr.add_collected_file,
+                        processed_keys,
+                        str(candidate.url),
+                        candidate,
+                    )
+                    continue
+
+                file = next(files)
+                if file is None:
+                    continue
+                if await asyncio.to_thread(
+                    self.tumblr.accept_file, processed_keys, file, cursor.blog_name
+                ):
+                    await self.file_queue.put(file)
+
+    async def _resolve(self, candidate: FileCandidate) -> FileMetadata | None:
+        if settings.FETCH_MODE == "get":  # the size comes with the download
+            return self.file_meta.build_file_metadata(
+                url=candidate.url,
+                author=candidate.blog_name,
+                post_slug=candidate.post_slug,
+                numeric_suffix=candidate.numeric_suffix,
+                headers=None,
+                variant_width=candidate.variant_width,
+            )
+
+        async with self.head_slots:
+            try:
+                with metrics.measure("head"):
+                    resp = await self.media_client.head(str(candidate.url))
+                    resp.raise_for_status()
+            except httpx.HTTPError as e:
+                self.logger.warning(
+                    f"Failed to get metadata for {candidate.url}. "
+                    f"Error: {e}. Skipping..."
+                )
+                metrics.count_skip("metadata_failed", candidate.blog_name)
+                return None
+
+        file = self.file_meta.build_file_metadata(
+            url=candidate.url,
+            author=candidate.blog_name,
+            post_slug=candidate.post_slug,
+            numeric_suffix=candidate.numeric_suffix,
+            headers=resp.headers,
+            variant_width=candidate.variant_width,
+        )
+        if self.file_meta.is_over_byte_budget(file, candidate):
+            return await self._resolve(candidate.get_smaller_variant())
+        return file
+
+    async def _download_worker(self) -> None:
+        while True:
+            waited_at = time.monotonic()
+            file = await self.file_queue.get()
+            metrics.observe("queue_wait", time.monotonic() - waited_at)
+            metrics.sample_queue_depth(self.file_queue.qsize())
+            is_handed_to_uploader = False
+            try:
+                is_saved = await self._download_file(file)
+                if is_saved and not await asyncio.to_thread(
+                    self.consumer.skip_duplicate_content, file
+                ):
+                    await self.upload_queue.put(file)
+                    is_handed_to_uploader = True
+
+            except Exception:
+                self.logger.exception(f"Failed to process {file.url}")
+
+            finally:
+                if not is_handed_to_uploader:
+                    # May checkpoint the blog to `config.json`
+                    await asyncio.to_thread(
+                        self.consumer.runtime_config.finish_pending_file, file.blog_name
+                    )
+                self.file_queue.task_done()
+
+    async def _download_file(self, file: FileMetadata) -> bool:  # False if rejected
+        # Disk and SQLite calls run in threads, so other downloads go on meanwhile
+        is_get_mode = settings.FETCH_MODE == "get"
+        if not is_get_mode and not await asyncio.to_thread(
+            self.consumer.accept_file, file
+        ):
+            return False
+
+        helper = self.consumer.helper
+        part_path = helper.get_part_path(file)
+        is_reserved = not is_get_mode
+        started_at = time.monotonic()
+        block_hashes: list[bytes] | None = None
+        try:
+            if is_get_mode or not helper.is_segmented(file):
+                async with self.media_client.stream("GET", str(file.url)) as resp:
+                    resp.raise_for_status()
+                    if is_get_mode:
+                        # Leaving the block unread drops the body of a rejected file
+                        if not await asyncio.to_thread(
+                            self.consumer.accept_headers, file, resp.headers
+                        ):
+                            return False
+                        is_reserved = True
+
+                    # A large file is requested again in segments
+                    if not helper.is_segmented(file):
+                        self.logger.info(f"Processing {file.url}...")
+                        block_hashes = await self._download_stream(resp, part_path)
+
+            if block_hashes is None:
+                self.logger.info(f"Processing {file.url} in segments...")
+                block_hashes = await self._download_segments(file, part_path)
+
+            if block_hashes is None:  # the server doesn't support ranges
+                async with self.media_client.stream("GET", str(file.url)) as resp:
+                    resp.raise_for_status()
+                    block_hashes = await self._download_stream(resp, part_path)
+
+        except Exception:
+            metrics.observe("download", time.monotonic() - started_at, is_error=True)
+            if is_reserved:
+                await asyncio.to_thread(self.consumer.abandon_file, file)
+            raise
+
+        # The size is only known here in get mode
+        metrics.observe("download", time.monotonic() - started_at, file.known_size)
+        file.content_hash = combine_block_hashes(block_hashes)
+        await asyncio.to_thread(part_path.replace, file.local_path)
+        return True
+
+    async def _download_stream(
+        self, resp: httpx.Response, part_path: Path
+    ) -> list[bytes]:  # the block hashes of the file
+        hasher = BlockHasher()
+        try:
+            f = await asyncio.to_thread(part_path.open, "wb")
+            with f:
+                async for chunk in resp.aiter_bytes(settings.DOWNLOAD_CHUNK_BYTES):
+                    await asyncio.to_thread(self._write_chunk, f, hasher, chunk)
+        except Exception:
+            await asyncio.to_thread(part_path.unlink, missing_ok=True)
+            raise
+        block_hashes: list[bytes] = hasher.finish()
+        return block_hashes
+
+    async def _download_segments(
+        self, file: FileMetadata, part_path: Path
+    ) -> list[bytes] | None:  # None if the server doesn't support ranges
+        # The same segments and `.part.json` progress as `Helper.download_file`,
+        # a failed download keeps them to be resumed
+        helper = self.consumer.helper
+        progress_path = helper.get_progress_path(part_path)
+        progress = await asyncio.to_thread(
+            helper.prepare_segments, file, part_path, progress_path
+        )
+        segment_slots = asyncio.Semaphore(settings.DOWNLOAD_SEGMENT_WORKERS)
+        tasks: list[asyncio.Task[tuple[int, list[bytes]]]] = []
+        try:
+            if not progress["done_segments"]:
+                # The first segment shows whether the server supports ranges
+                start, block_hashes = await self._download_segment(
+                    file, part_path, 0, segment_slots
+                )
+                await asyncio.to_thread(
+                    helper.record_segment, progress_path, progress, start, block_hashes
+                )
+
+            tasks = [
+                asyncio.create_task(
+                    self._download_segment(file, part_path, start, segment_slots)
+                )
+                for start in helper.get_pending_segments(file, progress)
+            ]
+            # Progress is saved by one coroutine at a time
+            for task in asyncio.as_completed(tasks):
+                start, block_hashes = await task
+                await asyncio.to_thread(
+                    helper.record_segment, progress_path, progress, start, block_hashes
+                )
+
+        except RangeNotSupportedError:
+            await asyncio.to_thread(
+                helper.discard_segments, file, part_path, progress_path
+            )
+            return None
+
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        file_block_hashes: list[bytes] = await asyncio.to_thread(
+            helper.finish_segments, progress_path, progress
+        )
+        return file_block_hashes
+
+    async def _download_segment(
+        self,
+        file: FileMetadata,
+        part_path: Path,
+        start: int,
+        segment_slots: asyncio.Semaphore,
+    ) -> tuple[int, list[bytes]]:  # the start offset, block hashes
+        end, headers = self.consumer.helper.get_segment_range(file, start)
+        hasher = BlockHasher()
+        async with (
+            segment_slots,
+            self.media_client.stream("GET", str(file.url), headers=headers) as resp,
+        ):
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                msg = f"Expected a partial response, got {resp.status_code}."
+                raise RangeNotSupportedError(msg)
+
+            f = await asyncio.to_thread(part_path.open, "r+b")
+            with f:
+                await asyncio.to_thread(f.seek, start)
+                async for chunk in resp.aiter_bytes(settings.DOWNLOAD_CHUNK_BYTES):
+                    await asyncio.to_thread(self._write_chunk, f, hasher, chunk)
+                if f.tell() != end + 1:
+                    msg = f"The segment {start}-{end} of {file.url} is incomplete."
+                    raise ValueError(msg)
+        return start, hasher.finish()
+
+    def _write_chunk(self, f: BinaryIO, hasher: BlockHasher, chunk: bytes) -> None:
+        f.write(chunk)
+        hasher.update(chunk)
+
+    async def _upload_worker(self) -> None:
+        while True:
+            batch = [await self.upload_queue.get()]
+            # Files that are already waiting go with the same `mega-put`
+            while (
+                len(batch) < settings.MEGA_UPLOAD_BATCH_FILES
+                and not self.upload_queue.empty()
+            ):
+                batch.append(self.upload_queue.get_nowait())
+
+            try:
+                await self._upload_batch(batch)
+            finally:
+                for _ in batch:
+                    self.upload_queue.task_done()
+
+    async def _upload_batch(self, batch: list[FileMetadata]) -> None:
+        if not settings.SAVE_TO_MEGA:  # already saved to LOCAL_UPLOAD_PATH
+            for file in batch:
+                await self._finish_file(file, is_uploaded=True)
+            return
+
+        batches_by_dir: dict[Path, list[FileMetadata]] = {}
+        for file in batch:
+            batches_by_dir.setdefault(file.mega_path.parent, []).append(file)
+
+        for mega_dir, dir_batch in batches_by_dir.items():
+            if len(dir_batch) == 1:
+                await self._upload_one(dir_batch[0])
+                continue
+
+            # A trailing slash makes the target a folder
+            is_uploaded = await self._put(dir_batch, f"{mega_dir}/")
+            if is_uploaded:
+                self.logger.info(f"Uploaded a batch of {len(dir_batch)} files.")
+                for file in dir_batch:
+                    await self._finish_file(file, is_uploaded=True)
+                continue
+
+            self.logger.warning(
+                f"Failed to upload a batch of {len(dir_batch)} files. "
+                "Checking them one by one..."
+            )
+            for file in dir_batch:
+                if await self._run_mega_command(
+                    "mega-ls", str(file.mega_path), stdout=subprocess.DEVNULL
+                ):
+                    await self._finish_file(file, is_uploaded=True)
+                else:
+                    await self._upload_one(file)
+
+    async def _upload_one(self, file: FileMetadata) -> None:
+        is_uploaded = await self._put([file], str(file.mega_path))
+        if not is_uploaded:
+            self.logger.error(f"Failed to upload {file.local_path}")
+        await self._finish_file(file, is_uploaded=is_uploaded)
+
+    async def _put(self, files: list[FileMetadata], target: str) -> bool:
+        started_at = time.monotonic()
+        is_uploaded = await self._run_mega_command(
+            "mega-put",
+            "-c",
+            "--ignore-quota-warn",
+            *(str(file.local_path) for file in files),
+            target,
+        )
+        metrics.observe(
+            "upload",
+            time.monotonic() - started_at,
+            sum(file.known_size for file in files) if is_uploaded else 0,
+            is_error=not is_uploaded,
+        )
+        return is_uploaded
+
+    async def _run_mega_command(
+        self, *command: str, stdout: int | None = None
+    ) -> bool:  # True if the command succeeded
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=subprocess.DEVNULL,  # prevent interactive prompts
+                stdout=stdout,
+            )
+        except OSError:
+            self.logger.exception(f"Failed to run {command[0]}")
+            return False
+        return await process.wait() == 0
+
+    async def _finish_file(self, file: FileMetadata, is_uploaded: bool) -> None:
+        try:
+            # The ledger may call `mega-du` and the dedup store writes to SQLite
+            await asyncio.to_thread(self.consumer.finish_file, file, is_uploaded)
+        except Exception:
+            self.logger.exception(f"Failed to finish {file.url}")
@@ -1,7 +1,17 @@
 from pathlib import Path
-from typing import Annotated
+from typing import Annotated, Literal, Self
 
-from pydantic import DirectoryPath, Field, computed_field, field_validator
+from pydantic import (
+    DirectoryPath,
+    Field,
+    NonNegativeFloat,
+    NonNegativeInt,
+    PositiveFloat,
+    PositiveInt,
+    computed_field,
+    field_validator,
+    model_validator,
+)
 from pydantic_settings import BaseSettings, NoDecode, SettingsConfigDict
 
 SixDigitCode = Annotated[str, Field(pattern=r"^\d{6}$")]
@@ -20,10 +30,29 @@ class Settings(BaseSettings):
     TUMBLR_COLLECT_VIDEOS: bool = Field(default=True)
     TUMBLR_BLOGS_TO_CRAWL: Annotated[set[str], NoDecode] = Field(default={"all"})
     TUMBLR_BLOGS_TO_IGNORE: Annotated[set[str], NoDecode] = Field(default=set())
+    TUMBLR_CRAWLER_WORKERS: PositiveInt = Field(default=1)
+    TUMBLR_USE_DASHBOARD: bool = Field(default=False)
+    TUMBLR_POST_FORMAT: Literal["legacy", "npf"] = Field(default="legacy")
+    TUMBLR_IMAGE_MAX_WIDTH: PositiveInt | None = Field(default=None)
+    TUMBLR_IMAGE_MAX_KB: PositiveInt | None = Field(default=None)
+    TUMBLR_API_URL: str = "https://api.tumblr.com/v2"
+    TUMBLR_API_CALLS_PER_HOUR: PositiveInt = Field(default=1000)
+    TUMBLR_API_CALLS_PER_DAY: PositiveInt = Field(default=5000)
+    TUMBLR_API_MAX_RETRIES: int = Field(default=5)
+    TUMBLR_API_MAX_BACKOFF_S: PositiveFloat = Field(default=300.0)
+    DEDUP_ACROSS_BLOGS: bool = Field(default=False)
 
     LOCAL_FILE_SIZE_LIMIT_MB: int = Field(default=10)
     LOCAL_UPLOAD_PATH: DirectoryPath | None = Field(default=None)
     LOCAL_TEMP_UPLOAD_DIR: Path = Path("temp")
+    SPOOL_DIR: Path | None = Field(default=None)  # e.g. /dev/shm/art_collector
+    SPOOL_MAX_MB: PositiveInt = Field(default=256)
+    SPOOL_FILE_MAX_MB: PositiveInt = Field(default=8)
+    FETCH_MODE: Literal["head", "get"] = Field(default="head")
+    DOWNLOAD_CHUNK_KB: PositiveInt = Field(default=256)
+    DOWNLOAD_SEGMENT_THRESHOLD_MB: PositiveInt = Field(default=16)
+    DOWNLOAD_SEGMENT_MB: PositiveInt = Field(default=4)
+    DOWNLOAD_SEGMENT_WORKERS: PositiveInt = Field(default=4)
 
     SAVE_TO_MEGA: bool = Field(default=True)
     MEGA_EMAIL: str | None = Field(default=None)
@@ -31,9 +60,43 @@ class Settings(BaseSettings):
     MEGA_AUTH_CODE: SixDigitCode | None = Field(default=None)
     MEGA_UPLOAD_PATH: Path = Field(default=Path("art_collector"))
     MEGA_FOLDER_SIZE_LIMIT_MB: int = Field(default=1000)
+    MEGA_LEDGER_RECONCILE_INTERVAL_S: PositiveInt = 300
+    MEGA_UPLOAD_BATCH_FILES: PositiveInt = Field(default=10)
+    MEGA_UPLOAD_BATCH_MB: PositiveInt = Field(default=50)
+    MEGA_UPLOAD_BATCH_TIMEOUT_S: PositiveFloat = Field(default=5.0)
 
     CONFIG_FILE: Path = Path(__file__).resolve().parent.parent / "config.json"
+    DEDUP_DB_FILE: Path = Path(__file__).resolve().parent.parent / "dedup.sqlite3"
+    WORK_PLAN_FILE: Path = Path(__file__).resolve().parent.parent / "work_plan.jsonl"
+    METRICS_REPORT_FILE: Path | None = (
+        Path(__file__).resolve().parent.parent / "logs" / "run_report.json"
+    )
+    METRICS_PROMETHEUS_FILE: Path | None = Field(default=None)
+    METRICS_SAMPLE_INTERVAL_S: PositiveFloat = Field(default=1.0)
+    PIPELINE_MODE: Literal["run", "plan", "execute"] = Field(default="run")
+    PIPELINE_ENGINE: Literal["threads", "asyncio"] = Field(default="threads")
+    WATCH_MODE: bool = Field(default=False)
+    WATCH_INTERVAL_MIN: PositiveFloat = Field(default=30)
+    WATCH_JITTER_MIN: NonNegativeFloat = Field(default=3)
+    WATCH_BLOGS_REFRESH_MIN: PositiveFloat = Field(default=360)
+    SHARD_COUNT: PositiveInt = Field(default=1)
+    SHARD_INDEX: NonNegativeInt | None = Field(default=None)  # None starts them all
+    SHARD_STATE_FILE: Path = (
+        Path(__file__).resolve().parent.parent / "shard_state.sqlite3"
+    )
+    SHARD_BLOGS_FILE: Path | None = Field(default=None)  # set by `run_shards`
+    MIN_WORKERS: PositiveInt | None = Field(default=None)  # None for MAX_WORKERS
     MAX_WORKERS: int = 8
+    CONSUMER_SCALE_INTERVAL_S: PositiveFloat = Field(default=5.0)
+    FILE_QUEUE_POLICY: Literal["fifo", "smallest_first", "round_robin", "packing"] = (
+        Field(default="fifo")
+    )
+    FILE_QUEUE_SIZE: PositiveInt = Field(default=64)
+    ASYNC_DOWNLOAD_CONCURRENCY: PositiveInt = Field(default=64)
+    ASYNC_UPLOAD_CONCURRENCY: PositiveInt = Field(default=4)
+    METADATA_RESOLVER_WORKERS: PositiveInt = 8
+    METADATA_QUEUE_SIZE: PositiveInt = 64
+    HTTP_POOL_HOSTS: PositiveInt = 16
 
     @field_validator("TUMBLR_BLOGS_TO_CRAWL", "TUMBLR_BLOGS_TO_IGNORE", mode="before")
     @classmethod
@@ -42,13 +105,70 @@ class Settings(BaseSettings):
             return v
         return {blog.strip() for blog in v.split(",")}
 
+    @field_validator(
+        "SPOOL_DIR",
+        "METRICS_REPORT_FILE",
+        "METRICS_PROMETHEUS_FILE",
+        "SHARD_INDEX",
+        "SHARD_BLOGS_FILE",
+        "MIN_WORKERS",
+        "TUMBLR_IMAGE_MAX_WIDTH",
+        "TUMBLR_IMAGE_MAX_KB",
+        mode="before",
+    )
+    @classmethod
+    def decode_optional(cls, v: str | Path | int | None) -> str | Path | int | None:
+        return v or None  # an empty value turns the option off
+
+    @model_validator(mode="after")
+    def check_shards(self) -> Self:
+        if self.SHARD_INDEX is not None and self.SHARD_INDEX >= self.SHARD_COUNT:
+            msg = f"SHARD_INDEX must be lower than SHARD_COUNT ({self.SHARD_COUNT})."
+            raise ValueError(msg)
+        if (
+            self.SHARD_COUNT > 1 or self.SHARD_INDEX is not None
+        ) and self.PIPELINE_MODE != "run":
+            msg = "Sharding is only supported with PIPELINE_MODE=run."
+            raise ValueError(msg)
+        return self
+
     @computed_field
     def LOCAL_FILE_SIZE_LIMIT_BYTES(self) -> int:  # noqa: N802
         return self.LOCAL_FILE_SIZE_LIMIT_MB * 1024 * 1024
 
+    @computed_field
+    def TUMBLR_IMAGE_MAX_BYTES(self) -> int | None:  # noqa: N802
+        if self.TUMBLR_IMAGE_MAX_KB is None:
+            return None
+        return self.TUMBLR_IMAGE_MAX_KB * 1024
+
+    @computed_field
+    def DOWNLOAD_CHUNK_BYTES(self) -> int:  # noqa: N802
+        return self.DOWNLOAD_CHUNK_KB * 1024
+
+    @computed_field
+    def DOWNLOAD_SEGMENT_THRESHOLD_BYTES(self) -> int:  # noqa: N802
+        return self.DOWNLOAD_SEGMENT_THRESHOLD_MB * 1024 * 1024
+
+    @computed_field
+    def DOWNLOAD_SEGMENT_BYTES(self) -> int:  # noqa: N802
+        return self.DOWNLOAD_SEGMENT_MB * 1024 * 1024
+
+    @computed_field
+    def SPOOL_MAX_BYTES(self) -> int:  # noqa: N802
+        return self.SPOOL_MAX_MB * 1024 * 1024
+
+    @computed_field
+    def SPOOL_FILE_MAX_BYTES(self) -> int:  # noqa: N802
+        return self.SPOOL_FILE_MAX_MB * 1024 * 1024
+
     @computed_field
     def MEGA_FOLDER_SIZE_LIMIT_BYTES(self) -> int:  # noqa: N802
         return self.MEGA_FOLDER_SIZE_LIMIT_MB * 1024 * 1024
 
+    @computed_field
+    def MEGA_UPLOAD_BATCH_BYTES(self) -> int:  # noqa: N802
+        return self.MEGA_UPLOAD_BATCH_MB * 1024 * 1024
+
 
 settings = Settings()
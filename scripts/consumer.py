@@ -1,16 +1,35 @@
 import logging
 import queue
+import time
+from collections.abc import Mapping
 
 from config import settings
-from file_metadata import FileMetadata
-from helper import Helper
-from mega import MegaSaver
+from consumer_scaler import ConsumerScaler
+from dedup_store import DedupStore
+from file_metadata import FileMetadata, FileMetadataHelper
+from helper import Helper, RuntimeConfig
+from mega import MegaFolderLedger, MegaRemoteManifest, MegaUploader
+from metrics import metrics
+from spool import MemorySpool
 
 
 class Consumer:
-    def __init__(self) -> None:
-        self.mega = MegaSaver()
+    def __init__(
+        self,
+        ledger: MegaFolderLedger,
+        dedup_store: DedupStore,
+        uploader: MegaUploader,
+        remote_manifest: MegaRemoteManifest,
+        runtime_config: RuntimeConfig,
+    ) -> None:
+        self.ledger = ledger
+        self.dedup_store = dedup_store
+        self.uploader = uploader
+        self.remote_manifest = remote_manifest
+        self.runtime_config = runtime_config
         self.helper = Helper()
+        self.file_meta = FileMetadataHelper()
+        self.spool = MemorySpool()
         logging.basicConfig(
             level=logging.INFO,
             format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
@@ -18,43 +37,157 @@ class Consumer:
         )
         self.logger = logging.getLogger(__name__)
 
-    def consumer_worker(self, file_queue: queue.Queue[FileMetadata | None]) -> None:
+    def consumer_worker(
+        self, file_queue: queue.Queue[FileMetadata | None], scaler: ConsumerScaler
+    ) -> None:
         while True:
+            scaler.acquire()  # waits while the pool is scaled down
+            waited_at = time.monotonic()
             file: FileMetadata | None = file_queue.get()
+            waited_s = time.monotonic() - waited_at
+            scaler.record_idle(waited_s)
+            metrics.observe("queue_wait", waited_s)
+            metrics.sample_queue_depth(file_queue.qsize())
             if file is None:
+                scaler.release()
+                file_queue.task_done()  # the queue is joined again by the next run
                 break
 
+            is_handed_to_uploader = False
+            resp = None
             try:
-                if file.size > settings.LOCAL_FILE_SIZE_LIMIT_BYTES:
-                    size_in_mb = self.helper.convert_bytes_to_mb(file.size)
-                    self.logger.warning(
-                        f"The file {file.url} exceeded the "
-                        f"{settings.LOCAL_FILE_SIZE_LIMIT_MB} MB limit. "
-                        f"The file size is {size_in_mb} MB. Skipping..."
-                    )
-                    continue
-
-                if file.local_path.exists():
-                    self.logger.info(f"{file.local_path} already exists. Skipping...")
+                if settings.FETCH_MODE == "get":
+                    # The download starts before the checks to get the size and ETag.
+                    # A rejected body is dropped without being read.
+                    resp = self.helper.open_download(file)
+                    if not self.accept_headers(file, resp.headers):
+                        continue
+                elif not self.accept_file(file):
                     continue
 
-                mega_folder_size = self.mega.get_mega_folder_size()
-                if mega_folder_size + file.size > settings.MEGA_FOLDER_SIZE_LIMIT_BYTES:
-                    size_in_mb = self.helper.convert_bytes_to_mb(file.size)
-                    self.logger.warning(
-                        f"Adding file {file.url} ({size_in_mb} MB) would "
-                        "exceed folder size limit of "
-                        f"{settings.MEGA_FOLDER_SIZE_LIMIT_MB} MB."
+                try:
+                    self.logger.info(f"Processing {file.url}...")
+                    started_at = time.monotonic()
+                    stall_s = self.helper.download_file(file, resp)
+                    scaler.record_download(
+                        file.known_size, time.monotonic() - started_at, stall_s
                     )
+                except Exception:
+                    self.abandon_file(file)
+                    raise
+                if self.skip_duplicate_content(file):
                     continue
-
-                self.logger.info(f"Processing {file.url}...")
-                self.helper.download_file(file)
-                self.mega.upload_local_file(file)
-                self.helper.delete_local_file(file)
+                # The upload may finish later on the uploader thread
+                self.uploader.submit(file, self.finish_file)
+                is_handed_to_uploader = True
 
             except Exception:
                 self.logger.exception(f"Failed to process {file.url}")
 
             finally:
+                if resp is not None:  # also when a check or the download raised
+                    resp.close()
+                if not is_handed_to_uploader:
+                    self.runtime_config.finish_pending_file(file.blog_name)
+                scaler.release()
                 file_queue.task_done()
+
+    def accept_headers(self, file: FileMetadata, headers: Mapping[str, str]) -> bool:
+        if not self.file_meta.apply_headers(file, headers):
+            return False
+
+        # Reposts under another URL are only found by their ETag
+        if file.etag and self.dedup_store.is_collected(file.blog_name, etag=file.etag):
+            self.logger.info(f"{file.url} has already been collected. Skipping...")
+            metrics.count_skip("collected", file.blog_name)
+            return False
+
+        return self.accept_file(file)
+
+    def accept_file(self, file: FileMetadata) -> bool:  # True if it should be saved
+        if not self.check_file(file):
+            return False
+
+        self.spool.assign(file)
+        return True
+
+    def check_file(self, file: FileMetadata) -> bool:  # the planner checks files too
+        if file.size is None:
+            self.logger.warning(f"The size of {file.url} is unknown. Skipping...")
+            metrics.count_skip("unknown_size", file.blog_name)
+            return False
+
+        if file.size > settings.LOCAL_FILE_SIZE_LIMIT_BYTES:
+            size_in_mb = self.helper.convert_bytes_to_mb(file.size)
+            self.logger.warning(
+                f"The file {file.url} exceeded the "
+                f"{settings.LOCAL_FILE_SIZE_LIMIT_MB} MB limit. "
+                f"The file size is {size_in_mb} MB. Skipping..."
+            )
+            metrics.count_skip("size_limit", file.blog_name)
+            return False
+
+        if file.local_path.exists():
+            self.logger.info(f"{file.local_path} already exists. Skipping...")
+            metrics.count_skip("local_exists", file.blog_name)
+            return False
+
+        if self.remote_manifest.contains(file.mega_path.name):
+            self.logger.info(f"{file.mega_path} already exists. Skipping...")
+            metrics.count_skip("remote_exists", file.blog_name)
+            return False
+
+        # Reserving is atomic, so workers can't overshoot the limit together
+        if not self.ledger.reserve(file.size):
+            size_in_mb = self.helper.convert_bytes_to_mb(file.size)
+            self.logger.warning(
+                f"Adding file {file.url} ({size_in_mb} MB) would "
+                "exceed folder size limit of "
+                f"{settings.MEGA_FOLDER_SIZE_LIMIT_MB} MB."
+            )
+            metrics.count_skip("folder_full", file.blog_name)
+            return False
+
+        return True
+
+    def skip_duplicate_content(self, file: FileMetadata) -> bool:
+        # Checked after the download, the hash is computed while the file is written
+        if file.content_hash is None:
+            return False
+
+        content_key = (
+            f"content:{file.content_hash}"
+            if settings.DEDUP_ACROSS_BLOGS
+            else f"content:{file.blog_name}:{file.content_hash}"
+        )
+        if not self.dedup_store.is_content_collected(
+            file.blog_name, file.content_hash
+        ) and self.dedup_store.claim(content_key):
+            return False
+
+        self.logger.info(
+            f"The content of {file.url} has already been collected. Skipping..."
+        )
+        metrics.count_skip("duplicate_content", file.blog_name)
+        file.local_path.unlink(missing_ok=True)
+        self.abandon_file(file)
+        # The URL is recorded too, so the next run skips it without a download
+        self.dedup_store.add(file)
+        return True
+
+    def abandon_file(self, file: FileMetadata) -> None:  # gives back what it held
+        self.ledger.release(file.known_size)
+        self.spool.release(file)
+
+    def finish_file(self, file: FileMetadata, is_uploaded: bool) -> None:
+        self.helper.delete_local_file(file)
+        self.spool.release(file)
+        if is_uploaded:
+            self.ledger.commit(file.known_size)
+            self.dedup_store.add(file)
+            metrics.count_collected(file.blog_name, file.known_size)
+            if settings.SAVE_TO_MEGA:
+                self.remote_manifest.add(file.mega_path.name)
+        else:
+            self.ledger.release(file.known_size)
+        self.runtime_config.finish_pending_file(file.blog_name)
@@ -0,0 +1,141 @@
+import logging
+import queue
+import threading
+import time
+
+from config import settings
+from file_metadata import FileMetadata
+
+
+class ConsumerScaler:
+    # Decides how many consumers take files from the queue at the same time.
+    # MAX_WORKERS consumer threads are started, the ones above the active count
+    # wait for a slot, so scaling never starts or stops threads.
+    def __init__(self, file_queue: queue.Queue[FileMetadata | None]) -> None:
+        self.file_queue = file_queue
+        self.condition = threading.Condition()
+        # Without MIN_WORKERS the count is fixed at MAX_WORKERS
+        self.min_cnt = min(
+            settings.MIN_WORKERS or settings.MAX_WORKERS, settings.MAX_WORKERS
+        )
+        self.active_cnt = self.min_cnt
+        self.running_cnt = 0  # consumers holding a slot
+        self.is_slow_start = True  # doubles the count until it stops paying off
+        self.stall_ratio_limit = 0.5  # of the download time, the link is saturated
+        self.idle_ratio_limit = 0.5  # of the consumer time, the producer is too slow
+        self.min_gain_ratio = 1.05  # a new consumer must add 5% to the throughput
+        # Collected since the last rescale
+        self.downloaded_bytes = 0
+        self.busy_s = 0.0
+        self.stall_s = 0.0
+        self.idle_s = 0.0
+        self.sampled_at = time.monotonic()
+        self.previous_cnt: int | None = None  # set if the last rescale grew the pool
+        self.previous_bps = 0.0
+        self.stop_event = threading.Event()
+        self.thread: threading.Thread | None = None
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def start(self) -> None:
+        self.logger.info(f"Starting with {self.active_cnt} consumers.")
+        if self.min_cnt >= settings.MAX_WORKERS:
+            return  # nothing to scale
+
+        self.stop_event.clear()
+        self.sampled_at = time.monotonic()
+        self.thread = threading.Thread(target=self._scaler_worker, daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def acquire(self) -> None:  # blocks while the pool is scaled down
+        with self.condition:
+            while self.running_cnt >= self.active_cnt:
+                self.condition.wait()
+            self.running_cnt += 1
+
+    def release(self) -> None:
+        with self.condition:
+            self.running_cnt -= 1
+            self.condition.notify()
+
+    def record_idle(self, idle_s: float) -> None:  # waited for a file
+        with self.condition:
+            self.idle_s += idle_s
+
+    def record_download(self, size: int, busy_s: float, stall_s: float) -> None:
+        with self.condition:
+            self.downloaded_bytes += size
+            self.busy_s += busy_s
+            self.stall_s += stall_s
+
+    def _scaler_worker(self) -> None:
+        # Slow start probes faster, a short run would end before it got going
+        while not self.stop_event.wait(
+            settings.CONSUMER_SCALE_INTERVAL_S / (4 if self.is_slow_start else 1)
+        ):
+            self._rescale()
+
+    def _rescale(self) -> None:
+        with self.condition:
+            now = time.monotonic()
+            interval_s = now - self.sampled_at
+            downloaded_bytes, busy_s, stall_s, idle_s = (
+                self.downloaded_bytes,
+                self.busy_s,
+                self.stall_s,
+                self.idle_s,
+            )
+            self.downloaded_bytes, self.busy_s, self.stall_s, self.idle_s = 0, 0, 0, 0
+            self.sampled_at = now
+            active_cnt = self.active_cnt
+
+        queue_depth = self.file_queue.qsize()
+        total_bps = downloaded_bytes / interval_s
+        worker_bps = downloaded_bytes / busy_s if busy_s else 0.0
+        stall_ratio = stall_s / busy_s if busy_s else 0.0
+        idle_ratio = idle_s / (active_cnt * interval_s)
+
+        # Stalls alone don't shrink the pool: a host that throttles each
+        # connection stalls every download, and more consumers still add up.
+        # Files waiting in the queue are never left to fewer consumers.
+        is_backlogged = queue_depth >= active_cnt
+        new_cnt = active_cnt
+        if (
+            self.previous_cnt is not None
+            and total_bps < self.previous_bps * self.min_gain_ratio
+        ):
+            # The last increase didn't pay off, go back to the previous count
+            self.is_slow_start = False
+            if not is_backlogged:
+                new_cnt = self.previous_cnt
+        elif stall_ratio > self.stall_ratio_limit and not self.is_slow_start:
+            pass  # the link may be saturated, more consumers would only split it
+        elif is_backlogged and idle_ratio < self.idle_ratio_limit:
+            new_cnt = active_cnt * 2 if self.is_slow_start else active_cnt + 1
+        elif idle_ratio > self.idle_ratio_limit and not is_backlogged:
+            new_cnt = active_cnt - 1  # consumers wait for the producer anyway
+
+        new_cnt = max(self.min_cnt, min(settings.MAX_WORKERS, new_cnt))
+        self.previous_cnt = active_cnt if new_cnt > active_cnt else None
+        self.previous_bps = total_bps
+
+        with self.condition:
+            self.active_cnt = new_cnt
+            self.condition.notify_all()
+
+        self.logger.info(
+            f"Consumers: {active_cnt} -> {new_cnt}, queue depth {queue_depth}, "
+            f"{total_bps / (1024 * 1024):.2f} MB/s in total, "
+            f"{worker_bps / (1024 * 1024):.2f} MB/s per consumer, "
+            f"{stall_ratio:.0%} stalled, {idle_ratio:.0%} idle."
+        )
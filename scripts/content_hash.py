@@ -0,0 +1,39 @@
+import hashlib
+
+# https://www.dropbox.com/developers/reference/content-hash
+# Every block is hashed on its own and the file hash is the hash of the block
+# hashes, so segments downloaded out of order hash the same as a single stream.
+# Segments are whole megabytes, so they always start at a block boundary.
+BLOCK_SIZE = 1024 * 1024
+DIGEST_SIZE = 32
+
+
+class BlockHasher:
+    def __init__(self) -> None:
+        self.block_hashes: list[bytes] = []
+        self.block = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        self.block_len = 0
+
+    def update(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            taken = view[: BLOCK_SIZE - self.block_len]
+            self.block.update(taken)
+            self.block_len += len(taken)
+            view = view[len(taken) :]
+            if self.block_len == BLOCK_SIZE:
+                self._finish_block()
+
+    def finish(self) -> list[bytes]:  # the hashes of all blocks, in order
+        if self.block_len:
+            self._finish_block()
+        return self.block_hashes
+
+    def _finish_block(self) -> None:
+        self.block_hashes.append(self.block.digest())
+        self.block = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        self.block_len = 0
+
+
+def combine_block_hashes(block_hashes: list[bytes]) -> str:
+    return hashlib.blake2b(b"".join(block_hashes), digest_size=DIGEST_SIZE).hexdigest()
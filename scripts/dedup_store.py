@@ -0,0 +1,143 @@
+import datetime
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+from config import settings
+from file_metadata import FileMetadata
+from shard_state import ShardState
+
+
+class DedupStore:
+    # Files collected by all runs, checked before any HEAD request or download
+    def __init__(
+        self, db_file: Path | None = None, shard_state: ShardState | None = None
+    ) -> None:
+        self.lock = threading.Lock()
+        self.run_keys: set[str] = set()  # claimed by this run, across all blogs
+        self.shard_state = shard_state  # shards claim keys for the whole run
+        self.connection = sqlite3.connect(
+            db_file or settings.DEDUP_DB_FILE, timeout=60, check_same_thread=False
+        )
+        with self.lock, self.connection:
+            # WAL needs shared memory, shards on other hosts only share the file
+            journal_mode = "WAL" if shard_state is None else "DELETE"
+            self.connection.execute(f"PRAGMA journal_mode={journal_mode}")
+            self.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS collected_files (
+                    id INTEGER PRIMARY KEY,
+                    blog_name TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    etag TEXT,
+                    filename TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    collected_at TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_collected_files_url
+                    ON collected_files (url);
+                CREATE INDEX IF NOT EXISTS idx_collected_files_etag
+                    ON collected_files (etag);
+                CREATE INDEX IF NOT EXISTS idx_collected_files_filename
+                    ON collected_files (filename);
+                """
+            )
+            columns = {
+                row[1]
+                for row in self.connection.execute("PRAGMA table_info(collected_files)")
+            }
+            if "content_hash" not in columns:  # databases from before content hashing
+                self.connection.execute(
+                    "ALTER TABLE collected_files ADD COLUMN content_hash TEXT"
+                )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_collected_files_content_hash "
+                "ON collected_files (content_hash)"
+            )
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def is_collected(
+        self,
+        blog_name: str,
+        url: str | None = None,
+        etag: str | None = None,
+        filename: str | None = None,
+    ) -> bool:
+        conditions: list[str] = []
+        params: list[str] = []
+        for column, value in (("url", url), ("etag", etag), ("filename", filename)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+
+        if not conditions:
+            return False
+
+        query = f"SELECT 1 FROM collected_files WHERE ({' OR '.join(conditions)})"  # noqa: S608
+        if not settings.DEDUP_ACROSS_BLOGS:
+            query += " AND blog_name = ?"
+            params.append(blog_name)
+
+        with self.lock:
+            row = self.connection.execute(f"{query} LIMIT 1", params).fetchone()
+        return row is not None
+
+    def is_content_collected(self, blog_name: str, content_hash: str) -> bool:
+        # The same bytes under another URL or without a stable ETag
+        query = "SELECT 1 FROM collected_files WHERE content_hash = ?"
+        params = [content_hash]
+        if not settings.DEDUP_ACROSS_BLOGS:
+            query += " AND blog_name = ?"
+            params.append(blog_name)
+
+        with self.lock:
+            row = self.connection.execute(f"{query} LIMIT 1", params).fetchone()
+        return row is not None
+
+    def claim(self, *keys: str) -> bool:  # False if any key is taken by this run
+        if self.shard_state is not None:
+            return bool(self.shard_state.claim(*keys))
+
+        with self.lock:
+            if self.run_keys.intersection(keys):
+                return False
+            self.run_keys.update(keys)
+            return True
+
+    def clear_claims(self) -> None:  # a new run in watch mode
+        with self.lock:
+            self.run_keys.clear()
+
+    def is_claimed(self, key: str) -> bool:
+        if self.shard_state is not None:
+            return bool(self.shard_state.is_claimed(key))
+
+        with self.lock:
+            return key in self.run_keys
+
+    def add(self, file: FileMetadata) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO collected_files "
+                "(blog_name, url, etag, filename, size, content_hash, collected_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    file.blog_name,
+                    str(file.url),
+                    file.etag,
+                    file.mega_path.name,
+                    file.size,
+                    file.content_hash,
+                    datetime.datetime.now(datetime.UTC).isoformat(),
+                ),
+            )
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -1,17 +1,63 @@
+import concurrent.futures
 import logging
+import threading
+from collections.abc import Mapping
 from pathlib import Path
 
 import requests
 from config import settings
+from metrics import metrics
 from pydantic import BaseModel, HttpUrl, PositiveInt
+from sessions import session_pool
 
 
 class FileMetadata(BaseModel):
     url: HttpUrl
+    blog_name: str
     etag: str | None
     local_path: Path
     mega_path: Path
-    size: PositiveInt  # in bytes
+    size: PositiveInt | None  # in bytes, None until the download starts in get mode
+    content_hash: str | None = None  # set by the download
+    variant_width: int | None = None  # a smaller size than the original was chosen
+
+    @property
+    def known_size(self) -> int:  # for files that passed the consumer checks
+        if self.size is None:
+            msg = f"The size of {self.url} is not known yet."
+            raise ValueError(msg)
+        return self.size
+
+
+class MediaVariant(BaseModel):  # one size of an image
+    url: HttpUrl
+    width: int
+
+
+class FileCandidate(BaseModel):  # a file found in a post, before the HEAD request
+    url: HttpUrl
+    blog_name: str
+    post_slug: str | None
+    numeric_suffix: int | None
+    variant_width: int | None = None  # a smaller size than the original was chosen
+    # Tried in turn, the widest first, while the file is over TUMBLR_IMAGE_MAX_KB
+    smaller_variants: list[MediaVariant] = []
+
+    def get_smaller_variant(self) -> "FileCandidate":
+        variant, *smaller_variants = self.smaller_variants
+        return self.model_copy(
+            update={
+                "url": variant.url,
+                "variant_width": variant.width,
+                "smaller_variants": smaller_variants,
+            }
+        )
+
+    def get_variants(self) -> list["FileCandidate"]:  # this size and the smaller ones
+        variants = [self]
+        while variants[-1].smaller_variants:
+            variants.append(variants[-1].get_smaller_variant())
+        return variants
 
 
 class FileMetadataHelper:
@@ -23,18 +69,39 @@ class FileMetadataHelper:
         )
         self.logger = logging.getLogger(__name__)
 
-    def _create_filename(
+    def _create_filename(  # noqa: PLR0913
         self,
         author: str,
         post_slug: str | None,
         stem: str,
         numeric_suffix: int | None,
         file_format: str,
+        variant_width: int | None = None,
     ) -> str:
         # 2 posts may have the same stem leading to false positive duplicates
         file_stem = f"{post_slug}_{stem}" if post_slug else stem
         suffix = f"_{numeric_suffix}" if numeric_suffix else ""
-        return f"{author}_{file_stem}{suffix}{file_format}"
+        # A smaller size is never mistaken for the original
+        width = f"_{variant_width}w" if variant_width else ""
+        return f"{author}_{file_stem}{suffix}{width}{file_format}"
+
+    def get_filename(
+        self,
+        url: HttpUrl,
+        author: str,
+        post_slug: str | None,
+        numeric_suffix: int | None,
+        variant_width: int | None = None,
+    ) -> str:
+        url_path = Path(url.path or "")  # a query is not part of the name
+        return self._create_filename(
+            author=author,
+            post_slug=post_slug,
+            stem=url_path.stem,
+            numeric_suffix=numeric_suffix,
+            file_format=url_path.suffix,  # includes a dot
+            variant_width=variant_width,
+        )
 
     def create_file_metadata(
         self,
@@ -42,14 +109,35 @@ class FileMetadataHelper:
         author: str,
         post_slug: str | None,
         numeric_suffix: int | None,
+        variant_width: int | None = None,
     ) -> FileMetadata | None:
-        stem = Path(str(url)).stem
-        filename = self._create_filename(
+        with metrics.measure("head"):
+            resp = session_pool.media.head(str(url), timeout=10)
+            resp.raise_for_status()
+        return self.build_file_metadata(
+            url=url,
+            author=author,
+            post_slug=post_slug,
+            numeric_suffix=numeric_suffix,
+            headers=resp.headers,
+            variant_width=variant_width,
+        )
+
+    def build_file_metadata(  # noqa: PLR0913
+        self,
+        url: HttpUrl,
+        author: str,
+        post_slug: str | None,
+        numeric_suffix: int | None,
+        headers: Mapping[str, str] | None,  # None leaves them to the download
+        variant_width: int | None = None,
+    ) -> FileMetadata | None:
+        filename = self.get_filename(
+            url=url,
             author=author,
             post_slug=post_slug,
-            stem=stem,
             numeric_suffix=numeric_suffix,
-            file_format=Path(str(url)).suffix,  # includes a dot
+            variant_width=variant_width,
         )
         if settings.SAVE_TO_MEGA:
             local_path = settings.LOCAL_TEMP_UPLOAD_DIR / filename
@@ -57,33 +145,132 @@ class FileMetadataHelper:
             local_path = settings.LOCAL_UPLOAD_PATH / filename
         mega_path = settings.MEGA_UPLOAD_PATH / filename
 
-        resp = requests.head(str(url), timeout=10)
-        resp.raise_for_status()
+        file = FileMetadata(
+            url=url,
+            blog_name=author,
+            etag=None,
+            local_path=local_path,
+            mega_path=mega_path,
+            size=None,
+            variant_width=variant_width,
+        )
+        if headers is not None and not self.apply_headers(file, headers):
+            return None
+        return file
 
+    def apply_headers(self, file: FileMetadata, headers: Mapping[str, str]) -> bool:
+        # Fills in the ETag and size, False if the size is unknown
         etag: str | None = (
-            resp.headers["ETag"].strip('"') if resp.headers.get("ETag", None) else None
+            headers["ETag"].strip('"') if headers.get("ETag", None) else None
         )
 
         if etag is None:
-            self.logger.info(f"ETag is missing for {url}")
+            self.logger.info(f"ETag is missing for {file.url}")
 
         file_size: int | None = (
-            int(resp.headers["content-length"])
-            if resp.headers.get("content-length", None)
+            int(headers["content-length"])
+            if headers.get("content-length", None)
             else None
         )
 
         if file_size is None:
             self.logger.warning(
-                f"Could not determine file size for {url}. "
+                f"Could not determine file size for {file.url}. "
                 f"Content-Length header is missing. Skipping..."
             )
-            return None
+            metrics.count_skip("unknown_size", file.blog_name)
+            return False
 
-        return FileMetadata(
-            url=url,
-            etag=etag,
-            local_path=local_path,
-            mega_path=mega_path,
-            size=file_size,
+        file.etag = etag
+        file.size = file_size
+        return True
+
+    def is_over_byte_budget(
+        self, file: FileMetadata | None, candidate: FileCandidate
+    ) -> bool:  # True if a smaller size of the image should be tried instead
+        if (
+            file is None
+            or file.size is None
+            or settings.TUMBLR_IMAGE_MAX_BYTES is None
+            or file.size <= settings.TUMBLR_IMAGE_MAX_BYTES
+            or not candidate.smaller_variants
+        ):
+            return False
+
+        self.logger.info(
+            f"{file.url} is over the {settings.TUMBLR_IMAGE_MAX_KB} KB budget. "
+            "Trying a smaller size..."
+        )
+        return True
+
+
+class MetadataResolver:
+    def __init__(self) -> None:
+        self.file_meta = FileMetadataHelper()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings.METADATA_RESOLVER_WORKERS
+        )
+        # Caps the number of candidates waiting for their HEAD request,
+        # `submit` blocks when resolvers fall behind the crawlers
+        self.pending_slots = threading.BoundedSemaphore(settings.METADATA_QUEUE_SIZE)
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def submit(
+        self, candidate: FileCandidate
+    ) -> concurrent.futures.Future[FileMetadata | None]:
+        if settings.FETCH_MODE == "get":
+            # No HEAD request, the consumer takes the size from the download itself
+            future: concurrent.futures.Future[FileMetadata | None] = (
+                concurrent.futures.Future()
+            )
+            future.set_result(self._build_unresolved(candidate))
+            return future
+
+        self.pending_slots.acquire()
+        future = self.executor.submit(self._resolve, candidate)
+        future.add_done_callback(lambda _: self.pending_slots.release())
+        return future
+
+    def get_filename(self, candidate: FileCandidate) -> str:
+        return self.file_meta.get_filename(
+            url=candidate.url,
+            author=candidate.blog_name,
+            post_slug=candidate.post_slug,
+            numeric_suffix=candidate.numeric_suffix,
+            variant_width=candidate.variant_width,
         )
+
+    def _build_unresolved(self, candidate: FileCandidate) -> FileMetadata | None:
+        return self.file_meta.build_file_metadata(
+            url=candidate.url,
+            author=candidate.blog_name,
+            post_slug=candidate.post_slug,
+            numeric_suffix=candidate.numeric_suffix,
+            headers=None,
+            variant_width=candidate.variant_width,
+        )
+
+    def _resolve(self, candidate: FileCandidate) -> FileMetadata | None:
+        try:
+            file = self.file_meta.create_file_metadata(
+                url=candidate.url,
+                author=candidate.blog_name,
+                post_slug=candidate.post_slug,
+                numeric_suffix=candidate.numeric_suffix,
+                variant_width=candidate.variant_width,
+            )
+        except requests.exceptions.RequestException as e:
+            self.logger.warning(
+                f"Failed to get metadata for {candidate.url}. Error: {e}. Skipping..."
+            )
+            metrics.count_skip("metadata_failed", candidate.blog_name)
+            return None
+
+        if self.file_meta.is_over_byte_budget(file, candidate):
+            return self._resolve(candidate.get_smaller_variant())
+        return file
@@ -0,0 +1,157 @@
+import asyncio
+import heapq
+import itertools
+import queue
+from collections import deque
+
+from config import settings
+from file_metadata import FileMetadata
+from mega import MegaFolderLedger
+
+
+def get_size(file: FileMetadata) -> int:
+    # Files without a HEAD request are assumed small, most of them are images
+    return file.size or 0
+
+
+class QueuePolicy:  # the crawl order
+    def __init__(self) -> None:
+        self.files: deque[FileMetadata] = deque()
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def put(self, file: FileMetadata) -> None:
+        self.files.append(file)
+
+    def get(self) -> FileMetadata:
+        return self.files.popleft()
+
+
+class SmallestFirstPolicy(QueuePolicy):
+    def __init__(self) -> None:
+        super().__init__()
+        self.heap: list[tuple[int, int, FileMetadata]] = []
+        self.counter = itertools.count()  # keeps the crawl order for equal sizes
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def put(self, file: FileMetadata) -> None:
+        heapq.heappush(self.heap, (get_size(file), next(self.counter), file))
+
+    def get(self) -> FileMetadata:
+        return heapq.heappop(self.heap)[2]
+
+
+class RoundRobinPolicy(QueuePolicy):  # one file per blog in turn
+    def __init__(self) -> None:
+        super().__init__()
+        self.files_by_blog: dict[str, deque[FileMetadata]] = {}
+        self.blog_names: deque[str] = deque()
+        self.file_cnt = 0
+
+    def __len__(self) -> int:
+        return self.file_cnt
+
+    def put(self, file: FileMetadata) -> None:
+        if file.blog_name not in self.files_by_blog:
+            self.files_by_blog[file.blog_name] = deque()
+            self.blog_names.append(file.blog_name)
+        self.files_by_blog[file.blog_name].append(file)
+        self.file_cnt += 1
+
+    def get(self) -> FileMetadata:
+        blog_name = self.blog_names.popleft()
+        blog_files = self.files_by_blog[blog_name]
+        file = blog_files.popleft()
+        if blog_files:
+            self.blog_names.append(blog_name)
+        else:
+            del self.files_by_blog[blog_name]
+        self.file_cnt -= 1
+        return file
+
+
+class PackingPolicy(QueuePolicy):
+    # The crawl order while every queued file fits in the remaining MEGA quota,
+    # the smallest file first once they don't, so the most files fit in what is left
+    def __init__(self, ledger: MegaFolderLedger) -> None:
+        super().__init__()
+        self.ledger = ledger
+        self.queued_bytes = 0
+
+    def put(self, file: FileMetadata) -> None:
+        super().put(file)
+        self.queued_bytes += get_size(file)
+
+    def get(self) -> FileMetadata:
+        if self.queued_bytes <= self.ledger.get_remaining_bytes():
+            file = self.files.popleft()
+        else:
+            file = min(self.files, key=get_size)
+            self.files.remove(file)
+        self.queued_bytes -= get_size(file)
+        return file
+
+
+def create_queue_policy(ledger: MegaFolderLedger) -> QueuePolicy:
+    match settings.FILE_QUEUE_POLICY:
+        case "smallest_first":
+            return SmallestFirstPolicy()
+        case "round_robin":
+            return RoundRobinPolicy()
+        case "packing":
+            return PackingPolicy(ledger)
+        case _:
+            return QueuePolicy()
+
+
+class FileQueue(queue.Queue[FileMetadata | None]):
+    # `queue.Queue` handles blocking and `task_done`, the policy picks the next file.
+    # The `None` sentinels stopping the consumers are returned after every file.
+    def __init__(self, policy: QueuePolicy, maxsize: int = 0) -> None:
+        self.policy = policy
+        self.sentinel_cnt = 0
+        super().__init__(maxsize)
+
+    def _init(self, maxsize: int) -> None:
+        pass  # the files are kept by the policy
+
+    def _qsize(self) -> int:
+        return len(self.policy) + self.sentinel_cnt
+
+    def _put(self, item: FileMetadata | None) -> None:
+        if item is None:
+            self.sentinel_cnt += 1
+        else:
+            self.policy.put(item)
+
+    def _get(self) -> FileMetadata | None:
+        if len(self.policy):
+            return self.policy.get()
+        self.sentinel_cnt -= 1
+        return None
+
+
+class AsyncFileQueue(asyncio.Queue[FileMetadata]):
+    # The files are kept by the policy, `_queue` stays an empty deque.
+    # Everything `asyncio.Queue` reads from `_queue` is overridden.
+    def __init__(self, policy: QueuePolicy, maxsize: int = 0) -> None:
+        self.policy = policy
+        super().__init__(maxsize)
+
+    def qsize(self) -> int:
+        return len(self.policy)
+
+    def empty(self) -> bool:
+        return not len(self.policy)
+
+    def _put(self, item: FileMetadata) -> None:
+        self.policy.put(item)
+
+    def _get(self) -> FileMetadata:
+        return self.policy.get()
+
+    def _format(self) -> str:
+        return f"{super()._format()} files={len(self.policy)}"
@@ -1,20 +1,48 @@
+import concurrent.futures
+import contextlib
 import datetime
 import json
 import logging
-from typing import TypedDict
+import threading
+import time
+from collections.abc import Generator, Iterable
+from pathlib import Path
+from typing import BinaryIO, NotRequired, TypedDict
 
 import requests
 from config import settings
+from content_hash import BlockHasher, combine_block_hashes
 from file_metadata import FileMetadata
+from metrics import metrics
+from sessions import session_pool
+from shard_state import ShardState
+
+
+class BlogCheckpoint(TypedDict):
+    last_runtime: str
 
 
 class ConfigData(TypedDict):
     last_runtime: str
     current_tumblr_blogs: list[str]
+    dashboard_since_id: NotRequired[int]
+    blog_checkpoints: NotRequired[dict[str, BlogCheckpoint]]
+
+
+class DownloadProgress(TypedDict):  # kept next to a `.part` file
+    url: str
+    etag: str | None
+    size: int
+    done_segments: dict[str, list[str]]  # start offset, hex block hashes
+
+
+class RangeNotSupportedError(Exception):
+    pass
 
 
 class Helper:
     def __init__(self) -> None:
+        self.stall_threshold_s = 0.5  # longer waits for a chunk count as stalls
         logging.basicConfig(
             level=logging.INFO,
             format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
@@ -22,19 +50,244 @@ class Helper:
         )
         self.logger = logging.getLogger(__name__)
 
-    def download_file(self, file: FileMetadata) -> None:
+    def download_file(
+        self, file: FileMetadata, resp: requests.Response | None = None
+    ) -> float:  # seconds spent stalled
+        # Written to a `.part` file and renamed when complete,
+        # so a file at `local_path` is never half written.
+        # `resp` is a response opened by `open_download` to read the headers first.
+        # The content hash is computed from the written chunks, not a second read.
+        part_path = self.get_part_path(file)
+        result: tuple[float, list[bytes]] | None = None
+        with metrics.measure("download", file.size or 0):
+            if self.is_segmented(file):
+                if resp is not None:
+                    resp.close()  # the segments are requested separately
+                    resp = None
+                result = self._download_segments(file, part_path)
+            if result is None:
+                result = self._download_stream(file, part_path, resp)
+
+        stall_s, block_hashes = result
+        file.content_hash = combine_block_hashes(block_hashes)
+        part_path.replace(file.local_path)
+        return stall_s
+
+    def open_download(self, file: FileMetadata) -> requests.Response:
+        # Only the headers are read, closing the response drops the body
+        resp: requests.Response = session_pool.media.get(
+            str(file.url), stream=True, timeout=10
+        )
         try:
-            resp = requests.get(str(file.url), stream=True, timeout=10)
             resp.raise_for_status()
+        except requests.HTTPError:
+            resp.close()
+            raise
+        return resp
+
+    def get_part_path(self, file: FileMetadata) -> Path:
+        local_path: Path = file.local_path
+        return local_path.with_name(f"{local_path.name}.part")
+
+    def _download_stream(
+        self, file: FileMetadata, part_path: Path, resp: requests.Response | None
+    ) -> tuple[float, list[bytes]]:
+        try:
+            if resp is None:
+                resp = self.open_download(file)
+            hasher = BlockHasher()
+            with part_path.open("wb") as f:
+                stall_s = self._write_chunks(resp, f, hasher)
+            return stall_s, hasher.finish()
+        except Exception:
+            part_path.unlink(missing_ok=True)
+            raise
+
+    def _download_segments(
+        self, file: FileMetadata, part_path: Path
+    ) -> tuple[float, list[bytes]] | None:
+        # Large files are fetched as HTTP Range segments in parallel.
+        # Finished segments and their block hashes are recorded next to
+        # the `.part` file, so a failed download is resumed by the next attempt or run.
+        progress_path = self.get_progress_path(part_path)
+        progress = self.prepare_segments(file, part_path, progress_path)
+        stall_s = 0.0
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings.DOWNLOAD_SEGMENT_WORKERS
+        )
+        try:
+            if not progress["done_segments"]:
+                # The first segment shows whether the server supports ranges
+                segment_stall_s, block_hashes = self._download_segment(
+                    file, part_path, 0
+                )
+                stall_s += segment_stall_s
+                self.record_segment(progress_path, progress, 0, block_hashes)
+
+            futures = {
+                executor.submit(self._download_segment, file, part_path, start): start
+                for start in self.get_pending_segments(file, progress)
+            }
+            for future in concurrent.futures.as_completed(futures):
+                segment_stall_s, block_hashes = future.result()
+                stall_s += segment_stall_s
+                self.record_segment(
+                    progress_path, progress, futures[future], block_hashes
+                )
+
+        except RangeNotSupportedError:
+            self.discard_segments(file, part_path, progress_path)
+            return None
 
-            with file.local_path.open("wb") as f:
-                for chunk in resp.iter_content(chunk_size=8192):
-                    f.write(chunk)
+        finally:
+            executor.shutdown(cancel_futures=True)
 
-        except requests.exceptions.RequestException as e:
-            self.logger.warning(
-                f"Failed to download {file.url}. Error: {e}. Skipping...\n"
+        # Segments are downloaded in parallel, so their stalls overlap
+        return (
+            stall_s / settings.DOWNLOAD_SEGMENT_WORKERS,
+            self.finish_segments(progress_path, progress),
+        )
+
+    def _download_segment(
+        self, file: FileMetadata, part_path: Path, start: int
+    ) -> tuple[float, list[bytes]]:
+        end, headers = self.get_segment_range(file, start)
+        resp = session_pool.media.get(
+            str(file.url), headers=headers, stream=True, timeout=10
+        )
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            resp.close()
+            msg = f"Expected a partial response, got {resp.status_code}."
+            raise RangeNotSupportedError(msg)
+
+        hasher = BlockHasher()
+        with part_path.open("r+b") as f:
+            f.seek(start)
+            stall_s = self._write_chunks(resp, f, hasher)
+            if f.tell() != end + 1:
+                msg = f"The segment {start}-{end} of {file.url} is incomplete."
+                raise ValueError(msg)
+        return stall_s, hasher.finish()
+
+    # The steps of a segmented download shared with the asyncio pipeline,
+    # so a download started by one engine is resumed by the other
+
+    def is_segmented(self, file: FileMetadata) -> bool:
+        return bool(
+            file.size and file.size >= settings.DOWNLOAD_SEGMENT_THRESHOLD_BYTES
+        )
+
+    def get_progress_path(self, part_path: Path) -> Path:
+        return part_path.with_name(f"{part_path.name}.json")
+
+    def prepare_segments(
+        self, file: FileMetadata, part_path: Path, progress_path: Path
+    ) -> DownloadProgress:
+        progress = self._load_progress(file, part_path, progress_path)
+        if progress is None:
+            progress = {
+                "url": str(file.url),
+                "etag": file.etag,
+                "size": file.known_size,
+                "done_segments": {},
+            }
+            with part_path.open("wb") as f:
+                f.truncate(file.known_size)  # segments are written in place
+            self._save_progress(progress_path, progress)
+        else:
+            self.logger.info(
+                f"Resuming {file.url}, "
+                f"{len(progress['done_segments'])} segments are already done..."
             )
+        return progress
+
+    def get_pending_segments(
+        self, file: FileMetadata, progress: DownloadProgress
+    ) -> list[int]:  # start offsets
+        return [
+            start
+            for start in range(0, file.known_size, settings.DOWNLOAD_SEGMENT_BYTES)
+            if str(start) not in progress["done_segments"]
+        ]
+
+    def get_segment_range(
+        self, file: FileMetadata, start: int
+    ) -> tuple[int, dict[str, str]]:  # the last byte, request headers
+        end = min(start + settings.DOWNLOAD_SEGMENT_BYTES, file.known_size) - 1
+        headers = {"Range": f"bytes={start}-{end}"}
+        if file.etag:  # the whole file is returned if it has changed since
+            headers["If-Range"] = f'"{file.etag}"'
+        return end, headers
+
+    def record_segment(
+        self,
+        progress_path: Path,
+        progress: DownloadProgress,
+        start: int,
+        block_hashes: list[bytes],
+    ) -> None:
+        progress["done_segments"][str(start)] = [h.hex() for h in block_hashes]
+        self._save_progress(progress_path, progress)
+
+    def discard_segments(
+        self, file: FileMetadata, part_path: Path, progress_path: Path
+    ) -> None:
+        self.logger.info(f"Range requests are not supported for {file.url}.")
+        part_path.unlink(missing_ok=True)
+        progress_path.unlink(missing_ok=True)
+
+    def finish_segments(
+        self, progress_path: Path, progress: DownloadProgress
+    ) -> list[bytes]:  # the block hashes of the file
+        progress_path.unlink()
+        return [
+            bytes.fromhex(h)
+            for _, segment_hashes in sorted(
+                progress["done_segments"].items(), key=lambda item: int(item[0])
+            )
+            for h in segment_hashes
+        ]
+
+    def _write_chunks(
+        self, resp: requests.Response, f: BinaryIO, hasher: BlockHasher
+    ) -> float:
+        stall_s = 0.0
+        chunk_received_at = time.monotonic()
+        for chunk in resp.iter_content(chunk_size=settings.DOWNLOAD_CHUNK_BYTES):
+            waited_s = time.monotonic() - chunk_received_at
+            if waited_s > self.stall_threshold_s:
+                stall_s += waited_s
+            f.write(chunk)
+            hasher.update(chunk)
+            chunk_received_at = time.monotonic()
+        return stall_s
+
+    def _load_progress(
+        self, file: FileMetadata, part_path: Path, progress_path: Path
+    ) -> DownloadProgress | None:
+        if not part_path.is_file() or not progress_path.is_file():
+            return None
+
+        try:
+            progress: DownloadProgress = json.loads(progress_path.read_text())
+        except (OSError, ValueError):
+            return None
+
+        # A changed file can't be resumed
+        is_same_file = (
+            progress.get("url") == str(file.url)
+            and progress.get("etag") == file.etag
+            and progress.get("size") == file.size
+            and part_path.stat().st_size == file.size
+            and isinstance(progress.get("done_segments"), dict)
+        )
+        return progress if is_same_file else None
+
+    def _save_progress(self, progress_path: Path, progress: DownloadProgress) -> None:
+        temp_file = progress_path.with_name(f"{progress_path.name}.tmp")
+        temp_file.write_text(json.dumps(progress))
+        temp_file.replace(progress_path)
 
     def delete_local_file(self, file: FileMetadata) -> None:
         if settings.SAVE_TO_MEGA and file.local_path.is_file():
@@ -49,24 +302,167 @@ class Helper:
                 if file_path.is_file():
                     file_path.unlink()
 
-    def get_last_runtime_in_unix(self) -> int:
-        json_content = settings.CONFIG_FILE.read_text()
-        config_data: ConfigData = json.loads(json_content)
-        last_runtime = datetime.datetime.fromisoformat(config_data["last_runtime"])
-        return int(last_runtime.timestamp())
+    def convert_bytes_to_mb(self, size_in_bytes: int) -> float:
+        return round(size_in_bytes / (1024 * 1024), 2)
+
+
+class RuntimeConfig:
+    # `config.json` is read once and kept in memory. A blog is checkpointed as soon
+    # as it is crawled and all its files are processed, so an interrupted run
+    # resumes from the blogs it didn't finish.
+    def __init__(self, shard_state: ShardState | None = None) -> None:
+        self.lock = threading.Lock()
+        self.started_at = datetime.datetime.now(datetime.UTC)
+        self.shard_state = shard_state  # other shards write the same file
+        self.config_data: ConfigData = self._read()
+        self.pending_file_cnts: dict[str, int] = {}
+        self.crawled_blogs: set[str] = set()
+        self.failed_blogs: set[str] = set()  # keep their checkpoints on `save`
+        # The planner only records crawled blogs, the executor checkpoints them
+        self.is_dry_run = settings.PIPELINE_MODE == "plan"
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def start_run(self, started_at: datetime.datetime | None = None) -> None:
+        # Watch mode reuses the config between runs, the executor takes
+        # the time of the plan, as posts published after it weren't planned
+        with self.lock:
+            self.started_at = started_at or datetime.datetime.now(datetime.UTC)
+            self.crawled_blogs.clear()
+            self.failed_blogs.clear()
+            if self.shard_state is not None:
+                self.config_data = self._read()
+
+    def get_crawled_blogs(self) -> list[str]:
+        with self.lock:
+            return sorted(self.crawled_blogs)
+
+    def get_failed_blogs(self) -> list[str]:
+        with self.lock:
+            return sorted(self.failed_blogs)
 
     def get_previous_run_tumblr_blogs(self) -> list[str]:
-        json_content = settings.CONFIG_FILE.read_text()
-        config_data: ConfigData = json.loads(json_content)
-        return config_data["current_tumblr_blogs"]
-
-    def save_runtime_config(self, followed_blogs: set[str]) -> None:
-        config_data = {
-            "last_runtime": datetime.datetime.now(datetime.UTC).isoformat(),
-            "current_tumblr_blogs": list(followed_blogs),
-        }
-        json_content = json.dumps(config_data, indent=2)
-        settings.CONFIG_FILE.write_text(json_content)
+        with self.lock:
+            return list(self.config_data["current_tumblr_blogs"])
 
-    def convert_bytes_to_mb(self, size_in_bytes: int) -> float:
-        return round(size_in_bytes / (1024 * 1024), 2)
+    def get_last_runtime_in_unix(self, blog_name: str) -> int:
+        with self.lock:
+            checkpoint = self.config_data.get("blog_checkpoints", {}).get(blog_name)
+            last_runtime = (
+                checkpoint["last_runtime"]
+                if checkpoint
+                else self.config_data["last_runtime"]
+            )
+        return int(datetime.datetime.fromisoformat(last_runtime).timestamp())
+
+    def is_blog_behind(self, blog_name: str) -> bool:
+        # A blog that failed in an earlier run is behind the dashboard position
+        with self.lock:
+            checkpoint = self.config_data.get("blog_checkpoints", {}).get(blog_name)
+            return checkpoint is not None and datetime.datetime.fromisoformat(
+                checkpoint["last_runtime"]
+            ) < datetime.datetime.fromisoformat(self.config_data["last_runtime"])
+
+    def get_dashboard_since_id(self) -> int | None:
+        with self.lock:
+            return self.config_data.get("dashboard_since_id")
+
+    def add_pending_file(self, blog_name: str) -> None:
+        with self.lock:
+            self.pending_file_cnts[blog_name] = (
+                self.pending_file_cnts.get(blog_name, 0) + 1
+            )
+
+    def finish_pending_file(self, blog_name: str) -> None:
+        with self.lock:
+            self.pending_file_cnts[blog_name] -= 1
+            if (
+                self.pending_file_cnts[blog_name] == 0
+                and blog_name in self.crawled_blogs
+            ):
+                self._checkpoint_blog(blog_name)
+
+    def complete_blog(self, blog_name: str) -> None:
+        with self.lock:
+            self.crawled_blogs.add(blog_name)
+            if self.is_dry_run:
+                return
+            if self.pending_file_cnts.get(blog_name, 0) == 0:
+                self._checkpoint_blog(blog_name)
+
+    def fail_blog(self, blog_name: str) -> None:
+        with self.lock:
+            self.failed_blogs.add(blog_name)
+
+    def _checkpoint_blog(self, blog_name: str) -> None:  # the lock must be held
+        self.crawled_blogs.discard(blog_name)
+        with self._lock_shards():
+            self.config_data.setdefault("blog_checkpoints", {})[blog_name] = {
+                "last_runtime": self.started_at.isoformat()
+            }
+            # The blog won't be treated as new if the run stops before the end
+            if blog_name not in self.config_data["current_tumblr_blogs"]:
+                self.config_data["current_tumblr_blogs"].append(blog_name)
+            self._write()
+        self.logger.info(f"{blog_name} has been checkpointed.")
+
+    def save(
+        self,
+        followed_blogs: set[str],
+        dashboard_since_id: int | None = None,
+        started_at: datetime.datetime | None = None,  # the first shard's start
+        failed_blogs: Iterable[str] = (),  # of the other shards
+    ) -> None:
+        with self.lock, self._lock_shards():
+            # Every other blog is now up to date, its checkpoint is no longer
+            # needed. A blog that failed keeps the checkpoint it had, a new one
+            # is crawled as new again.
+            failed_blogs = self.failed_blogs.union(failed_blogs)
+            previous_blogs = self.config_data["current_tumblr_blogs"]
+            checkpoints = self.config_data.get("blog_checkpoints", {})
+            failed_checkpoints: dict[str, BlogCheckpoint] = {
+                blog_name: checkpoints.get(
+                    blog_name, {"last_runtime": self.config_data["last_runtime"]}
+                )
+                for blog_name in failed_blogs
+                if blog_name in previous_blogs
+            }
+            self.config_data = {
+                "last_runtime": (started_at or self.started_at).isoformat(),
+                "current_tumblr_blogs": [
+                    blog_name
+                    for blog_name in followed_blogs
+                    if blog_name not in failed_blogs or blog_name in previous_blogs
+                ],
+            }
+            if failed_checkpoints:
+                self.config_data["blog_checkpoints"] = failed_checkpoints
+            if dashboard_since_id is not None:
+                self.config_data["dashboard_since_id"] = dashboard_since_id
+            self._write()
+
+    @contextlib.contextmanager
+    def _lock_shards(self) -> Generator[None]:  # the lock must be held
+        # The checkpoints other shards have written are read back first
+        if self.shard_state is None:
+            yield
+            return
+
+        with self.shard_state.transaction():
+            self.config_data = self._read()
+            yield
+
+    def _read(self) -> ConfigData:
+        config_data: ConfigData = json.loads(settings.CONFIG_FILE.read_text())
+        return config_data
+
+    def _write(self) -> None:  # the lock must be held
+        # Written next to the config and renamed, so a crash can't leave half a file
+        json_content = json.dumps(self.config_data, indent=2)
+        temp_file = settings.CONFIG_FILE.with_suffix(".json.tmp")
+        temp_file.write_text(json_content)
+        temp_file.replace(settings.CONFIG_FILE)
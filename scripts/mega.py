@@ -1,10 +1,16 @@
 import logging
 import re
 import subprocess
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
 
 from config import settings
 from file_metadata import FileMetadata
 from helper import Helper
+from metrics import metrics
+from shard_state import ShardState
 
 # https://github.com/meganz/MEGAcmd/blob/master/UserGuide.md
 
@@ -56,9 +62,10 @@ class MegaSaver:
         if settings.MEGA_UPLOAD_PATH:
             command = ["mega-du", settings.MEGA_UPLOAD_PATH]
             try:
-                result = subprocess.run(
-                    command, capture_output=True, text=True, check=True
-                )
+                with metrics.measure("mega_du"):
+                    result = subprocess.run(
+                        command, capture_output=True, text=True, check=True
+                    )
             except subprocess.CalledProcessError as e:
                 if e.returncode == 53:
                     self.logger.info(
@@ -83,4 +90,370 @@ class MegaSaver:
                 str(file.local_path),
                 str(file.mega_path),
             ]  # -c	Creates remote folder destination in case of not existing
+            with metrics.measure("upload", file.known_size):
+                subprocess.run(command, check=True)
+
+    def upload_local_files(self, files: list[FileMetadata], mega_dir: Path) -> None:
+        # One `mega-put` for many files, a trailing slash makes the target a folder
+        command = [
+            "mega-put",
+            "-c",
+            "--ignore-quota-warn",
+            *(str(file.local_path) for file in files),
+            f"{mega_dir}/",
+        ]
+        with metrics.measure("upload", sum(file.known_size for file in files)):
             subprocess.run(command, check=True)
+
+    def list_remote_files(self) -> set[str]:
+        command = ["mega-ls", str(settings.MEGA_UPLOAD_PATH)]
+        try:
+            with metrics.measure("mega_ls"):
+                result = subprocess.run(
+                    command, capture_output=True, text=True, check=True
+                )
+        except subprocess.CalledProcessError as e:
+            if e.returncode == 53:
+                self.logger.info(
+                    f"The path `{settings.MEGA_UPLOAD_PATH}` does not exist."
+                )
+                return set()
+            raise
+
+        return {line.strip() for line in result.stdout.splitlines() if line.strip()}
+
+    def remote_file_exists(self, mega_path: Path) -> bool:
+        result = subprocess.run(
+            ["mega-ls", str(mega_path)], capture_output=True, check=False
+        )
+        return result.returncode == 0
+
+
+class MegaRemoteManifest:
+    # Names of the files in MEGA_UPLOAD_PATH, listed once at startup
+    def __init__(self, mega: MegaSaver) -> None:
+        self.mega = mega
+        self.lock = threading.Lock()
+        self.filenames: set[str] = set()
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def load(self) -> None:
+        filenames = self.mega.list_remote_files() if settings.SAVE_TO_MEGA else set()
+        with self.lock:
+            self.filenames = filenames
+        self.logger.info(
+            f"{len(filenames)} files found in {settings.MEGA_UPLOAD_PATH}."
+        )
+
+    def contains(self, filename: str) -> bool:
+        with self.lock:
+            return filename in self.filenames
+
+    def add(self, filename: str) -> None:
+        with self.lock:
+            self.filenames.add(filename)
+
+
+class MegaFolderLedger:
+    # Keeps the MEGA folder size in memory instead of asking `mega-du` per file
+    def __init__(self, mega: MegaSaver) -> None:
+        self.mega = mega
+        self.lock = threading.Lock()
+        self.used_bytes = 0  # uploaded, including files from previous runs
+        self.reserved_bytes = 0  # held by files that are being processed
+        self.commit_cnt = 0
+        self.last_reconciled_at = time.monotonic()
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def seed(self) -> None:
+        used_bytes = self.mega.get_mega_folder_size() if settings.SAVE_TO_MEGA else 0
+        with self.lock:
+            self.used_bytes = used_bytes
+            self.reserved_bytes = 0
+            self.last_reconciled_at = time.monotonic()
+
+        self.logger.info(
+            f"The folder size ledger starts at "
+            f"{self.mega.helper.convert_bytes_to_mb(used_bytes)} MB."
+        )
+
+    def is_full(self) -> bool:
+        with self.lock:
+            total_bytes = self.used_bytes + self.reserved_bytes
+        return bool(total_bytes >= settings.MEGA_FOLDER_SIZE_LIMIT_BYTES)
+
+    def get_remaining_bytes(self) -> int:
+        with self.lock:
+            total_bytes = self.used_bytes + self.reserved_bytes
+        return int(settings.MEGA_FOLDER_SIZE_LIMIT_BYTES - total_bytes)
+
+    def reserve(self, size: int) -> bool:
+        with self.lock:
+            total_bytes = self.used_bytes + self.reserved_bytes + size
+            if total_bytes > settings.MEGA_FOLDER_SIZE_LIMIT_BYTES:
+                return False
+            self.reserved_bytes += size
+            return True
+
+    def release(self, size: int) -> None:  # the file failed, give its bytes back
+        with self.lock:
+            self.reserved_bytes -= size
+
+    def commit(self, size: int) -> None:  # the file has been saved
+        with self.lock:
+            self.reserved_bytes -= size
+            self.used_bytes += size
+            self.commit_cnt += 1
+            reconcile_is_due = (
+                time.monotonic() - self.last_reconciled_at
+                >= settings.MEGA_LEDGER_RECONCILE_INTERVAL_S
+            )
+            if reconcile_is_due:
+                self.last_reconciled_at = time.monotonic()
+
+        if reconcile_is_due:
+            self.reconcile()
+
+    def reconcile(self) -> None:
+        if not settings.SAVE_TO_MEGA:
+            return
+
+        with self.lock:
+            commit_cnt = self.commit_cnt
+
+        used_bytes = self.mega.get_mega_folder_size()
+
+        with self.lock:
+            # Uploads finished while `mega-du` was running may or may not be counted
+            if commit_cnt != self.commit_cnt:
+                self.logger.info(
+                    "The folder size changed during reconcile. Skipping..."
+                )
+                return
+
+            if used_bytes != self.used_bytes:
+                self.logger.info(
+                    f"The folder size ledger was off by "
+                    f"{used_bytes - self.used_bytes} bytes. Reconciled with mega-du."
+                )
+            self.used_bytes = used_bytes
+
+
+class SharedFolderLedger(MegaFolderLedger):
+    # The ledger of a sharded run, kept in the shard state,
+    # so all shards reserve their files from the same MEGA_FOLDER_SIZE_LIMIT_MB
+    def __init__(self, mega: MegaSaver, shard_state: ShardState) -> None:
+        super().__init__(mega)
+        self.shard_state = shard_state
+
+    def seed(self) -> None:
+        self.shard_state.reset_reserved_folder_bytes()
+        commit_cnt = self.shard_state.get_folder_commit_cnt()
+        used_bytes = self.mega.get_mega_folder_size() if settings.SAVE_TO_MEGA else 0
+        # Files other shards saved meanwhile are counted at the next reconcile
+        self.shard_state.set_used_folder_bytes(used_bytes, commit_cnt)
+        with self.lock:
+            self.last_reconciled_at = time.monotonic()
+
+        self.logger.info(
+            f"The shared folder size ledger starts at "
+            f"{self.mega.helper.convert_bytes_to_mb(used_bytes)} MB."
+        )
+
+    def is_full(self) -> bool:
+        total_bytes: int = self.shard_state.get_folder_bytes()
+        return bool(total_bytes >= settings.MEGA_FOLDER_SIZE_LIMIT_BYTES)
+
+    def get_remaining_bytes(self) -> int:
+        total_bytes: int = self.shard_state.get_folder_bytes()
+        return int(settings.MEGA_FOLDER_SIZE_LIMIT_BYTES - total_bytes)
+
+    def reserve(self, size: int) -> bool:
+        return bool(self.shard_state.reserve_folder_bytes(size))
+
+    def release(self, size: int) -> None:
+        self.shard_state.release_folder_bytes(size)
+
+    def commit(self, size: int) -> None:
+        self.shard_state.commit_folder_bytes(size)
+        with self.lock:
+            reconcile_is_due = (
+                time.monotonic() - self.last_reconciled_at
+                >= settings.MEGA_LEDGER_RECONCILE_INTERVAL_S
+            )
+            if reconcile_is_due:
+                self.last_reconciled_at = time.monotonic()
+
+        if reconcile_is_due:
+            self.reconcile()
+
+    def reconcile(self) -> None:
+        if not settings.SAVE_TO_MEGA:
+            return
+
+        commit_cnt = self.shard_state.get_folder_commit_cnt()
+        used_bytes = self.mega.get_mega_folder_size()
+        # Uploads finished by any shard while `mega-du` was running may be missed
+        if not self.shard_state.set_used_folder_bytes(used_bytes, commit_cnt):
+            self.logger.info("The folder size changed during reconcile. Skipping...")
+
+
+UploadCallback = Callable[[FileMetadata, bool], None]  # the file, is it uploaded
+
+
+class MegaUploader:
+    # Collects downloaded files and uploads them with one `mega-put` per batch.
+    # MEGAcmd commands talk to the `mega-cmd-server` started by `mega-login`,
+    # so a batch pays the process startup and server handshake only once.
+    def __init__(self, mega: MegaSaver) -> None:
+        self.mega = mega
+        self.condition = threading.Condition()
+        self.batch: list[tuple[FileMetadata, UploadCallback]] = []
+        self.batch_bytes = 0
+        self.batch_started_at = 0.0
+        self.is_closed = False
+        self.flusher: threading.Thread | None = None
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def is_batching(self) -> bool:
+        return bool(settings.SAVE_TO_MEGA and settings.MEGA_UPLOAD_BATCH_FILES > 1)
+
+    def start(self) -> None:
+        if self.is_batching:
+            self.is_closed = False
+            self.flusher = threading.Thread(target=self._flusher_worker, daemon=True)
+            self.flusher.start()
+
+    def close(self) -> None:  # uploads what is left and waits for it
+        with self.condition:
+            self.is_closed = True
+            self.condition.notify_all()
+
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+
+    def flush(self) -> None:  # uploads what is left and keeps batching
+        self.close()
+        self.start()
+
+    def submit(self, file: FileMetadata, on_done: UploadCallback) -> None:
+        if not self.is_batching:
+            self._upload_one(file, on_done)
+            return
+
+        with self.condition:
+            # Downloads wait while the uploads fall behind, so the files
+            # waiting on the disk stay within about 2 batches
+            while self.batch and self._is_batch_full(scale=2) and not self.is_closed:
+                self.condition.wait()
+
+            is_closed = self.is_closed
+            if not is_closed:
+                if not self.batch:
+                    self.batch_started_at = time.monotonic()
+                self.batch.append((file, on_done))
+                self.batch_bytes += file.known_size
+                # The flusher starts the timeout of a new batch or sends a full one
+                if len(self.batch) == 1 or self._is_batch_full():
+                    self.condition.notify_all()
+
+        # The flusher may be gone, so a late file is uploaded on its own
+        # instead of waiting in the batch with its reservation forever
+        if is_closed:
+            self._upload_one(file, on_done)
+
+    def _is_batch_full(self, scale: int = 1) -> bool:
+        return bool(
+            len(self.batch) >= scale * settings.MEGA_UPLOAD_BATCH_FILES
+            or self.batch_bytes >= scale * settings.MEGA_UPLOAD_BATCH_BYTES
+        )
+
+    def _flusher_worker(self) -> None:
+        while True:
+            with self.condition:
+                while not self.is_closed and not self._is_batch_full():
+                    if not self.batch:
+                        self.condition.wait()
+                        continue
+
+                    timeout = (
+                        self.batch_started_at
+                        + settings.MEGA_UPLOAD_BATCH_TIMEOUT_S
+                        - time.monotonic()
+                    )
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+
+                if self.is_closed and not self.batch:
+                    return
+
+                # Files submitted during the previous upload stay for the next batch
+                batch = self.batch[: settings.MEGA_UPLOAD_BATCH_FILES]
+                self.batch = self.batch[settings.MEGA_UPLOAD_BATCH_FILES :]
+                self.batch_bytes = sum(file.known_size for file, _ in self.batch)
+                self.condition.notify_all()  # submitters waiting for room
+
+            self._upload_batch(batch)
+
+    def _upload_batch(self, batch: list[tuple[FileMetadata, UploadCallback]]) -> None:
+        batches_by_dir: dict[Path, list[tuple[FileMetadata, UploadCallback]]] = {}
+        for file, on_done in batch:
+            batches_by_dir.setdefault(file.mega_path.parent, []).append((file, on_done))
+
+        for mega_dir, dir_batch in batches_by_dir.items():
+            if len(dir_batch) == 1:
+                self._upload_one(*dir_batch[0])
+                continue
+
+            try:
+                self.mega.upload_local_files([file for file, _ in dir_batch], mega_dir)
+            except subprocess.CalledProcessError:
+                self.logger.warning(
+                    f"Failed to upload a batch of {len(dir_batch)} files. "
+                    "Checking them one by one..."
+                )
+                for file, on_done in dir_batch:
+                    if self.mega.remote_file_exists(file.mega_path):
+                        self._report(file, on_done, is_uploaded=True)
+                    else:
+                        self._upload_one(file, on_done)
+                continue
+
+            self.logger.info(f"Uploaded a batch of {len(dir_batch)} files.")
+            for file, on_done in dir_batch:
+                self._report(file, on_done, is_uploaded=True)
+
+    def _upload_one(self, file: FileMetadata, on_done: UploadCallback) -> None:
+        try:
+            self.mega.upload_local_file(file)
+        except Exception:
+            self.logger.exception(f"Failed to upload {file.local_path}")
+            self._report(file, on_done, is_uploaded=False)
+        else:
+            self._report(file, on_done, is_uploaded=True)
+
+    def _report(
+        self, file: FileMetadata, on_done: UploadCallback, is_uploaded: bool
+    ) -> None:
+        try:
+            on_done(file, is_uploaded)
+        except Exception:
+            self.logger.exception(f"Failed to finish {file.url}")
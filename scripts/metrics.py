@@ -0,0 +1,295 @@
+import bisect
+import contextlib
+import datetime
+import json
+import logging
+import threading
+import time
+from collections.abc import Generator
+from pathlib import Path
+from typing import Any
+
+from config import settings
+
+# Upper bounds in seconds, the last bucket takes everything slower
+LATENCY_BUCKETS_S = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class StageStats:  # one step of the pipeline, e.g. a HEAD request or an upload
+    def __init__(self) -> None:
+        self.cnt = 0
+        self.error_cnt = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.bytes = 0
+        self.bucket_cnts = [0] * (len(LATENCY_BUCKETS_S) + 1)
+
+    def observe(self, elapsed_s: float, size: int, is_error: bool) -> None:
+        self.cnt += 1
+        self.error_cnt += is_error
+        self.total_s += elapsed_s
+        self.max_s = max(self.max_s, elapsed_s)
+        self.bytes += size
+        self.bucket_cnts[bisect.bisect_left(LATENCY_BUCKETS_S, elapsed_s)] += 1
+
+    def merge(self, stats: dict[str, Any]) -> None:  # a stage from another report
+        self.cnt += stats["count"]
+        self.error_cnt += stats["errors"]
+        self.total_s += stats["total_s"]
+        self.max_s = max(self.max_s, stats["max_s"])
+        self.bytes += stats["bytes"]
+        self.bucket_cnts = [
+            cnt + other_cnt
+            for cnt, other_cnt in zip(self.bucket_cnts, stats["buckets"], strict=True)
+        ]
+
+    def get_quantile(self, q: float) -> float:
+        # Interpolated inside its bucket, like `histogram_quantile` in Prometheus
+        rank = q * self.cnt
+        seen_cnt = 0
+        lower_s = 0.0
+        for upper_s, bucket_cnt in zip(
+            LATENCY_BUCKETS_S, self.bucket_cnts, strict=False
+        ):
+            if bucket_cnt and seen_cnt + bucket_cnt >= rank:
+                quantile_s = lower_s + (upper_s - lower_s) * (
+                    (rank - seen_cnt) / bucket_cnt
+                )
+                return min(quantile_s, self.max_s)
+            seen_cnt += bucket_cnt
+            lower_s = upper_s
+        return self.max_s
+
+    def to_dict(self, runtime_s: float) -> dict[str, Any]:
+        return {
+            "count": self.cnt,
+            "errors": self.error_cnt,
+            "total_s": round(self.total_s, 3),
+            "mean_s": round(self.total_s / self.cnt, 3) if self.cnt else 0.0,
+            "p50_s": round(self.get_quantile(0.5), 3),
+            "p95_s": round(self.get_quantile(0.95), 3),
+            "max_s": round(self.max_s, 3),
+            "bytes": self.bytes,
+            # Per request, and over the whole run with the requests overlapping
+            "bytes_per_s": round(self.bytes / self.total_s) if self.total_s else 0,
+            "run_bytes_per_s": round(self.bytes / runtime_s) if runtime_s else 0,
+            "buckets": list(self.bucket_cnts),  # to merge the reports of shards
+        }
+
+
+class Metrics:
+    # Collected by every engine and written as a report when the run ends,
+    # so the slowest stage of a run can be found without reading the log.
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started_at = datetime.datetime.now(datetime.UTC)
+        self.started_at_monotonic = time.monotonic()
+        self.stages: dict[str, StageStats] = {}
+        self.skip_cnts: dict[str, int] = {}
+        self.blogs: dict[str, dict[str, int]] = {}
+        self.queue_depths: list[tuple[float, int]] = []  # seconds since start, depth
+        self.sampled_at = 0.0
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def start_run(self) -> None:
+        # The clock of a report starts with its run, watch mode waits between runs.
+        # Calls made before, like MEGA's at startup, still count towards it.
+        with self.lock:
+            self.started_at = datetime.datetime.now(datetime.UTC)
+            self.started_at_monotonic = time.monotonic()
+            self.queue_depths.clear()
+            self.sampled_at = 0.0
+
+    def reset(self) -> None:  # once a run is reported, the next one starts from zero
+        with self.lock:
+            self.stages.clear()
+            self.skip_cnts.clear()
+            self.blogs.clear()
+            self.queue_depths.clear()
+
+    @classmethod
+    def merge_reports(cls, reports: list[dict[str, Any]]) -> "Metrics":
+        # The reports of the shards of a run as one run started by the first shard
+        merged = cls()
+        merged.started_at = min(
+            datetime.datetime.fromisoformat(report["started_at"]) for report in reports
+        )
+        merged.started_at_monotonic = time.monotonic() - (
+            (datetime.datetime.now(datetime.UTC) - merged.started_at).total_seconds()
+        )
+        for report in reports:
+            offset_s = (
+                datetime.datetime.fromisoformat(report["started_at"])
+                - merged.started_at
+            ).total_seconds()
+            merged._add_report(report, offset_s)
+        merged.queue_depths.sort()
+        return merged
+
+    def _add_report(self, report: dict[str, Any], offset_s: float) -> None:
+        for stage, stats in report["stages"].items():
+            self.stages.setdefault(stage, StageStats()).merge(stats)
+        for reason, cnt in report["skipped"].items():
+            self.skip_cnts[reason] = self.skip_cnts.get(reason, 0) + cnt
+        for blog_name, blog in report["blogs"].items():
+            merged_blog = self._get_blog(blog_name)
+            for key, value in blog.items():
+                merged_blog[key] += value
+        # Every shard samples its own queue
+        self.queue_depths.extend(
+            (round(at_s + offset_s, 1), depth)
+            for at_s, depth in report["queue_depth"]["samples"]
+        )
+
+    @contextlib.contextmanager
+    def measure(self, stage: str, size: int = 0) -> Generator[None]:
+        # Failed calls are timed too and counted as errors
+        started_at = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.observe(stage, time.monotonic() - started_at, is_error=True)
+            raise
+        self.observe(stage, time.monotonic() - started_at, size)
+
+    def observe(
+        self, stage: str, elapsed_s: float, size: int = 0, *, is_error: bool = False
+    ) -> None:
+        with self.lock:
+            stats = self.stages.setdefault(stage, StageStats())
+            stats.observe(elapsed_s, size, is_error)
+
+    def count_skip(self, reason: str, blog_name: str) -> None:
+        with self.lock:
+            self.skip_cnts[reason] = self.skip_cnts.get(reason, 0) + 1
+            self._get_blog(blog_name)["skipped"] += 1
+
+    def count_collected(self, blog_name: str, size: int) -> None:
+        with self.lock:
+            blog = self._get_blog(blog_name)
+            blog["files"] += 1
+            blog["bytes"] += size
+
+    def sample_queue_depth(self, depth: int) -> None:  # at most once per interval
+        now = time.monotonic()
+        with self.lock:
+            if now - self.sampled_at < settings.METRICS_SAMPLE_INTERVAL_S:
+                return
+            self.sampled_at = now
+            self.queue_depths.append((round(now - self.started_at_monotonic, 1), depth))
+
+    def get_report(self) -> dict[str, Any]:
+        runtime_s = time.monotonic() - self.started_at_monotonic
+        with self.lock:
+            depths = [depth for _, depth in self.queue_depths]
+            return {
+                "started_at": self.started_at.isoformat(),
+                "runtime_s": round(runtime_s, 3),
+                "engine": settings.PIPELINE_ENGINE,
+                "shards": settings.SHARD_COUNT,
+                "stages": {
+                    stage: stats.to_dict(runtime_s)
+                    for stage, stats in sorted(self.stages.items())
+                },
+                "skipped": dict(sorted(self.skip_cnts.items())),
+                "blogs": {
+                    blog_name: dict(blog)
+                    for blog_name, blog in sorted(self.blogs.items())
+                },
+                "queue_depth": {
+                    "mean": round(sum(depths) / len(depths), 1) if depths else 0,
+                    "max": max(depths, default=0),
+                    "samples": list(self.queue_depths),
+                },
+            }
+
+    def write_report(self) -> None:
+        report = self.get_report()
+        for stage, stats in report["stages"].items():
+            self.logger.info(
+                f"{stage}: {stats['count']} calls, {stats['errors']} failed, "
+                f"p50 {stats['p50_s']}s, p95 {stats['p95_s']}s, "
+                f"{stats['total_s']}s in total."
+            )
+
+        if settings.METRICS_REPORT_FILE is not None:
+            self._write_file(settings.METRICS_REPORT_FILE, json.dumps(report, indent=2))
+        if settings.METRICS_PROMETHEUS_FILE is not None:
+            self._write_file(settings.METRICS_PROMETHEUS_FILE, self._get_prometheus())
+
+    def _get_blog(self, blog_name: str) -> dict[str, int]:
+        return self.blogs.setdefault(blog_name, {"files": 0, "bytes": 0, "skipped": 0})
+
+    def _get_prometheus(self) -> str:
+        # The text format read by the node_exporter textfile collector,
+        # the samples of a metric have to be written together
+        with self.lock:
+            stages = sorted(self.stages.items())
+            blogs = sorted(self.blogs.items())
+            skip_cnts = sorted(self.skip_cnts.items())
+            max_depth = max((depth for _, depth in self.queue_depths), default=0)
+
+        lines = ["# TYPE art_collector_stage_seconds histogram"]
+        for stage, stats in stages:
+            bucket_cnt = 0
+            for bound_s, cnt in zip(
+                (*LATENCY_BUCKETS_S, "+Inf"), stats.bucket_cnts, strict=True
+            ):
+                bucket_cnt += cnt
+                lines.append(
+                    f'art_collector_stage_seconds_bucket{{stage="{stage}",'
+                    f'le="{bound_s}"}} {bucket_cnt}'
+                )
+            lines.append(
+                f'art_collector_stage_seconds_sum{{stage="{stage}"}} {stats.total_s}'
+            )
+            lines.append(
+                f'art_collector_stage_seconds_count{{stage="{stage}"}} {stats.cnt}'
+            )
+
+        counters = {
+            "stage_errors_total": [
+                (f'stage="{stage}"', stats.error_cnt) for stage, stats in stages
+            ],
+            "stage_bytes_total": [
+                (f'stage="{stage}"', stats.bytes) for stage, stats in stages
+            ],
+            "skipped_files_total": [
+                (f'reason="{reason}"', cnt) for reason, cnt in skip_cnts
+            ],
+            "blog_files_total": [
+                (f'blog="{blog_name}"', blog["files"]) for blog_name, blog in blogs
+            ],
+            "blog_bytes_total": [
+                (f'blog="{blog_name}"', blog["bytes"]) for blog_name, blog in blogs
+            ],
+        }
+        for name, samples in counters.items():
+            lines.append(f"# TYPE art_collector_{name} counter")
+            lines.extend(
+                f"art_collector_{name}{{{labels}}} {value}" for labels, value in samples
+            )
+
+        runtime_s = time.monotonic() - self.started_at_monotonic
+        lines.extend((
+            "# TYPE art_collector_queue_depth_max gauge",
+            f"art_collector_queue_depth_max {max_depth}",
+            "# TYPE art_collector_runtime_seconds gauge",
+            f"art_collector_runtime_seconds {runtime_s:.3f}",
+        ))
+        return "\n".join(lines) + "\n"
+
+    def _write_file(self, path: Path, text: str) -> None:
+        # Renamed into place, so a scraper never reads a half written file
+        temp_file = path.with_name(f"{path.name}.tmp")
+        temp_file.write_text(text)
+        temp_file.replace(path)
+        self.logger.info(f"The run report has been written to {path}.")
+
+
+metrics = Metrics()
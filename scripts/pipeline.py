@@ -1,50 +1,391 @@
+import asyncio
 import concurrent.futures
+import functools
+import logging
+import os
 import queue
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
 import time
-from typing import TYPE_CHECKING
+from collections.abc import Callable, Iterable
+from pathlib import Path
+from types import FrameType
 
+from async_pipeline import AsyncPipeline
 from config import settings
 from consumer import Consumer
-from helper import Helper
-from mega import MegaSaver
-from tumblr import TumblrCollector
+from consumer_scaler import ConsumerScaler
+from dedup_store import DedupStore
+from file_metadata import FileMetadata
+from file_queue import FileQueue, create_queue_policy
+from helper import RuntimeConfig
+from mega import (
+    MegaFolderLedger,
+    MegaRemoteManifest,
+    MegaSaver,
+    MegaUploader,
+    SharedFolderLedger,
+)
+from metrics import Metrics, metrics
+from shard_state import ShardRun, ShardState
+from tumblr import FollowedBlogReader, TumblrCollector
+from work_plan import WorkPlan, WorkPlanWriter
 
-if TYPE_CHECKING:
-    from file_metadata import FileMetadata
 
+def put_files(
+    files: Iterable[FileMetadata], file_queue: queue.Queue[FileMetadata | None]
+) -> None:
+    for file in files:
+        file_queue.put(file)
 
-def main() -> None:
-    mega = MegaSaver()
-    mega.login()  # the first step as auth code can expire
 
-    file_queue: queue.Queue[FileMetadata | None] = queue.Queue(
-        maxsize=settings.MAX_WORKERS * 2
-    )
-    tumblr = TumblrCollector()
-    helper = Helper()
-    consumer = Consumer()
-    followed_blog_names = tumblr.get_followed_blogs()
+class Pipeline:
+    # Everything a run needs. In watch mode it is kept between runs,
+    # so the MEGA session, HTTP connections and the ledger stay warm.
+    def __init__(self) -> None:
+        self.mega = MegaSaver()
+        self.mega.login()  # the first step as auth code can expire
+        # A shard shares the ledger, dedup keys and `config.json` with the others
+        self.shard_state = ShardState() if settings.SHARD_INDEX is not None else None
+        self.ledger = (
+            MegaFolderLedger(self.mega)
+            if self.shard_state is None
+            else SharedFolderLedger(self.mega, self.shard_state)
+        )
+        self.ledger.seed()  # the only `mega-du` call until the ledger reconciles
+        self.remote_manifest = MegaRemoteManifest(self.mega)
+        self.remote_manifest.load()  # the only `mega-ls` of the upload folder
+
+        # The policy picks the next file from the files waiting in the queue
+        self.file_queue = FileQueue(
+            create_queue_policy(self.ledger), maxsize=settings.FILE_QUEUE_SIZE
+        )
+        self.runtime_config = RuntimeConfig(self.shard_state)
+        self.dedup_store = DedupStore(shard_state=self.shard_state)
+        self.tumblr = TumblrCollector(
+            self.ledger, self.dedup_store, self.remote_manifest, self.runtime_config
+        )
+        self.uploader = MegaUploader(self.mega)
+        self.uploader.start()
+        self.scaler = ConsumerScaler(self.file_queue)
+        self.consumer = Consumer(
+            self.ledger,
+            self.dedup_store,
+            self.uploader,
+            self.remote_manifest,
+            self.runtime_config,
+        )
+        self.consumer.spool.open()
+
+        # One event loop for every run, the async clients are bound to it
+        self.async_runner: asyncio.Runner | None = None
+        self.async_pipeline: AsyncPipeline | None = None
+        if settings.PIPELINE_ENGINE == "asyncio":
+            self.async_runner = asyncio.Runner()
+            self.async_pipeline = AsyncPipeline(self.tumblr, self.consumer)
+
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def is_stopped(self) -> bool:
+        return bool(self.tumblr.stop_event.is_set())
+
+    def stop(self) -> None:  # no new files are crawled, queued ones are finished
+        self.tumblr.stop_event.set()
+
+    def run(self, followed_blog_names: set[str]) -> None:
+        metrics.start_run()
+        self.runtime_config.start_run()
+        self.dedup_store.clear_claims()
+        if self.shard_state is not None:
+            self.shard_state.start_round(self.runtime_config.started_at)
+        if self.async_runner is not None and self.async_pipeline is not None:
+            self.async_runner.run(self.async_pipeline.run(followed_blog_names))
+        else:
+            self._run_threads(
+                functools.partial(
+                    self.tumblr.produce_files_from_blogs, followed_blog_names
+                )
+            )
+
+        if self.shard_state is not None:
+            self._finish_shard_run(self.shard_state, followed_blog_names)
+        else:
+            self._finish_run(followed_blog_names, self.tumblr.dashboard_since_id)
+
+    def plan(self, followed_blog_names: set[str]) -> None:
+        # Crawls and resolves the files like a run, but only writes them down
+        metrics.start_run()
+        self.runtime_config.start_run()
+        self.dedup_store.clear_claims()
+        writer = WorkPlanWriter(settings.WORK_PLAN_FILE, self.consumer)
+        plan_queue: queue.Queue[FileMetadata | None] = queue.Queue(
+            maxsize=settings.FILE_QUEUE_SIZE
+        )
+        writer_thread = threading.Thread(
+            target=writer.writer_worker, args=(plan_queue,)
+        )
+        writer_thread.start()
+        try:
+            self.tumblr.produce_files_from_blogs(followed_blog_names, plan_queue)
+        finally:
+            plan_queue.put(None)
+            writer_thread.join()
+
+        writer.close(
+            self.runtime_config,
+            followed_blog_names,
+            self.tumblr.dashboard_since_id,
+            is_complete=not self.is_stopped,
+        )
+        metrics.write_report()
+        metrics.reset()
+
+    def execute(self) -> None:  # transfers a plan without calling the Tumblr API
+        metrics.start_run()
+        work_plan = WorkPlan.load(settings.WORK_PLAN_FILE)
+        summary = work_plan.summary
+        self.runtime_config.start_run(summary.started_at if summary else None)
+        for blog_name in summary.failed_blogs if summary else []:
+            self.runtime_config.fail_blog(blog_name)  # failed to plan
+        self.dedup_store.clear_claims()
+        files = work_plan.iter_files(
+            self.dedup_store, self.runtime_config, self.tumblr.stop_event
+        )
+        if self.async_runner is not None and self.async_pipeline is not None:
+            self.async_runner.run(self.async_pipeline.run_planned(files))
+        else:
+            self._run_threads(functools.partial(put_files, files))
+
+        if summary is not None and work_plan.is_whole:
+            self._finish_run(set(summary.followed_blogs), summary.dashboard_since_id)
+        else:
+            self._finish_run(None, None)  # only the complete blogs are checkpointed
+
+    def _run_threads(
+        self, producer: Callable[[queue.Queue[FileMetadata | None]], None]
+    ) -> None:
+        self.scaler.start()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings.MAX_WORKERS + 1
+        ) as executor:
+            # Submitting consumer workers
+            for _ in range(settings.MAX_WORKERS):
+                executor.submit(
+                    self.consumer.consumer_worker, self.file_queue, self.scaler
+                )
+
+            # Submitting the producer
+            producer_future = executor.submit(producer, self.file_queue)
 
-    with concurrent.futures.ThreadPoolExecutor(
-        max_workers=settings.MAX_WORKERS + 1
-    ) as executor:
-        # Submitting consumer workers
-        for _ in range(settings.MAX_WORKERS):
-            executor.submit(consumer.consumer_worker, file_queue)
+            try:
+                producer_future.result()
+            finally:
+                # The queued files are finished even if the producer failed
+                self.file_queue.join()
+                for _ in range(settings.MAX_WORKERS):
+                    self.file_queue.put(None)
 
-        # Submitting the producer
-        producer_future = executor.submit(
-            tumblr.produce_files_from_blogs, followed_blog_names, file_queue
+        self.scaler.close()
+
+    def _finish_run(
+        self, followed_blog_names: set[str] | None, dashboard_since_id: int | None
+    ) -> None:
+        self.uploader.flush()  # uploads the last batch
+        if followed_blog_names is not None and not self.is_stopped:
+            # A stopped run keeps the checkpoints of the blogs it has finished
+            self.runtime_config.save(followed_blog_names, dashboard_since_id)
+        metrics.write_report()
+        metrics.reset()
+
+    def _finish_shard_run(self, shard_state: ShardState, blog_names: set[str]) -> None:
+        # The blogs of a shard are checkpointed as they finish. The last shard
+        # of the round saves `config.json` as a full run and merges the reports.
+        self.uploader.flush()
+        shard_runs = shard_state.finish_round(
+            ShardRun(
+                shard_index=shard_state.shard_index,
+                started_at=self.runtime_config.started_at,
+                is_complete=not self.is_stopped,
+                blogs=sorted(blog_names),
+                failed_blogs=self.runtime_config.get_failed_blogs(),
+                dashboard_since_id=self.tumblr.dashboard_since_id,
+                report=metrics.get_report(),
+            )
+        )
+        metrics.reset()
+        if shard_runs is None:  # other shards are still running
+            return
+
+        if all(shard_run.is_complete for shard_run in shard_runs):
+            # The oldest position, no shard has read the dashboard past it
+            dashboard_since_ids = [
+                shard_run.dashboard_since_id
+                for shard_run in shard_runs
+                if shard_run.dashboard_since_id is not None
+            ]
+            self.runtime_config.save(
+                {blog for shard_run in shard_runs for blog in shard_run.blogs},
+                min(dashboard_since_ids, default=None),
+                started_at=min(shard_run.started_at for shard_run in shard_runs),
+                failed_blogs={
+                    blog for shard_run in shard_runs for blog in shard_run.failed_blogs
+                },
+            )
+        Metrics.merge_reports([
+            shard_run.report for shard_run in shard_runs
+        ]).write_report()
+
+    def wait_for_next_run(self) -> bool:  # False if stopped while waiting
+        # Jitter keeps several collectors from polling Tumblr at the same time
+        delay_s = 60 * random.uniform(  # noqa: S311
+            settings.WATCH_INTERVAL_MIN,
+            settings.WATCH_INTERVAL_MIN + settings.WATCH_JITTER_MIN,
         )
+        self.logger.info(f"The next run starts in {delay_s / 60:.1f} minutes.")
+        return not self.tumblr.stop_event.wait(delay_s)
+
+    def close(self) -> None:
+        if self.async_runner is not None and self.async_pipeline is not None:
+            self.async_runner.run(self.async_pipeline.close())
+            self.async_runner.close()
+        self.uploader.close()
+        self.consumer.spool.close()
+        self.dedup_store.close()
+        if self.shard_state is not None:
+            self.shard_state.close()
+        # Shards started by `run_shards` share one mega-cmd-server, logging out
+        # would stop the uploads of the others, it logs out after them
+        if settings.SHARD_BLOGS_FILE is None:
+            self.mega.logout()
+
+
+def run_shards() -> int:  # the highest exit code of the shards
+    # `/user/following` is paged here once, the shards read the blogs from a file
+    blog_reader = FollowedBlogReader()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        blogs_file = Path(temp_dir, "followed_blogs.json")
+        blog_reader.write_followed_blogs(blogs_file)
+
+        # Every shard is a process of its own. In their own sessions they don't get
+        # Ctrl+C from the terminal, signals are passed on to them one by one.
+        processes = [
+            subprocess.Popen(
+                [sys.executable, str(Path(__file__).resolve())],
+                env={
+                    **os.environ,
+                    "SHARD_INDEX": str(shard_index),
+                    "SHARD_BLOGS_FILE": str(blogs_file),
+                },
+                start_new_session=True,
+            )
+            for shard_index in range(settings.SHARD_COUNT)
+        ]
+
+        def forward_signal(signum: int, _frame: FrameType | None) -> None:
+            for process in processes:
+                if process.poll() is None:
+                    process.send_signal(signum)
+
+        signal.signal(signal.SIGTERM, forward_signal)
+        signal.signal(signal.SIGINT, forward_signal)
+        returncode = wait_for_shards(processes, blog_reader, blogs_file)
+
+    MegaSaver().logout()  # every shard has finished its uploads
+    return returncode
+
+
+def wait_for_shards(
+    processes: list[subprocess.Popen[bytes]],
+    blog_reader: FollowedBlogReader,
+    blogs_file: Path,
+) -> int:  # the highest exit code of the shards
+    # In watch mode the followed blogs are refreshed here for all shards,
+    # they read the file again every WATCH_BLOGS_REFRESH_MIN
+    refresh_s = settings.WATCH_BLOGS_REFRESH_MIN * 60
+    refreshed_at = time.monotonic()
+    for process in processes:
+        while True:
+            timeout = (
+                max(0.0, refreshed_at + refresh_s - time.monotonic())
+                if settings.WATCH_MODE
+                else None
+            )
+            try:
+                process.wait(timeout)
+                break
+            except subprocess.TimeoutExpired:
+                try:
+                    blog_reader.write_followed_blogs(blogs_file)
+                except Exception:
+                    blog_reader.logger.exception("Failed to refresh the followed blogs")
+                refreshed_at = time.monotonic()
+
+    return max(process.returncode for process in processes)
+
+
+def main() -> None:
+    if settings.SHARD_COUNT > 1 and settings.SHARD_INDEX is None:
+        if returncode := run_shards():
+            sys.exit(returncode)
+        return
+
+    pipeline = Pipeline()
+
+    # The first SIGTERM or Ctrl+C lets the queued files finish and saves
+    # the checkpoints, a second one stops at once
+    def handle_signal(signum: int, _frame: FrameType | None) -> None:
+        pipeline.logger.info(f"{signal.strsignal(signum)}. Finishing queued files...")
+        pipeline.stop()
+        signal.signal(signum, signal.SIG_DFL)
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    try:
+        if settings.PIPELINE_MODE == "execute":
+            pipeline.execute()
+            return
+
+        followed_blog_names = pipeline.tumblr.get_followed_blogs()
+        if settings.PIPELINE_MODE == "plan":
+            pipeline.plan(followed_blog_names)
+            return
 
-        producer_future.result()
-        file_queue.join()
+        blogs_refreshed_at = time.monotonic()
+        while True:
+            try:
+                pipeline.run(followed_blog_names)
+            except Exception:
+                if not settings.WATCH_MODE:
+                    raise
+                pipeline.logger.exception("The run failed")
 
-        for _ in range(settings.MAX_WORKERS):
-            file_queue.put(None)
+            if not settings.WATCH_MODE or not pipeline.wait_for_next_run():
+                break
 
-    helper.save_runtime_config(followed_blog_names)
-    mega.logout()
+            # Followed blogs change rarely, `/user/following` is paged again
+            # only every WATCH_BLOGS_REFRESH_MIN
+            if (
+                time.monotonic() - blogs_refreshed_at
+                >= settings.WATCH_BLOGS_REFRESH_MIN * 60
+            ):
+                try:
+                    followed_blog_names = pipeline.tumblr.get_followed_blogs()
+                    blogs_refreshed_at = time.monotonic()
+                except Exception:
+                    pipeline.logger.exception("Failed to refresh the followed blogs")
+    finally:
+        pipeline.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,231 @@
+import logging
+import re
+from typing import Any, ClassVar
+
+from config import settings
+from file_metadata import FileCandidate, MediaVariant
+from pydantic import HttpUrl
+from tumblr_enum import TumblrPostType
+
+# https://www.tumblr.com/docs/npf
+
+
+class PostExtractor:
+    # Finds the files of a post in the legacy format, HTML in `trail` for text posts
+    # and `photos` for photo posts
+    params: ClassVar[dict[str, str]] = {}  # added to every request for posts
+
+    def __init__(self) -> None:
+        self.url_pattern = re.compile(r"\s*(https?://[^\s]+)\s+([0-9]+)w\s*")
+        self.srcset_pattern = re.compile(r'srcset="([^"]+)"')
+        self.source_pattern = re.compile(r'<source src="([^"]+)"')
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def get_post_candidates(
+        self, post: dict[str, Any], blog_name: str
+    ) -> list[FileCandidate]:
+        is_repost = "parent_post_url" in post
+        if is_repost:
+            return []
+
+        match post["type"]:
+            case TumblrPostType.TEXT.value:
+                return self._get_text_post_candidates(
+                    post_html=post, blog_name=blog_name
+                )
+
+            case TumblrPostType.PHOTO.value:
+                return self._get_photo_post_candidates(
+                    post_html=post, blog_name=blog_name
+                )
+
+            case TumblrPostType.ANSWER.value:
+                return []  # /posts does not support filtering by multiple types
+
+            case _:
+                self.logger.info(f"Not supported post type: {post['type']}.")
+                return []
+
+    def _get_text_post_candidates(
+        self, post_html: dict[str, Any], blog_name: str
+    ) -> list[FileCandidate]:
+        trail: list[dict[str, Any]] = post_html.get("trail") or []
+        if not trail:  # the post has no content of its own
+            return []
+
+        content_raw: str = trail[0].get("content_raw") or ""
+        post_slug: str | None = post_html["slug"]
+        candidates: list[FileCandidate] = []
+
+        # Split content_raw as a post can have multiple images/gifs
+        srcset_matches = self.srcset_pattern.findall(content_raw)
+        if srcset_matches:
+            # If the post has more than one image/gif,
+            # use numeric_suffix to distinguish them
+            numeric_suffix = 1 if len(srcset_matches) > 1 else None
+            for srcset_content in srcset_matches:
+                variants = [
+                    MediaVariant(url=HttpUrl(url), width=int(width))
+                    for url, width in self.url_pattern.findall(srcset_content)
+                ]
+                if not variants:  # no `NNNw` widths, the last file is the largest
+                    last_url = srcset_content.split(",")[-1].split()[0]
+                    variants = [MediaVariant(url=HttpUrl(last_url), width=0)]
+
+                candidates.append(
+                    self._create_candidate(
+                        variants, blog_name, post_slug, numeric_suffix
+                    )
+                )
+                if numeric_suffix is not None:
+                    numeric_suffix += 1
+
+        # Some text blogs have videos
+        if settings.TUMBLR_COLLECT_VIDEOS:
+            srcset_matches = self.source_pattern.findall(content_raw)
+            if srcset_matches:
+                numeric_suffix = 1 if len(srcset_matches) > 1 else None
+                for video_url in srcset_matches:
+                    candidates.append(
+                        FileCandidate(
+                            url=HttpUrl(video_url),
+                            blog_name=blog_name,
+                            post_slug=post_slug,
+                            numeric_suffix=numeric_suffix,
+                        )
+                    )
+                    if numeric_suffix is not None:
+                        numeric_suffix += 1
+
+        return candidates
+
+    def _get_photo_post_candidates(
+        self, post_html: dict[str, Any], blog_name: str
+    ) -> list[FileCandidate]:
+        photo: dict[str, Any] = post_html["photos"][0]
+        post_slug: str | None = post_html["slug"]
+        variants = [
+            MediaVariant(url=HttpUrl(size["url"]), width=size.get("width") or 0)
+            for size in (photo["original_size"], *photo.get("alt_sizes", []))
+        ]
+
+        return [
+            self._create_candidate(
+                variants,
+                blog_name,
+                post_slug,
+                numeric_suffix=None,  # a single photo does not require numbering
+            )
+        ]
+
+    def _create_candidate(
+        self,
+        variants: list[MediaVariant],
+        blog_name: str,
+        post_slug: str | None,
+        numeric_suffix: int | None,
+    ) -> FileCandidate:
+        # The widest size within TUMBLR_IMAGE_MAX_WIDTH, the narrowest if none fits.
+        # The smaller ones are kept for TUMBLR_IMAGE_MAX_KB. `alt_sizes` lists
+        # the original too, a size is only tried once.
+        variants = sorted(
+            {variant.url: variant for variant in variants}.values(),
+            key=lambda variant: variant.width,
+            reverse=True,
+        )
+        max_width = settings.TUMBLR_IMAGE_MAX_WIDTH
+        fitting_variants = [
+            variant
+            for variant in variants
+            if max_width is None or variant.width <= max_width
+        ] or variants[-1:]
+        variant, *smaller_variants = fitting_variants
+
+        return FileCandidate(
+            url=variant.url,
+            blog_name=blog_name,
+            post_slug=post_slug,
+            numeric_suffix=numeric_suffix,
+            # The original keeps its name
+            variant_width=None if variant is variants[0] else variant.width,
+            smaller_variants=smaller_variants,
+        )
+
+
+class NpfPostExtractor(PostExtractor):
+    # Finds the files of a post in the Neue Post Format. Every post is a list of
+    # content blocks whatever its legacy type, so photo and text posts are read
+    # the same way and the variants of a file come with their width and height.
+    params: ClassVar[dict[str, str]] = {"npf": "true"}
+
+    def get_post_candidates(
+        self, post: dict[str, Any], blog_name: str
+    ) -> list[FileCandidate]:
+        # Only reblogs have a trail, it holds the reblogged posts
+        if "parent_post_url" in post or post.get("trail"):
+            return []
+
+        if any(layout.get("type") == "ask" for layout in post.get("layout", [])):
+            return []  # answers aren't collected, as in the legacy format
+
+        post_slug: str | None = post.get("slug")
+        images: list[list[MediaVariant]] = []
+        videos: list[list[MediaVariant]] = []
+        for block in post.get("content", []):
+            match block.get("type"):
+                case "image":
+                    variants = self._get_variants(block.get("media"))
+                    if variants:
+                        images.append(variants)
+
+                case "video" if settings.TUMBLR_COLLECT_VIDEOS:
+                    # Only videos hosted by Tumblr have `media`, not YouTube embeds.
+                    # The size limits are for images, a video is taken as it is.
+                    variants = self._get_variants(block.get("media"))
+                    if variants:
+                        videos.append(variants[:1])
+
+        # Images and videos are numbered apart, as in the legacy format,
+        # so a post collected before keeps the names of its files
+        return [
+            *self._create_candidates(images, blog_name, post_slug),
+            *self._create_candidates(videos, blog_name, post_slug),
+        ]
+
+    def _get_variants(
+        self, media: list[dict[str, Any]] | dict[str, Any] | None
+    ) -> list[MediaVariant]:  # the widest first
+        # Image blocks list every size, video blocks have a single media object
+        media_objects = media if isinstance(media, list) else [media] if media else []
+        variants = [
+            MediaVariant(
+                url=HttpUrl(media_object["url"]), width=media_object.get("width") or 0
+            )
+            for media_object in media_objects
+            if media_object.get("url")
+        ]
+        return sorted(variants, key=lambda variant: variant.width, reverse=True)
+
+    def _create_candidates(
+        self, files: list[list[MediaVariant]], blog_name: str, post_slug: str | None
+    ) -> list[FileCandidate]:
+        # If the post has more than one file, numeric_suffix distinguishes them
+        return [
+            self._create_candidate(
+                variants, blog_name, post_slug, i if len(files) > 1 else None
+            )
+            for i, variants in enumerate(files, start=1)
+        ]
+
+
+def create_post_extractor() -> PostExtractor:
+    match settings.TUMBLR_POST_FORMAT:
+        case "npf":
+            return NpfPostExtractor()
+        case _:
+            return PostExtractor()
@@ -0,0 +1,37 @@
+import requests
+from config import settings
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth1
+
+
+class SessionPool:
+    def __init__(self) -> None:
+        # Sessions are shared by all threads, so connections to api.tumblr.com
+        # and the media hosts are kept alive and reused instead of reopened
+        self.api = self._create_session(pool_size=settings.TUMBLR_CRAWLER_WORKERS)
+        self.api.auth = OAuth1(
+            client_key=settings.TUMBLR_CONSUMER_KEY,
+            client_secret=settings.TUMBLR_CONSUMER_SECRET,
+            resource_owner_key=settings.TUMBLR_OAUTH_TOKEN,
+            resource_owner_secret=settings.TUMBLR_OAUTH_SECRET,
+        )
+        # Consumers download and resolvers send HEADs through the same pool,
+        # a large file is downloaded over several connections
+        self.media = self._create_session(
+            pool_size=settings.MAX_WORKERS
+            + settings.METADATA_RESOLVER_WORKERS
+            + settings.DOWNLOAD_SEGMENT_WORKERS
+        )
+
+    def _create_session(self, pool_size: int) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=settings.HTTP_POOL_HOSTS,  # hosts to keep pools for
+            pool_maxsize=pool_size,  # connections kept alive per host
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+
+session_pool = SessionPool()
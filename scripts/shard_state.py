@@ -0,0 +1,259 @@
+import contextlib
+import datetime
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections.abc import Generator
+from pathlib import Path
+from typing import Any
+
+from config import settings
+from pydantic import BaseModel
+
+
+def get_blog_shard(blog_name: str, shard_count: int) -> int:
+    # `hash` is salted per process, every shard and host must agree on the shard
+    digest = hashlib.blake2b(blog_name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shard_count
+
+
+class ShardRun(BaseModel):  # what a shard reports when it finishes a round
+    shard_index: int
+    started_at: datetime.datetime
+    is_complete: bool  # False if the shard was stopped
+    blogs: list[str]
+    failed_blogs: list[str]  # they keep their checkpoints
+    dashboard_since_id: int | None
+    report: dict[str, Any]
+
+
+class ShardState:
+    # Shared by the shards of a run through an SQLite file: the dedup keys claimed
+    # by the run, the MEGA folder ledger and the shards that finished each round.
+    # Every shard runs the same rounds, the last one to finish a round saves
+    # `config.json` as a full run and merges the run reports.
+    def __init__(self, db_file: Path | None = None) -> None:
+        if settings.SHARD_INDEX is None:
+            msg = "SHARD_INDEX is not set."
+            raise ValueError(msg)
+
+        self.shard_index = settings.SHARD_INDEX
+        self.round = 0
+        self.lock = threading.Lock()
+        db_file = db_file or settings.SHARD_STATE_FILE
+        # No WAL, it needs shared memory and shards on other hosts only share the file
+        self.connection = sqlite3.connect(
+            db_file, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        with self.lock:
+            self.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS shard_settings (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    shard_count INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS shard_runs (
+                    round INTEGER NOT NULL,
+                    shard_index INTEGER NOT NULL,
+                    started_at TEXT NOT NULL,
+                    result TEXT,
+                    PRIMARY KEY (round, shard_index)
+                );
+                CREATE TABLE IF NOT EXISTS run_claims (
+                    round INTEGER NOT NULL,
+                    key TEXT NOT NULL,
+                    PRIMARY KEY (round, key)
+                );
+                CREATE TABLE IF NOT EXISTS folder_ledger (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    used_bytes INTEGER NOT NULL,
+                    commit_cnt INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS ledger_reservations (
+                    shard_index INTEGER PRIMARY KEY,
+                    reserved_bytes INTEGER NOT NULL
+                );
+                """
+            )
+
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT shard_count FROM shard_settings"
+            ).fetchone()
+            if row is None:
+                connection.execute(
+                    "INSERT INTO shard_settings (id, shard_count) VALUES (1, ?)",
+                    (settings.SHARD_COUNT,),
+                )
+            elif row[0] != settings.SHARD_COUNT:
+                # Blogs would move between shards in the middle of a round
+                msg = (
+                    f"{db_file} was created for {row[0]} shards. "
+                    "Delete it to change SHARD_COUNT."
+                )
+                raise ValueError(msg)
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    @contextlib.contextmanager
+    def transaction(self) -> Generator[sqlite3.Connection]:
+        # IMMEDIATE takes the write lock up front, so shards wait for each other
+        # instead of failing on a lock upgrade. Also serialises `config.json` writes.
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def start_round(self, started_at: datetime.datetime) -> None:
+        with self.transaction() as connection:
+            last_round, own_last_round = connection.execute(
+                "SELECT MAX(round), "
+                "(SELECT MAX(round) FROM shard_runs WHERE shard_index = ?) "
+                "FROM shard_runs",
+                (self.shard_index,),
+            ).fetchone()
+            # A shard that was down joins the round the others are in
+            self.round = max((own_last_round or 0) + 1, last_round or 0)
+            connection.execute(
+                "INSERT INTO shard_runs (round, shard_index, started_at) "
+                "VALUES (?, ?, ?)",
+                (self.round, self.shard_index, started_at.isoformat()),
+            )
+            # Only the rounds some shard is still in need their claims
+            connection.execute(
+                "DELETE FROM run_claims WHERE round < ("
+                "SELECT MIN(last_round) FROM ("
+                "SELECT MAX(round) AS last_round FROM shard_runs GROUP BY shard_index))"
+            )
+        self.logger.info(
+            f"The shard {self.shard_index} of {settings.SHARD_COUNT} "
+            f"has started the round {self.round}."
+        )
+
+    def finish_round(self, shard_run: ShardRun) -> list[ShardRun] | None:
+        # Every shard of the round if this one is the last to finish, None otherwise
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE shard_runs SET result = ? WHERE round = ? AND shard_index = ?",
+                (shard_run.model_dump_json(), self.round, self.shard_index),
+            )
+            rows = connection.execute(
+                "SELECT result FROM shard_runs WHERE round = ? AND result IS NOT NULL",
+                (self.round,),
+            ).fetchall()
+
+        if len(rows) < settings.SHARD_COUNT:
+            self.logger.info(
+                f"The round {self.round} is finished by {len(rows)} of "
+                f"{settings.SHARD_COUNT} shards."
+            )
+            return None
+        return [ShardRun.model_validate_json(row[0]) for row in rows]
+
+    def claim(self, *keys: str) -> bool:  # False if any key is taken by the round
+        with self.transaction() as connection:
+            for key in keys:
+                row = connection.execute(
+                    "SELECT 1 FROM run_claims WHERE round = ? AND key = ?",
+                    (self.round, key),
+                ).fetchone()
+                if row is not None:
+                    return False
+            connection.executemany(
+                "INSERT OR IGNORE INTO run_claims (round, key) VALUES (?, ?)",
+                [(self.round, key) for key in keys],
+            )
+            return True
+
+    def is_claimed(self, key: str) -> bool:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM run_claims WHERE round = ? AND key = ?",
+                (self.round, key),
+            ).fetchone()
+        return row is not None
+
+    def get_folder_bytes(self) -> int:
+        with self.lock:
+            return self._get_folder_bytes(self.connection)
+
+    def get_folder_commit_cnt(self) -> int:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT commit_cnt FROM folder_ledger"
+            ).fetchone()
+        return int(row[0]) if row else 0
+
+    def reserve_folder_bytes(self, size: int) -> bool:
+        with self.transaction() as connection:
+            total_bytes = self._get_folder_bytes(connection)
+            if total_bytes + size > settings.MEGA_FOLDER_SIZE_LIMIT_BYTES:
+                return False
+            self._add_reserved_bytes(connection, size)
+            return True
+
+    def release_folder_bytes(self, size: int) -> None:
+        with self.transaction() as connection:
+            self._add_reserved_bytes(connection, -size)
+
+    def reset_reserved_folder_bytes(self) -> None:
+        # Bytes left reserved by a crashed run of this shard are given back
+        with self.transaction() as connection:
+            connection.execute(
+                "DELETE FROM ledger_reservations WHERE shard_index = ?",
+                (self.shard_index,),
+            )
+
+    def commit_folder_bytes(self, size: int) -> None:
+        with self.transaction() as connection:
+            self._add_reserved_bytes(connection, -size)
+            connection.execute(
+                "INSERT INTO folder_ledger (id, used_bytes, commit_cnt) "
+                "VALUES (1, ?, 1) ON CONFLICT (id) DO UPDATE SET "
+                "used_bytes = used_bytes + excluded.used_bytes, "
+                "commit_cnt = commit_cnt + 1",
+                (size,),
+            )
+
+    def set_used_folder_bytes(self, used_bytes: int, commit_cnt: int) -> bool:
+        # False if a shard has saved a file since `commit_cnt` was read
+        with self.transaction() as connection:
+            row = connection.execute("SELECT commit_cnt FROM folder_ledger").fetchone()
+            if (row[0] if row else 0) != commit_cnt:
+                return False
+            connection.execute(
+                "INSERT INTO folder_ledger (id, used_bytes, commit_cnt) "
+                "VALUES (1, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+                "used_bytes = excluded.used_bytes",
+                (used_bytes, commit_cnt),
+            )
+            return True
+
+    def _get_folder_bytes(self, connection: sqlite3.Connection) -> int:
+        # Used and reserved by every shard
+        row = connection.execute(
+            "SELECT COALESCE((SELECT used_bytes FROM folder_ledger), 0) "
+            "+ COALESCE((SELECT SUM(reserved_bytes) FROM ledger_reservations), 0)"
+        ).fetchone()
+        return int(row[0])
+
+    def _add_reserved_bytes(self, connection: sqlite3.Connection, size: int) -> None:
+        connection.execute(
+            "INSERT INTO ledger_reservations (shard_index, reserved_bytes) "
+            "VALUES (?, ?) ON CONFLICT (shard_index) DO UPDATE SET "
+            "reserved_bytes = reserved_bytes + excluded.reserved_bytes",
+            (self.shard_index, size),
+        )
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,63 @@
+import logging
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+from config import settings
+from file_metadata import FileMetadata
+
+
+class MemorySpool:
+    # Small files are downloaded to a tmpfs directory, so `mega-put` reads them
+    # from memory and the temp folder on disk only gets the large ones.
+    # `mega-put` needs a path, so a tmpfs is used instead of Python buffers.
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.used_bytes = 0
+        self.spool_dir: Path | None = None
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def open(self) -> None:
+        if not settings.SAVE_TO_MEGA or settings.SPOOL_DIR is None:
+            return
+
+        if not settings.SPOOL_DIR.parent.is_dir():
+            self.logger.info(
+                f"{settings.SPOOL_DIR.parent} does not exist. "
+                "All files will be downloaded to the disk."
+            )
+            return
+
+        settings.SPOOL_DIR.mkdir(exist_ok=True)
+        # A folder per run, so several runs can share the spool
+        self.spool_dir = Path(tempfile.mkdtemp(dir=settings.SPOOL_DIR))
+        self.logger.info(f"Small files will be spooled to {self.spool_dir}.")
+
+    def close(self) -> None:
+        if self.spool_dir is not None:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+            self.spool_dir = None
+
+    def assign(self, file: FileMetadata) -> None:  # moves the file to the spool
+        if self.spool_dir is None or file.known_size > settings.SPOOL_FILE_MAX_BYTES:
+            return
+
+        with self.lock:
+            if self.used_bytes + file.known_size > settings.SPOOL_MAX_BYTES:
+                return  # the spool is full, the file goes to the disk
+            self.used_bytes += file.known_size
+
+        file.local_path = self.spool_dir / file.local_path.name
+
+    def release(self, file: FileMetadata) -> None:  # the file has left the spool
+        if self.spool_dir is None or file.local_path.parent != self.spool_dir:
+            return
+
+        with self.lock:
+            self.used_bytes -= file.known_size
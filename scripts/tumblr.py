@@ -1,34 +1,49 @@
+import concurrent.futures
+import json
 import logging
 import queue
-import re
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
 from typing import Any
 
-import requests
 from config import settings
-from file_metadata import FileMetadata, FileMetadataHelper
-from helper import Helper
-from mega import MegaSaver
-from pydantic import HttpUrl
-from requests_oauthlib import OAuth1
-from tumblr_enum import TumblrPostType
+from dedup_store import DedupStore
+from file_metadata import FileCandidate, FileMetadata, MetadataResolver
+from helper import RuntimeConfig
+from mega import MegaFolderLedger, MegaRemoteManifest
+from metrics import metrics
+from post_extractor import create_post_extractor
+from shard_state import get_blog_shard
+from tumblr_api import tumblr_api
 
 # https://www.tumblr.com/docs/en/api/v2
 # https://api.tumblr.com/v2/user/info
 
+FileFuture = concurrent.futures.Future[FileMetadata | None]
 
-class TumblrCollector:
+
+@dataclass
+class BlogCursor:
+    blog_name: str
+    is_new_blog: bool
+    next_params: dict[str, Any] | None = None  # None before the first page
+    seen_urls: set[str] = field(default_factory=set)
+
+
+@dataclass
+class DashboardCursor:
+    since_id: int
+    offset: int = 0
+    is_complete: bool = True  # False if the dashboard didn't reach `since_id`
+
+
+class FollowedBlogReader:
+    # Pages `/user/following` and applies the blog filters. It needs no Mega
+    # session, so `run_shards` reads the blogs for its shards with it.
     def __init__(self) -> None:
         self.tumblr_api_limit = 20
-        self.url_pattern = re.compile(r"\s*(https?://[^\s]+)\s+([0-9]+)w\s*")
-        self.helper = Helper()
-        self.mega = MegaSaver()
-        self.file_meta = FileMetadataHelper()
-        self.oauth = OAuth1(
-            client_key=settings.TUMBLR_CONSUMER_KEY,
-            client_secret=settings.TUMBLR_CONSUMER_SECRET,
-            resource_owner_key=settings.TUMBLR_OAUTH_TOKEN,
-            resource_owner_secret=settings.TUMBLR_OAUTH_SECRET,
-        )
         logging.basicConfig(
             level=logging.INFO,
             format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
@@ -37,10 +52,8 @@ class TumblrCollector:
         self.logger = logging.getLogger(__name__)
 
     def get_current_user_followed_blog_cnt(self) -> int:
-        resp = requests.get(
-            "https://api.tumblr.com/v2/user/info", auth=self.oauth, timeout=10
-        )
-        return int(resp.json()["response"]["user"]["following"])
+        response = tumblr_api.get("user/info")
+        return int(response["user"]["following"])
 
     def get_followed_blogs(self) -> set[str]:
         self.logger.info("Start extracting followed blogs...")
@@ -50,13 +63,11 @@ class TumblrCollector:
         offset = 0
 
         while True:
-            resp = requests.get(
-                "https://api.tumblr.com/v2/user/following",
-                auth=self.oauth,
-                timeout=10,
+            response = tumblr_api.get(
+                "user/following",
                 params={"offset": offset, "limit": self.tumblr_api_limit},
             )
-            page_followed_blogs = resp.json()["response"]["blogs"]
+            page_followed_blogs = response["blogs"]
             page_blog_names = {blog["name"] for blog in page_followed_blogs}
             followed_blog_names.update(page_blog_names)
 
@@ -89,6 +100,61 @@ class TumblrCollector:
         )
         return filtered_blogs
 
+    def write_followed_blogs(self, blogs_file: Path) -> None:
+        blog_names = self.get_followed_blogs()
+        # Replaced at once, so a shard never reads a half written list
+        temp_file = blogs_file.with_suffix(".tmp")
+        temp_file.write_text(json.dumps(sorted(blog_names)))
+        temp_file.replace(blogs_file)
+
+
+class TumblrCollector:
+    def __init__(
+        self,
+        ledger: MegaFolderLedger,
+        dedup_store: DedupStore,
+        remote_manifest: MegaRemoteManifest,
+        runtime_config: RuntimeConfig,
+    ) -> None:
+        self.tumblr_api_limit = 20
+        self.tumblr_dashboard_max_offset = 250
+        self.dashboard_since_id: int | None = None  # saved for the next run
+        self.dashboard_head_params = {"limit": 1}
+        self.stop_event = threading.Event()  # set on shutdown, crawling stops
+        self.post_extractor = create_post_extractor()
+        self.runtime_config = runtime_config
+        self.ledger = ledger
+        self.dedup_store = dedup_store
+        self.remote_manifest = remote_manifest
+        self.resolver = MetadataResolver()
+        self.followed_blog_reader = FollowedBlogReader()
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def get_followed_blogs(self) -> set[str]:
+        if settings.SHARD_BLOGS_FILE is not None:
+            # `run_shards` pages `/user/following` once for all of its shards
+            blog_names = set(json.loads(settings.SHARD_BLOGS_FILE.read_text()))
+        else:
+            blog_names = self.followed_blog_reader.get_followed_blogs()
+
+        if settings.SHARD_INDEX is not None:
+            # A blog is always crawled by the same shard
+            blog_names = {
+                blog
+                for blog in blog_names
+                if get_blog_shard(blog, settings.SHARD_COUNT) == settings.SHARD_INDEX
+            }
+            self.logger.info(
+                f"{len(blog_names)} of the followed blogs belong to the shard "
+                f"{settings.SHARD_INDEX}."
+            )
+        return blog_names
+
     def produce_files_from_blogs(
         self, blog_names: set[str], file_queue: queue.Queue[FileMetadata | None]
     ) -> None:
@@ -97,7 +163,56 @@ class TumblrCollector:
         processed_keys: dict[str, set[str]] = {
             blog_name: set() for blog_name in blog_names
         }
-        previous_tumblr_blogs = self.helper.get_previous_run_tumblr_blogs()
+        cursors, is_first_run = self.prepare_cursors(blog_names)
+
+        dashboard_since_id = self.runtime_config.get_dashboard_since_id()
+        self.dashboard_since_id = dashboard_since_id
+        if settings.TUMBLR_USE_DASHBOARD and dashboard_since_id and not is_first_run:
+            # Followed blogs are read from a single feed,
+            # only new blogs need to be crawled one by one
+            followed_cursors = self.get_dashboard_cursors(cursors)
+            is_dashboard_complete = self._add_dashboard_files(
+                file_queue=file_queue,
+                processed_keys=processed_keys,
+                cursors=followed_cursors,
+                since_id=dashboard_since_id,
+            )
+            if is_dashboard_complete:
+                cursors = [
+                    cursor
+                    for cursor in cursors
+                    if cursor.blog_name not in followed_cursors
+                ]
+
+        elif settings.TUMBLR_USE_DASHBOARD:
+            # Posts published during this run will be read from the dashboard next time
+            self.dashboard_since_id = self._get_dashboard_head_id()
+
+        if settings.TUMBLR_CRAWLER_WORKERS > 1 and len(cursors) > 1:
+            self._crawl_blogs_concurrently(
+                file_queue=file_queue,
+                processed_keys=processed_keys,
+                cursors=cursors,
+                is_first_run=is_first_run,
+            )
+        else:
+            for cursor in cursors:
+                try:
+                    self._add_blog_files(
+                        file_queue=file_queue,
+                        processed_keys=processed_keys,
+                        cursor=cursor,
+                        is_first_run=is_first_run,
+                    )
+                except Exception:
+                    # The other blogs are still crawled, this one keeps its checkpoint
+                    self.logger.exception(f"Failed to crawl {cursor.blog_name}")
+                    self.runtime_config.fail_blog(cursor.blog_name)
+
+        self.logger.info("All files have been produced.")
+
+    def prepare_cursors(self, blog_names: set[str]) -> tuple[list[BlogCursor], bool]:
+        previous_tumblr_blogs = self.runtime_config.get_previous_run_tumblr_blogs()
         is_first_run = len(previous_tumblr_blogs) == 0
         if is_first_run:
             self.logger.info(
@@ -105,174 +220,389 @@ class TumblrCollector:
                 "`last_runtime` form `config.json` will be ignored."
             )
 
-        for blog_name in blog_names:
-            self._add_blog_files(
-                file_queue=file_queue,
-                processed_keys=processed_keys,
-                blog_name=blog_name,
-                is_first_run=is_first_run,
-                previous_tumblr_blogs=previous_tumblr_blogs,
+        cursors = [
+            BlogCursor(
+                blog_name=blog_name, is_new_blog=blog_name not in previous_tumblr_blogs
             )
+            for blog_name in blog_names
+        ]
+        for cursor in cursors:
+            if cursor.is_new_blog and not is_first_run:
+                self.logger.info(
+                    f"{cursor.blog_name} is a new blog. "
+                    "`last_runtime` form `config.json` will be ignored for it."
+                )
 
-        self.logger.info("All files have been produced.")
+        return cursors, is_first_run
 
-    def _add_blog_files(
+    def get_dashboard_cursors(self, cursors: list[BlogCursor]) -> dict[str, BlogCursor]:
+        # New blogs and blogs that failed in an earlier run are crawled one by one
+        return {
+            cursor.blog_name: cursor
+            for cursor in cursors
+            if not cursor.is_new_blog
+            and not self.runtime_config.is_blog_behind(cursor.blog_name)
+        }
+
+    def _get_dashboard_head_id(self) -> int | None:
+        response = tumblr_api.get("user/dashboard", params=self.dashboard_head_params)
+        return self.read_dashboard_head_id(response)
+
+    def read_dashboard_head_id(self, response: dict[str, Any]) -> int | None:
+        posts = response["posts"]
+        return int(posts[0]["id"]) if posts else None
+
+    def _add_dashboard_files(
         self,
         file_queue: queue.Queue[FileMetadata | None],
         processed_keys: dict[str, set[str]],
-        blog_name: str,
-        is_first_run: bool,
-        previous_tumblr_blogs: list[str],
-    ) -> None:
-        offset = 0
-        is_new_blog = blog_name not in previous_tumblr_blogs
-        if is_new_blog and not is_first_run:
-            self.logger.info(
-                f"{blog_name} is a new blog. "
-                "`last_runtime` form `config.json` will be ignored for it."
+        cursors: dict[str, BlogCursor],
+        since_id: int,
+    ) -> bool:  # False if the dashboard didn't reach `since_id`
+        self.logger.info(f"Start reading the dashboard since the post {since_id}...")
+        dashboard_cursor = DashboardCursor(since_id=since_id)
+
+        while not self.is_crawl_stopped():
+            response = tumblr_api.get(
+                "user/dashboard", params=self.get_dashboard_params(dashboard_cursor)
             )
+            candidates_by_blog = self.route_dashboard_posts(response["posts"], cursors)
+            for blog_name, candidates in candidates_by_blog.items():
+                self._add_files(
+                    file_queue, processed_keys, cursors[blog_name], candidates
+                )
 
-        while (
-            len(processed_keys[blog_name]) < settings.TUMBLR_FILE_LIMIT_PER_BLOG
-            and self.mega.get_mega_folder_size() < settings.MEGA_FOLDER_SIZE_LIMIT_BYTES
-        ):
-            params = {"limit": self.tumblr_api_limit, "offset": offset}
-
-            if is_first_run or is_new_blog:
-                # Don't use 'after' parameter for the first run or new blogs
-                pass
-            else:
-                last_runtime = self.helper.get_last_runtime_in_unix()
-                params["after"] = last_runtime
-
-            resp = requests.get(
-                f"https://api.tumblr.com/v2/blog/{blog_name}.tumblr.com/posts",
-                auth=self.oauth,
-                params=params,
-                timeout=10,
+            if not self.advance_dashboard(dashboard_cursor, response):
+                break
+
+        return dashboard_cursor.is_complete
+
+    def is_crawl_stopped(self) -> bool:
+        return self.ledger.is_full() or self.stop_event.is_set()
+
+    def get_dashboard_params(self, dashboard_cursor: DashboardCursor) -> dict[str, Any]:
+        return {
+            "limit": self.tumblr_api_limit,
+            "offset": dashboard_cursor.offset,
+            "since_id": dashboard_cursor.since_id,
+            **self.post_extractor.params,
+        }
+
+    def advance_dashboard(
+        self, dashboard_cursor: DashboardCursor, response: dict[str, Any]
+    ) -> bool:  # True if the dashboard has more pages to read
+        if len(response["posts"]) < self.tumblr_api_limit:
+            return False
+
+        dashboard_cursor.offset += self.tumblr_api_limit
+        if dashboard_cursor.offset >= self.tumblr_dashboard_max_offset:
+            self.logger.warning(
+                "The dashboard can't be read any deeper. "
+                "Falling back to crawling every blog..."
+            )
+            dashboard_cursor.is_complete = False
+            return False
+        return True
+
+    def route_dashboard_posts(
+        self, posts: list[dict[str, Any]], cursors: dict[str, BlogCursor]
+    ) -> dict[str, list[FileCandidate]]:
+        page_since_id = max((int(post["id"]) for post in posts), default=0)
+        self.dashboard_since_id = max(page_since_id, self.dashboard_since_id or 0)
+
+        candidates_by_blog: dict[str, list[FileCandidate]] = {}
+        for post in posts:
+            blog_name = post["blog_name"]
+            if blog_name not in cursors:  # filtered out or crawled as a new blog
+                continue
+            candidates_by_blog.setdefault(blog_name, []).extend(
+                self.post_extractor.get_post_candidates(post, blog_name)
             )
-            posts = resp.json()["response"]["posts"]
+        return candidates_by_blog
 
-            if not posts:
-                self.logger.warning(
-                    f"The end of the blog {blog_name} has been reached."
+    def _crawl_blogs_concurrently(
+        self,
+        file_queue: queue.Queue[FileMetadata | None],
+        processed_keys: dict[str, set[str]],
+        cursors: list[BlogCursor],
+        is_first_run: bool,
+    ) -> None:
+        # Blogs are crawled a page at a time and put back at the end of the queue,
+        # so a large blog can't keep a crawler busy while the others wait
+        blog_queue: queue.Queue[BlogCursor | None] = queue.Queue()
+        for cursor in cursors:
+            blog_queue.put(cursor)
+
+        crawler_cnt = min(settings.TUMBLR_CRAWLER_WORKERS, len(cursors))
+        self.logger.info(f"Crawling blogs with {crawler_cnt} crawlers...")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=crawler_cnt) as executor:
+            for _ in range(crawler_cnt):
+                executor.submit(
+                    self._blog_crawler_worker,
+                    blog_queue,
+                    file_queue,
+                    processed_keys,
+                    is_first_run,
                 )
+
+            blog_queue.join()
+
+            for _ in range(crawler_cnt):
+                blog_queue.put(None)
+
+    def _blog_crawler_worker(
+        self,
+        blog_queue: queue.Queue[BlogCursor | None],
+        file_queue: queue.Queue[FileMetadata | None],
+        processed_keys: dict[str, set[str]],
+        is_first_run: bool,
+    ) -> None:
+        while True:
+            cursor: BlogCursor | None = blog_queue.get()
+            if cursor is None:
                 break
 
-            for post in posts:
-                is_repost = "parent_post_url" in post
-                if is_repost:
-                    continue
-
-                match post["type"]:
-                    case TumblrPostType.TEXT.value:
-                        self._add_files_from_text_post(
-                            file_queue=file_queue,
-                            processed_keys=processed_keys,
-                            post_html=post,
-                            blog_name=blog_name,
-                        )
-
-                    case TumblrPostType.PHOTO.value:
-                        self._add_files_from_photo_post(
-                            file_queue=file_queue,
-                            processed_keys=processed_keys,
-                            post_html=post,
-                            blog_name=blog_name,
-                        )
-
-                    case TumblrPostType.ANSWER.value:
-                        continue  # /posts does not support filtering by multiple types
-
-                    case _:
-                        self.logger.info(f"Not supported post type: {post['type']}.")
-
-            if len(posts) < self.tumblr_api_limit:
-                self.logger.warning(
-                    f"The end of the blog {blog_name} has been reached."
+            try:
+                # Only one crawler holds a blog at a time,
+                # so its processed keys are never shared between threads
+                has_next_page = self._add_blog_page(
+                    file_queue=file_queue,
+                    processed_keys=processed_keys,
+                    cursor=cursor,
+                    is_first_run=is_first_run,
                 )
-                break
+                if has_next_page:
+                    blog_queue.put(cursor)
+                else:
+                    self.finish_blog(cursor)
 
-            offset += self.tumblr_api_limit
+            except Exception:
+                self.logger.exception(f"Failed to crawl {cursor.blog_name}")
+                self.runtime_config.fail_blog(cursor.blog_name)
 
-    def _add_file(
+            finally:
+                blog_queue.task_done()
+
+    def _add_blog_files(
         self,
         file_queue: queue.Queue[FileMetadata | None],
         processed_keys: dict[str, set[str]],
-        file: FileMetadata | None,
-        blog_name: str,
+        cursor: BlogCursor,
+        is_first_run: bool,
     ) -> None:
-        blog_file_cnt = len(processed_keys[blog_name])
-        if blog_file_cnt < settings.TUMBLR_FILE_LIMIT_PER_BLOG and file:
-            file_key = file.etag if file.etag else file.url
-            if file_key in processed_keys[blog_name]:
-                self.logger.info(f"A duplicate found, key: {file_key}. Skipping...")
-            else:
-                processed_keys[blog_name].add(file_key)
-                file_queue.put(file)
-
-    def _add_files_from_text_post(
+        while self._add_blog_page(
+            file_queue=file_queue,
+            processed_keys=processed_keys,
+            cursor=cursor,
+            is_first_run=is_first_run,
+        ):
+            pass
+
+        self.finish_blog(cursor)
+
+    def finish_blog(self, cursor: BlogCursor) -> None:
+        # A blog cut short by a shutdown keeps its old checkpoint
+        # and is crawled again by the next run
+        if not self.stop_event.is_set():
+            self.runtime_config.complete_blog(cursor.blog_name)
+
+    def _add_blog_page(
         self,
         file_queue: queue.Queue[FileMetadata | None],
         processed_keys: dict[str, set[str]],
-        post_html: dict[str, Any],
-        blog_name: str,
+        cursor: BlogCursor,
+        is_first_run: bool,
+    ) -> bool:  # True if the blog has more pages to crawl
+        if self.is_blog_done(processed_keys, cursor.blog_name):
+            return False
+
+        params = self.get_page_params(cursor, is_first_run)
+        response = tumblr_api.get(
+            f"blog/{cursor.blog_name}.tumblr.com/posts", params=params
+        )
+        # Collect the whole page first, so its HEAD requests run concurrently
+        candidates = self.get_page_candidates(cursor, response["posts"])
+        self._add_files(file_queue, processed_keys, cursor, candidates)
+        return self.advance_cursor(cursor, params, response)
+
+    def is_blog_done(self, processed_keys: dict[str, set[str]], blog_name: str) -> bool:
+        return (
+            len(processed_keys[blog_name]) >= settings.TUMBLR_FILE_LIMIT_PER_BLOG
+            or self.is_crawl_stopped()
+        )
+
+    def get_page_params(self, cursor: BlogCursor, is_first_run: bool) -> dict[str, Any]:
+        if cursor.next_params is not None:
+            params = cursor.next_params
+        elif is_first_run or cursor.is_new_blog:
+            # Don't use 'after' parameter for the first run or new blogs
+            params = {"limit": self.tumblr_api_limit}
+        else:
+            last_runtime = self.runtime_config.get_last_runtime_in_unix(
+                cursor.blog_name
+            )
+            params = {"limit": self.tumblr_api_limit, "after": last_runtime}
+
+        # The cursor from `_links` may not carry over the format of the posts
+        return {**params, **self.post_extractor.params}
+
+    def get_page_candidates(
+        self, cursor: BlogCursor, posts: list[dict[str, Any]]
+    ) -> list[FileCandidate]:
+        candidates: list[FileCandidate] = []
+        for post in posts:
+            candidates.extend(
+                self.post_extractor.get_post_candidates(post, cursor.blog_name)
+            )
+        return candidates
+
+    def advance_cursor(
+        self, cursor: BlogCursor, params: dict[str, Any], response: dict[str, Any]
+    ) -> bool:  # True if the blog has more pages to crawl
+        posts = response["posts"]
+        if len(posts) < self.tumblr_api_limit:
+            self.logger.warning(
+                f"The end of the blog {cursor.blog_name} has been reached."
+            )
+            return False
+
+        # Follow the cursor Tumblr returns instead of growing the offset
+        next_link = response.get("_links", {}).get("next")
+        if next_link:
+            cursor.next_params = next_link["query_params"]
+        elif "after" in params:  # `before` and `after` can't be combined
+            offset = int(params.get("offset", 0)) + self.tumblr_api_limit
+            cursor.next_params = {**params, "offset": offset}
+        else:
+            # `before` the oldest post alone would skip the posts published in the
+            # same second, so they are paged by offset
+            oldest_timestamp = min(int(post["timestamp"]) for post in posts)
+            before = oldest_timestamp + 1
+            offset = sum(int(post["timestamp"]) == oldest_timestamp for post in posts)
+            if params.get("before") == before:  # the whole page is from that second
+                offset += int(params.get("offset", 0))
+            cursor.next_params = {**params, "before": before, "offset": offset}
+        return True
+
+    def _add_files(
+        self,
+        file_queue: queue.Queue[FileMetadata | None],
+        processed_keys: dict[str, set[str]],
+        cursor: BlogCursor,
+        candidates: list[FileCandidate],
     ) -> None:
-        content_raw: str = post_html["trail"][0]["content_raw"]
-        post_slug: str | None = post_html["slug"]
-
-        # Split content_raw as a post can have multiple images/gifs
-        srcset_matches = re.findall(r'srcset="([^"]+)"', content_raw)
-        if srcset_matches:
-            # If the post has more than one image/gif,
-            # use numeric_suffix to distinguish them
-            numeric_suffix = 1 if len(srcset_matches) > 1 else None
-            for srcset_content in srcset_matches:
-                file_candidates = srcset_content.split(",")
-                # Get the file with the highest resolution
-                last_candidate_url = HttpUrl(file_candidates[-1].split()[0])
-
-                file = self.file_meta.create_file_metadata(
-                    url=last_candidate_url,
-                    author=blog_name,
-                    post_slug=post_slug,
-                    numeric_suffix=numeric_suffix,
-                )
-                self._add_file(file_queue, processed_keys, file, blog_name)
-                if numeric_suffix is not None:
-                    numeric_suffix += 1
-
-        # Some text blogs have videos
-        if settings.TUMBLR_COLLECT_VIDEOS:
-            srcset_matches = re.findall(r'<source src="([^"]+)"', content_raw)
-            if srcset_matches:
-                numeric_suffix = 1 if len(srcset_matches) > 1 else None
-                for video_url in srcset_matches:
-                    file = self.file_meta.create_file_metadata(
-                        url=video_url,
-                        author=blog_name,
-                        post_slug=post_slug,
-                        numeric_suffix=numeric_suffix,
+        pending_candidates = deque(candidates)
+        while batch := self.select_candidates(
+            processed_keys, cursor, pending_candidates
+        ):
+            futures: list[FileFuture | None] = [
+                None if is_known else self.resolver.submit(candidate)
+                for candidate, is_known in batch
+            ]
+            # Files are added in the crawl order, whatever order HEADs complete in,
+            # so the per-blog limit and duplicates resolve the same way every run
+            for (candidate, _), future in zip(batch, futures, strict=True):
+                if future is None:
+                    self.add_collected_file(
+                        processed_keys, str(candidate.url), candidate
                     )
-                    self._add_file(file_queue, processed_keys, file, blog_name)
-                    if numeric_suffix is not None:
-                        numeric_suffix += 1
+                else:
+                    self._add_file(
+                        file_queue, processed_keys, future.result(), cursor.blog_name
+                    )
+
+    def select_candidates(
+        self,
+        processed_keys: dict[str, set[str]],
+        cursor: BlogCursor,
+        pending_candidates: deque[FileCandidate],
+    ) -> list[tuple[FileCandidate, bool]]:  # candidates, are they already known
+        # HEAD requests are only sent for as many files as the blog can still take,
+        # the next batch is resolved only if some of them are rejected
+        free_slot_cnt = settings.TUMBLR_FILE_LIMIT_PER_BLOG - len(
+            processed_keys[cursor.blog_name]
+        )
+
+        batch: list[tuple[FileCandidate, bool]] = []
+        while pending_candidates and len(batch) < free_slot_cnt:
+            candidate = pending_candidates.popleft()
+            url = str(candidate.url)
+            if url in cursor.seen_urls or (
+                settings.DEDUP_ACROSS_BLOGS and self.dedup_store.is_claimed(url)
+            ):
+                self.logger.info(f"A duplicate found, key: {url}. Skipping...")
+                metrics.count_skip("duplicate", cursor.blog_name)
+                continue
+            cursor.seen_urls.add(url)
+
+            # Known files are skipped without a HEAD request
+            batch.append((candidate, self._is_known_file(candidate)))
+
+        return batch
+
+    def _is_known_file(self, candidate: FileCandidate) -> bool:
+        # Collected by previous runs or already on MEGA. A smaller size chosen by
+        # TUMBLR_IMAGE_MAX_KB in an earlier run has its own URL and name.
+        for variant in candidate.get_variants():
+            filename = self.resolver.get_filename(variant)
+            if self.remote_manifest.contains(filename) or self.dedup_store.is_collected(
+                variant.blog_name, url=str(variant.url), filename=filename
+            ):
+                return True
+        return False
+
+    def add_collected_file(
+        self,
+        processed_keys: dict[str, set[str]],
+        file_key: str,
+        candidate: FileCandidate | FileMetadata,
+    ) -> None:
+        # Collected files still count towards the limit, as they did on disk
+        if (
+            len(processed_keys[candidate.blog_name])
+            < settings.TUMBLR_FILE_LIMIT_PER_BLOG
+        ):
+            processed_keys[candidate.blog_name].add(file_key)
+            self.logger.info(f"{candidate.url} has already been collected. Skipping...")
+            metrics.count_skip("collected", candidate.blog_name)
 
-    def _add_files_from_photo_post(
+    def _add_file(
         self,
         file_queue: queue.Queue[FileMetadata | None],
         processed_keys: dict[str, set[str]],
-        post_html: dict[str, Any],
+        file: FileMetadata | None,
         blog_name: str,
     ) -> None:
-        # Get the photo with the highest resolution
-        url: str = post_html["photos"][0]["original_size"]["url"]
-        post_slug: str | None = post_html["slug"]
-
-        file = self.file_meta.create_file_metadata(
-            url=url,
-            author=blog_name,
-            post_slug=post_slug,
-            numeric_suffix=None,  # a single photo does not require numbering
-        )
-        self._add_file(file_queue, processed_keys, file, blog_name)
+        if file and self.accept_file(processed_keys, file, blog_name):
+            file_queue.put(file)
+
+    def accept_file(
+        self, processed_keys: dict[str, set[str]], file: FileMetadata, blog_name: str
+    ) -> bool:  # True if the file should be queued
+        blog_file_cnt = len(processed_keys[blog_name])
+        if blog_file_cnt >= settings.TUMBLR_FILE_LIMIT_PER_BLOG:
+            return False
+
+        file_key = file.etag if file.etag else str(file.url)
+        if file_key in processed_keys[blog_name]:
+            self.logger.info(f"A duplicate found, key: {file_key}. Skipping...")
+            metrics.count_skip("duplicate", blog_name)
+            return False
+
+        if file.etag and self.dedup_store.is_collected(blog_name, etag=file.etag):
+            self.add_collected_file(processed_keys, file_key, file)
+            return False
+
+        if settings.DEDUP_ACROSS_BLOGS and not self.dedup_store.claim(
+            file_key, str(file.url)
+        ):
+            self.logger.info(
+                f"A duplicate from another blog found, key: {file_key}. Skipping..."
+            )
+            metrics.count_skip("duplicate_other_blog", blog_name)
+            return False
+
+        processed_keys[blog_name].add(file_key)
+        self.runtime_config.add_pending_file(blog_name)
+        return True
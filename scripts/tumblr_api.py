@@ -0,0 +1,173 @@
+import logging
+import random
+import threading
+import time
+from collections.abc import Mapping
+from typing import Any, Protocol
+
+from config import settings
+from metrics import metrics
+from sessions import session_pool
+
+# https://www.tumblr.com/docs/en/api/v2#rate-limits
+
+
+class ApiResponse(Protocol):  # `requests` and `httpx` responses
+    @property
+    def status_code(self) -> int: ...
+
+    @property
+    def headers(self) -> Mapping[str, str]: ...
+
+    def raise_for_status(self) -> object: ...
+
+    def json(self) -> Any: ...  # noqa: ANN401
+
+
+class TokenBucket:
+    def __init__(self, capacity: int, refill_period_s: float) -> None:
+        self.capacity = capacity
+        self.refill_rate = capacity / refill_period_s  # tokens per second
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate
+        )
+        self.updated_at = now
+
+    def reserve(self) -> float:  # takes a token, returns seconds to wait for it
+        self.refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.refill_rate)
+
+    def wait_time(self) -> float:
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.refill_rate)
+
+    def sync(self, remaining: int) -> None:  # the API knows better what is left
+        self.refill()
+        self.tokens = min(self.tokens, float(remaining))
+
+
+class TumblrApiClient:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.buckets = {
+            "hour": TokenBucket(settings.TUMBLR_API_CALLS_PER_HOUR, 60 * 60),
+            "day": TokenBucket(settings.TUMBLR_API_CALLS_PER_DAY, 24 * 60 * 60),
+        }
+        self.blocked_until = 0.0  # set by 429/5xx responses and exhausted limits
+        self.failure_cnt = 0
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def budget(self) -> dict[str, int]:  # calls left in each window
+        with self.lock:
+            for bucket in self.buckets.values():
+                bucket.refill()
+            return {name: int(bucket.tokens) for name, bucket in self.buckets.items()}
+
+    @property
+    def wait_time(self) -> float:  # seconds until the next call can be made
+        with self.lock:
+            blocked_s = self.blocked_until - time.monotonic()
+            return max(
+                0.0,
+                blocked_s,
+                *(bucket.wait_time() for bucket in self.buckets.values()),
+            )
+
+    def schedule(self) -> float:  # reserves a call, returns seconds to wait for it
+        with self.lock:
+            blocked_s = self.blocked_until - time.monotonic()
+            return max(
+                0.0, blocked_s, *(bucket.reserve() for bucket in self.buckets.values())
+            )
+
+    def record_response(
+        self, status_code: int, headers: Mapping[str, str]
+    ) -> float | None:
+        # Returns seconds to back off before a retry, None if the call succeeded
+        with self.lock:
+            for name, bucket in self.buckets.items():
+                remaining = headers.get(f"X-Ratelimit-Per{name}-Remaining")
+                reset_s = headers.get(f"X-Ratelimit-Per{name}-Reset")
+                if remaining is None:
+                    continue
+
+                bucket.sync(int(remaining))
+                if int(remaining) <= 0 and reset_s is not None:
+                    self.blocked_until = max(
+                        self.blocked_until, time.monotonic() + float(reset_s)
+                    )
+
+            is_retryable = status_code == 429 or status_code >= 500
+            if not is_retryable:
+                self.failure_cnt = 0
+                return None
+
+            self.failure_cnt += 1
+            retry_after = headers.get("Retry-After")
+            backoff_s = (
+                float(retry_after)
+                if retry_after and retry_after.isdigit()
+                # Jitter keeps the crawlers from retrying all at once
+                else min(settings.TUMBLR_API_MAX_BACKOFF_S, 2**self.failure_cnt)
+                * random.uniform(0.5, 1)  # noqa: S311
+            )
+            self.blocked_until = max(self.blocked_until, time.monotonic() + backoff_s)
+            return backoff_s
+
+    def get_url(self, path: str) -> str:
+        return f"{settings.TUMBLR_API_URL}/{path}"
+
+    def schedule_call(self) -> float:  # like `schedule`, for the caller to wait
+        wait_s = self.schedule()
+        if wait_s > 0:
+            self.logger.info(f"Waiting {wait_s:.1f}s for the Tumblr API limits...")
+            metrics.observe("api_wait", wait_s)
+        return wait_s
+
+    def should_retry(self, path: str, resp: ApiResponse, attempt: int) -> bool:
+        backoff_s = self.record_response(resp.status_code, resp.headers)
+        if backoff_s is None or attempt == settings.TUMBLR_API_MAX_RETRIES:
+            return False
+
+        self.logger.warning(
+            f"The Tumblr API returned {resp.status_code} for {path}. "
+            f"Retrying in {backoff_s:.1f}s ({attempt + 1}/"
+            f"{settings.TUMBLR_API_MAX_RETRIES})..."
+        )
+        return True
+
+    def read_response(self, resp: ApiResponse) -> dict[str, Any]:
+        resp.raise_for_status()
+        response: dict[str, Any] = resp.json()["response"]
+        return response
+
+    def get(self, path: str, params: dict[str, Any] | None = None) -> dict[str, Any]:
+        # The async pipeline makes the same calls, only its waiting and I/O differ
+        for attempt in range(settings.TUMBLR_API_MAX_RETRIES + 1):
+            wait_s = self.schedule_call()
+            if wait_s > 0:
+                time.sleep(wait_s)
+
+            with metrics.measure("api"):
+                resp = session_pool.api.get(
+                    self.get_url(path), params=params, timeout=10
+                )
+            if not self.should_retry(path, resp, attempt):
+                break
+
+        return self.read_response(resp)
+
+
+tumblr_api = TumblrApiClient()
@@ -0,0 +1,195 @@
+import datetime
+import json
+import logging
+import queue
+import threading
+from collections import Counter
+from collections.abc import Iterator
+from pathlib import Path
+from typing import IO
+
+from consumer import Consumer
+from dedup_store import DedupStore
+from file_metadata import FileMetadata
+from helper import RuntimeConfig
+from metrics import metrics
+from pydantic import BaseModel
+
+
+class BlogTotals(BaseModel):
+    files: int = 0
+    bytes: int = 0
+
+
+class WorkPlanSummary(BaseModel):
+    started_at: datetime.datetime
+    is_complete: bool  # False if the planner was stopped
+    followed_blogs: list[str]
+    dashboard_since_id: int | None
+    crawled_blogs: list[str]
+    failed_blogs: list[str] = []  # they keep their checkpoints
+    files: int
+    bytes: int
+    unknown_size_files: int  # FETCH_MODE=get leaves sizes to the download
+    blogs: dict[str, BlogTotals]
+
+
+class WorkPlanWriter:
+    # Writes the files the planner found as JSON Lines, a line per file
+    # and the totals in the last line.
+    def __init__(self, path: Path, consumer: Consumer) -> None:
+        self.path = path
+        self.temp_path = path.with_suffix(f"{path.suffix}.tmp")
+        self.consumer = consumer
+        self.blogs: dict[str, BlogTotals] = {}
+        self.unknown_size_files = 0
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def writer_worker(self, file_queue: queue.Queue[FileMetadata | None]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.temp_path.open("w") as f:
+            while True:
+                file = file_queue.get()
+                if file is None:
+                    file_queue.task_done()
+                    break
+
+                try:
+                    self._write_file(f, file)
+                except Exception:
+                    self.logger.exception(f"Failed to plan {file.url}")
+                finally:
+                    file_queue.task_done()
+
+    def _write_file(self, f: IO[str], file: FileMetadata) -> None:
+        if file.size is None:
+            self.unknown_size_files += 1
+        elif not self.consumer.check_file(file):  # planned files fill the folder
+            return
+
+        record = file.model_dump(mode="json", exclude={"content_hash"})
+        f.write(json.dumps({"type": "file", **record}) + "\n")
+        totals = self.blogs.setdefault(file.blog_name, BlogTotals())
+        totals.files += 1
+        totals.bytes += file.size or 0
+
+    def close(
+        self,
+        runtime_config: RuntimeConfig,
+        followed_blog_names: set[str],
+        dashboard_since_id: int | None,
+        *,
+        is_complete: bool,
+    ) -> WorkPlanSummary:
+        summary = WorkPlanSummary(
+            started_at=runtime_config.started_at,
+            is_complete=is_complete,
+            followed_blogs=sorted(followed_blog_names),
+            dashboard_since_id=dashboard_since_id,
+            crawled_blogs=runtime_config.get_crawled_blogs(),
+            failed_blogs=runtime_config.get_failed_blogs(),
+            files=sum(totals.files for totals in self.blogs.values()),
+            bytes=sum(totals.bytes for totals in self.blogs.values()),
+            unknown_size_files=self.unknown_size_files,
+            blogs=self.blogs,
+        )
+        with self.temp_path.open("a") as f:
+            record = summary.model_dump(mode="json")
+            f.write(json.dumps({"type": "summary", **record}) + "\n")
+        # Renamed when complete, so a crash can't leave half a plan
+        self.temp_path.replace(self.path)
+
+        unknown_size = (
+            f", {summary.unknown_size_files} of unknown size"
+            if summary.unknown_size_files
+            else ""
+        )
+        self.logger.info(
+            f"{summary.files} files ({summary.bytes / (1024 * 1024):.1f} MB"
+            f"{unknown_size}) from {len(summary.blogs)} blogs "
+            f"have been planned to {self.path}."
+        )
+        return summary
+
+
+class WorkPlan:
+    # A plan read back by the executor. Its lines can be split between executors,
+    # a blog is only checkpointed if all its planned files are in the same part.
+    def __init__(
+        self, files: list[FileMetadata], summary: WorkPlanSummary | None
+    ) -> None:
+        self.files = files
+        self.summary = summary
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s]{%(filename)s:%(lineno)d}%(levelname)s - %(message)s",
+            filename="logs/art_collector.log",
+        )
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def load(cls, path: Path) -> "WorkPlan":
+        files: list[FileMetadata] = []
+        summary: WorkPlanSummary | None = None
+        with path.open() as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.pop("type") == "summary":
+                    summary = WorkPlanSummary.model_validate(record)
+                else:
+                    files.append(FileMetadata.model_validate(record))
+        return cls(files, summary)
+
+    @property
+    def is_whole(self) -> bool:  # every file of a finished plan, nothing split off
+        return (
+            self.summary is not None
+            and self.summary.is_complete
+            and len(self.files) == self.summary.files
+        )
+
+    def get_complete_blogs(self) -> list[str]:  # crawled blogs with all their files
+        if self.summary is None:
+            return []
+
+        file_cnts = Counter(file.blog_name for file in self.files)
+        return [
+            blog_name
+            for blog_name in self.summary.crawled_blogs
+            if file_cnts[blog_name]
+            == self.summary.blogs.get(blog_name, BlogTotals()).files
+        ]
+
+    def iter_files(
+        self,
+        dedup_store: DedupStore,
+        runtime_config: RuntimeConfig,
+        stop_event: threading.Event,
+    ) -> Iterator[FileMetadata]:  # the files to transfer, in the planned order
+        self.logger.info(f"Start transferring {len(self.files)} planned files...")
+        for file in self.files:
+            if stop_event.is_set():
+                return  # the blogs aren't checkpointed, the plan can be run again
+
+            # Transferred by an earlier executor or a run after the plan
+            if dedup_store.is_collected(
+                file.blog_name, url=str(file.url), filename=file.mega_path.name
+            ):
+                self.logger.info(f"{file.url} has already been collected. Skipping...")
+                metrics.count_skip("collected", file.blog_name)
+                continue
+
+            runtime_config.add_pending_file(file.blog_name)
+            yield file
+
+        # A blog is checkpointed when its last queued file is finished
+        for blog_name in self.get_complete_blogs():
+            runtime_config.complete_blog(blog_name)
+        self.logger.info("All planned files have been queued.")
@@ -0,0 +1,17 @@
+import logging
+import sys
+from pathlib import Path
+
+import pytest
+
+# The scripts import each other by module name
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+
+# The `basicConfig` of every class is a no-op, nothing is logged to `logs/`
+logging.basicConfig(handlers=[logging.NullHandler()])
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,156 @@
+import asyncio
+import queue
+from collections.abc import AsyncIterator
+from pathlib import Path
+from unittest.mock import Mock
+
+import httpx
+import pytest
+from async_pipeline import AsyncPipeline
+from config import settings
+from consumer import Consumer
+from dedup_store import DedupStore
+from file_metadata import FileMetadata
+
+MB = 1024 * 1024
+
+
+class UnreadBody(httpx.AsyncByteStream):  # fails the test if the body is read
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        pytest.fail("The body of a rejected file was read.")
+        yield b""
+
+
+def get_file(tmp_path: Path) -> FileMetadata:  # as queued in get mode
+    return FileMetadata(
+        url="https://media.example/a.png",
+        blog_name="a",
+        etag=None,
+        local_path=tmp_path / "a.png",
+        mega_path=Path("/Root/a/a.png"),
+        size=None,
+    )
+
+
+@pytest.fixture
+def consumer(monkeypatch: pytest.MonkeyPatch) -> Consumer:
+    monkeypatch.setattr(settings, "FETCH_MODE", "get")
+    consumer = Consumer(
+        ledger=Mock(),
+        dedup_store=Mock(),
+        uploader=Mock(),
+        remote_manifest=Mock(),
+        runtime_config=Mock(),
+    )
+    consumer.dedup_store.is_collected.return_value = False
+    consumer.remote_manifest.contains.return_value = False
+    consumer.ledger.reserve.return_value = True
+    consumer.helper = Mock()
+    return consumer
+
+
+def consume(consumer: Consumer, file: FileMetadata, headers: dict[str, str]) -> Mock:
+    resp = Mock(headers=headers)
+    consumer.helper.open_download.return_value = resp
+    file_queue: queue.Queue[FileMetadata | None] = queue.Queue()
+    file_queue.put(file)
+    file_queue.put(None)
+    consumer.consumer_worker(file_queue, Mock())
+    return resp
+
+
+def test_a_file_over_the_size_limit_is_dropped_unread(
+    tmp_path: Path, consumer: Consumer
+):
+    resp = consume(consumer, get_file(tmp_path), {"content-length": str(20 * MB)})
+
+    resp.close.assert_called_once()
+    consumer.helper.download_file.assert_not_called()
+    consumer.ledger.reserve.assert_not_called()
+    consumer.runtime_config.finish_pending_file.assert_called_once_with("a")
+
+
+def test_a_repost_is_found_by_its_etag(tmp_path: Path, consumer: Consumer):
+    consumer.dedup_store.is_collected.return_value = True
+    resp = consume(
+        consumer, get_file(tmp_path), {"content-length": str(MB), "ETag": '"e1"'}
+    )
+
+    consumer.dedup_store.is_collected.assert_called_once_with("a", etag="e1")
+    resp.close.assert_called_once()
+    consumer.helper.download_file.assert_not_called()
+
+
+def test_an_accepted_file_is_read_from_the_same_response(
+    tmp_path: Path, consumer: Consumer
+):
+    file = get_file(tmp_path)
+    consumer.helper.download_file.return_value = 0.0
+    resp = consume(consumer, file, {"content-length": str(MB)})
+
+    consumer.ledger.reserve.assert_called_once_with(MB)
+    consumer.helper.download_file.assert_called_once_with(file, resp)
+    consumer.uploader.submit.assert_called_once_with(file, consumer.finish_file)
+    consumer.runtime_config.finish_pending_file.assert_not_called()
+
+
+def test_a_failed_download_releases_the_reserved_bytes(
+    tmp_path: Path, consumer: Consumer
+):
+    consumer.helper.download_file.side_effect = OSError
+    resp = consume(consumer, get_file(tmp_path), {"content-length": str(MB)})
+
+    consumer.ledger.release.assert_called_once_with(MB)
+    resp.close.assert_called_once()
+    consumer.uploader.submit.assert_not_called()
+    consumer.runtime_config.finish_pending_file.assert_called_once_with("a")
+
+
+def test_the_asyncio_engine_drops_a_rejected_file_unread(
+    tmp_path: Path, consumer: Consumer
+):
+    def serve_headers(_: httpx.Request) -> httpx.Response:
+        return httpx.Response(
+            200, headers={"content-length": str(20 * MB)}, stream=UnreadBody()
+        )
+
+    async def download() -> bool:
+        pipeline = AsyncPipeline(Mock(), consumer)
+        pipeline.media_client = httpx.AsyncClient(
+            transport=httpx.MockTransport(serve_headers)
+        )
+        async with pipeline.media_client:
+            return await pipeline._download_file(get_file(tmp_path))  # noqa: SLF001
+
+    assert not asyncio.run(download())
+    consumer.ledger.reserve.assert_not_called()
+    assert not list(tmp_path.iterdir())
+
+
+def test_a_file_with_collected_content_is_not_uploaded(
+    tmp_path: Path, consumer: Consumer
+):
+    file = get_file(tmp_path)
+    file.size = MB
+    file.content_hash = "abc"
+    file.local_path.write_bytes(b"a")
+    consumer.dedup_store.is_content_collected.return_value = True
+
+    assert consumer.skip_duplicate_content(file)
+    assert not file.local_path.exists()
+    consumer.ledger.release.assert_called_once_with(MB)
+    consumer.dedup_store.add.assert_called_once_with(file)
+
+
+def test_the_same_content_is_uploaded_once_per_run(tmp_path: Path, consumer: Consumer):
+    consumer.dedup_store = DedupStore(tmp_path / "dedup.sqlite3")
+    files = [get_file(tmp_path), get_file(tmp_path)]
+    files[1].url = "https://media.example/b.png"
+    for file in files:
+        file.size = MB
+        file.content_hash = "abc"
+
+    assert not consumer.skip_duplicate_content(files[0])
+    assert consumer.skip_duplicate_content(files[1])
+    assert consumer.dedup_store.is_collected("a", url="https://media.example/b.png")
+    consumer.dedup_store.close()
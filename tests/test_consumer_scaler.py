@@ -0,0 +1,62 @@
+import queue
+import time
+
+import pytest
+from config import settings
+from consumer_scaler import ConsumerScaler
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def scaler(monkeypatch: pytest.MonkeyPatch) -> ConsumerScaler:
+    monkeypatch.setattr(settings, "MIN_WORKERS", 2)
+    monkeypatch.setattr(settings, "MAX_WORKERS", 32)
+    return ConsumerScaler(queue.Queue())
+
+
+def rescale(
+    scaler: ConsumerScaler,
+    queue_depth: int,
+    downloaded_mb: int,
+    *,
+    stall_s: float = 0.0,
+    idle_s: float = 0.0,
+) -> int:  # the new count after a second with these numbers
+    scaler.file_queue = queue.Queue()
+    for _ in range(queue_depth):
+        scaler.file_queue.put(None)
+    scaler.sampled_at = time.monotonic() - 1
+    scaler.record_download(downloaded_mb * MB, busy_s=1.0, stall_s=stall_s)
+    scaler.record_idle(idle_s)
+    scaler._rescale()  # noqa: SLF001
+    return scaler.active_cnt
+
+
+def test_slow_start_doubles_while_files_wait(scaler: ConsumerScaler):
+    assert [rescale(scaler, 64, mb) for mb in (1, 2, 4)] == [4, 8, 16]
+
+
+def test_stalls_alone_do_not_shrink_the_pool(scaler: ConsumerScaler):
+    # A host that throttles each connection stalls every download
+    assert rescale(scaler, 64, 1, stall_s=0.9) == 4
+    assert rescale(scaler, 64, 2, stall_s=0.9) == 8
+
+
+def test_an_increase_that_did_not_pay_off_is_undone(scaler: ConsumerScaler):
+    rescale(scaler, 64, 4)  # 2 -> 4
+    assert rescale(scaler, 2, 4, stall_s=0.9) == 2
+    # The link is saturated, the count is kept
+    assert rescale(scaler, 64, 4, stall_s=0.9) == 2
+
+
+def test_the_pool_never_shrinks_while_files_wait(scaler: ConsumerScaler):
+    rescale(scaler, 64, 4)  # 2 -> 4
+    assert rescale(scaler, 64, 4, stall_s=0.9) == 4
+    assert rescale(scaler, 4, 1, idle_s=3.0) == 4
+
+
+def test_idle_consumers_are_removed(scaler: ConsumerScaler):
+    rescale(scaler, 64, 1)  # 2 -> 4
+    rescale(scaler, 64, 2)  # 4 -> 8
+    assert rescale(scaler, 0, 4, idle_s=6.0) == 7
@@ -0,0 +1,80 @@
+import os
+from pathlib import Path
+
+from config import settings
+from content_hash import BLOCK_SIZE, BlockHasher, combine_block_hashes
+from file_metadata import FileMetadata
+from helper import Helper
+
+DATA = os.urandom(2 * settings.DOWNLOAD_SEGMENT_BYTES + BLOCK_SIZE // 3)
+
+
+def hash_stream(data: bytes, chunk_size: int) -> str:
+    hasher = BlockHasher()
+    for start in range(0, len(data), chunk_size):
+        hasher.update(data[start : start + chunk_size])
+    return combine_block_hashes(hasher.finish())
+
+
+def get_file(tmp_path: Path) -> FileMetadata:
+    return FileMetadata(
+        url="https://64.media.tumblr.com/large.mp4",
+        blog_name="blog",
+        etag=None,
+        local_path=tmp_path / "large.mp4",
+        mega_path=Path("blog/large.mp4"),
+        size=len(DATA),
+    )
+
+
+def test_chunk_size_does_not_change_the_hash():
+    assert hash_stream(DATA, 1000) == hash_stream(DATA, 256 * 1024)
+    assert hash_stream(DATA, 1000) == hash_stream(DATA, len(DATA))
+
+
+def test_blocks_are_hashed_on_their_own():
+    hasher = BlockHasher()
+    hasher.update(DATA[: BLOCK_SIZE + 1])
+    assert len(hasher.finish()) == 2
+
+    assert BlockHasher().finish() == []
+
+
+def test_segments_hash_the_same_as_a_single_stream(tmp_path: Path):
+    helper = Helper()
+    file = get_file(tmp_path)
+    part_path = helper.get_part_path(file)
+    progress_path = helper.get_progress_path(part_path)
+    progress = helper.prepare_segments(file, part_path, progress_path)
+
+    # The segments finish out of order
+    for start in reversed(helper.get_pending_segments(file, progress)):
+        end, _ = helper.get_segment_range(file, start)
+        segment = DATA[start : end + 1]
+        with part_path.open("r+b") as f:
+            f.seek(start)
+            f.write(segment)
+        hasher = BlockHasher()
+        hasher.update(segment)
+        helper.record_segment(progress_path, progress, start, hasher.finish())
+
+    block_hashes = helper.finish_segments(progress_path, progress)
+    assert part_path.read_bytes() == DATA
+    assert not progress_path.exists()
+    assert combine_block_hashes(block_hashes) == hash_stream(DATA, 1000)
+
+
+def test_a_resumed_download_keeps_the_block_hashes(tmp_path: Path):
+    helper = Helper()
+    file = get_file(tmp_path)
+    part_path = helper.get_part_path(file)
+    progress_path = helper.get_progress_path(part_path)
+    progress = helper.prepare_segments(file, part_path, progress_path)
+    helper.record_segment(progress_path, progress, 0, [b"\0" * 32])
+
+    progress = helper.prepare_segments(file, part_path, progress_path)
+    assert progress["done_segments"] == {"0": ["00" * 32]}
+    assert helper.get_pending_segments(file, progress) == [
+        settings.DOWNLOAD_SEGMENT_BYTES,
+        2 * settings.DOWNLOAD_SEGMENT_BYTES,
+    ]
@@ -0,0 +1,101 @@
+import sqlite3
+from pathlib import Path
+
+import pytest
+from config import settings
+from dedup_store import DedupStore
+from file_metadata import FileMetadata
+
+
+@pytest.fixture
+def dedup_store(tmp_path: Path) -> DedupStore:
+    dedup_store = DedupStore(tmp_path / "dedup.sqlite3")
+    dedup_store.add(
+        FileMetadata(
+            url="https://64.media.tumblr.com/abc/photo.jpg",
+            blog_name="blog",
+            etag='"abc"',
+            local_path=tmp_path / "photo.jpg",
+            mega_path=Path("blog/photo.jpg"),
+            size=1,
+        )
+    )
+    return dedup_store
+
+
+def test_a_collected_file_is_found_by_any_key(dedup_store: DedupStore):
+    assert dedup_store.is_collected(
+        "blog", url="https://64.media.tumblr.com/abc/photo.jpg"
+    )
+    assert dedup_store.is_collected("blog", etag='"abc"')
+    assert dedup_store.is_collected("blog", filename="photo.jpg")
+    assert not dedup_store.is_collected("blog", filename="other.jpg")
+    assert not dedup_store.is_collected("blog")
+
+
+def test_files_are_collected_per_blog(
+    dedup_store: DedupStore, monkeypatch: pytest.MonkeyPatch
+):
+    assert not dedup_store.is_collected("other_blog", etag='"abc"')
+
+    monkeypatch.setattr(settings, "DEDUP_ACROSS_BLOGS", True)
+    assert dedup_store.is_collected("other_blog", etag='"abc"')
+
+
+def test_collected_files_are_kept_between_runs(tmp_path: Path, dedup_store: DedupStore):
+    dedup_store.close()
+    dedup_store = DedupStore(tmp_path / "dedup.sqlite3")
+    assert dedup_store.is_collected("blog", filename="photo.jpg")
+
+
+def test_a_key_is_claimed_once_per_run(dedup_store: DedupStore):
+    assert dedup_store.claim('"abc"')
+    assert not dedup_store.claim('"abc"')
+
+
+def get_columns(db_file: Path) -> set[str]:
+    with sqlite3.connect(db_file) as connection:
+        columns = {
+            row[1] for row in connection.execute("PRAGMA table_info(collected_files)")
+        }
+    connection.close()
+    return columns
+
+
+def test_a_database_from_before_content_hashing_is_migrated(tmp_path: Path):
+    db_file = tmp_path / "old.sqlite3"
+    with sqlite3.connect(db_file) as connection:
+        connection.execute(
+            "CREATE TABLE collected_files ("
+            "id INTEGER PRIMARY KEY, blog_name TEXT NOT NULL, url TEXT NOT NULL, "
+            "etag TEXT, filename TEXT NOT NULL, size INTEGER NOT NULL, "
+            "collected_at TEXT NOT NULL)"
+        )
+        connection.execute(
+            "INSERT INTO collected_files "
+            "(blog_name, url, etag, filename, size, collected_at) "
+            "VALUES ('blog', 'https://example.com/old.jpg', NULL, 'old.jpg', 1, '')"
+        )
+    connection.close()
+
+    dedup_store = DedupStore(db_file)
+    assert "content_hash" in get_columns(db_file)
+    assert dedup_store.is_collected("blog", filename="old.jpg")
+
+    file = FileMetadata(
+        url="https://64.media.tumblr.com/new.jpg",
+        blog_name="blog",
+        etag=None,
+        local_path=tmp_path / "new.jpg",
+        mega_path=Path("blog/new.jpg"),
+        size=1,
+        content_hash="abc",
+    )
+    dedup_store.add(file)
+    assert dedup_store.is_content_collected("blog", "abc")
+    assert not dedup_store.is_content_collected("other_blog", "abc")
+    dedup_store.close()
+
+    # Opening a migrated database again changes nothing
+    DedupStore(db_file).close()
+    assert "content_hash" in get_columns(db_file)
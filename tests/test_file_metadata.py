@@ -0,0 +1,73 @@
+from unittest.mock import Mock
+
+import file_metadata
+import pytest
+from config import settings
+from file_metadata import FileCandidate, MediaVariant, MetadataResolver
+from pydantic import HttpUrl
+
+MEDIA = "https://64.media.tumblr.com"
+SIZES = {1280: 900 * 1024, 640: 300 * 1024, 400: 100 * 1024}  # in bytes
+
+
+def head(url: str, **_: object) -> Mock:
+    width = int(url.removesuffix(".jpg").rsplit("_", 1)[1])
+    return Mock(headers={"ETag": f'"{width}"', "content-length": str(SIZES[width])})
+
+
+@pytest.fixture
+def resolver(monkeypatch: pytest.MonkeyPatch) -> MetadataResolver:
+    media = Mock(**{"head.side_effect": head})
+    monkeypatch.setattr(file_metadata, "session_pool", Mock(media=media))
+    return MetadataResolver()
+
+
+@pytest.fixture
+def candidate() -> FileCandidate:
+    return FileCandidate(
+        url=HttpUrl(f"{MEDIA}/a_1280.jpg"),
+        blog_name="blog",
+        post_slug="cat",
+        numeric_suffix=None,
+        smaller_variants=[
+            MediaVariant(url=HttpUrl(f"{MEDIA}/a_{width}.jpg"), width=width)
+            for width in (640, 400)
+        ],
+    )
+
+
+def test_the_original_is_kept_without_a_budget(
+    resolver: MetadataResolver, candidate: FileCandidate
+):
+    file = resolver.submit(candidate).result()
+
+    assert file is not None
+    assert file.mega_path.name == "blog_cat_a_1280.jpg"
+    assert file.variant_width is None
+
+
+def test_a_smaller_size_is_picked_within_the_budget(
+    resolver: MetadataResolver,
+    candidate: FileCandidate,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(settings, "TUMBLR_IMAGE_MAX_KB", 500)
+    file = resolver.submit(candidate).result()
+
+    assert file is not None
+    assert str(file.url) == f"{MEDIA}/a_640.jpg"
+    assert file.size == SIZES[640]
+    # A smaller size is never mistaken for the original
+    assert file.mega_path.name == "blog_cat_a_640_640w.jpg"
+
+
+def test_the_smallest_size_is_kept_over_the_budget(
+    resolver: MetadataResolver,
+    candidate: FileCandidate,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(settings, "TUMBLR_IMAGE_MAX_KB", 50)
+    file = resolver.submit(candidate).result()
+
+    assert file is not None
+    assert file.variant_width == 400
@@ -0,0 +1,99 @@
+import asyncio
+from pathlib import Path
+from unittest.mock import Mock
+
+from file_metadata import FileMetadata
+from file_queue import (
+    AsyncFileQueue,
+    FileQueue,
+    PackingPolicy,
+    QueuePolicy,
+    RoundRobinPolicy,
+    SmallestFirstPolicy,
+)
+
+
+def get_file(name: str, size: int | None = 1, blog_name: str = "blog") -> FileMetadata:
+    return FileMetadata(
+        url=f"https://64.media.tumblr.com/{name}",
+        blog_name=blog_name,
+        etag=None,
+        local_path=Path("temp") / name,
+        mega_path=Path(blog_name) / name,
+        size=size,
+    )
+
+
+def drain(policy: QueuePolicy) -> list[str]:
+    names = []
+    while len(policy):
+        names.append(policy.get().mega_path.name)
+    return names
+
+
+def test_queue_policy_keeps_the_crawl_order():
+    policy = QueuePolicy()
+    for name, size in (("a", 3), ("b", 1), ("c", 2)):
+        policy.put(get_file(name, size))
+    assert drain(policy) == ["a", "b", "c"]
+
+
+def test_smallest_first_policy():
+    policy = SmallestFirstPolicy()
+    for name, size in (("a", 3), ("b", 1), ("c", None), ("d", 1)):
+        policy.put(get_file(name, size))
+    assert drain(policy) == ["c", "b", "d", "a"]
+
+
+def test_round_robin_policy():
+    policy = RoundRobinPolicy()
+    for name, blog_name in (("a1", "a"), ("a2", "a"), ("a3", "a"), ("b1", "b")):
+        policy.put(get_file(name, blog_name=blog_name))
+    assert drain(policy) == ["a1", "b1", "a2", "a3"]
+
+
+def test_packing_policy():
+    ledger = Mock()
+    policy = PackingPolicy(ledger)
+    for name, size in (("a", 3), ("b", 1), ("c", 2)):
+        policy.put(get_file(name, size))
+
+    # The smallest files first once the queue doesn't fit the quota
+    ledger.get_remaining_bytes.return_value = 5
+    assert drain(policy) == ["b", "a", "c"]
+
+
+def test_packing_policy_keeps_the_crawl_order_while_files_fit():
+    ledger = Mock()
+    ledger.get_remaining_bytes.return_value = 6
+    policy = PackingPolicy(ledger)
+    for name, size in (("a", 3), ("b", 1), ("c", 2)):
+        policy.put(get_file(name, size))
+    assert drain(policy) == ["a", "b", "c"]
+
+
+def test_file_queue_returns_the_sentinels_last():
+    file_queue = FileQueue(SmallestFirstPolicy())
+    file_queue.put(get_file("a", 2))
+    file_queue.put(None)
+    file_queue.put(get_file("b", 1))
+    file_queue.put(None)
+    assert file_queue.qsize() == 4
+
+    items = [file_queue.get() for _ in range(4)]
+    assert [item and item.mega_path.name for item in items] == ["b", "a", None, None]
+    assert file_queue.empty()
+
+
+def test_async_file_queue_uses_the_policy():
+    async def run() -> list[str]:
+        file_queue = AsyncFileQueue(SmallestFirstPolicy(), maxsize=2)
+        await file_queue.put(get_file("a", 2))
+        await file_queue.put(get_file("b", 1))
+        assert file_queue.full()
+        assert "files=2" in repr(file_queue)
+        names = [(await file_queue.get()).mega_path.name for _ in range(2)]
+        assert file_queue.empty()
+        return names
+
+    assert asyncio.run(run()) == ["b", "a"]
@@ -0,0 +1,245 @@
+import asyncio
+import datetime
+import json
+import threading
+from pathlib import Path
+from typing import Any
+from unittest.mock import Mock
+
+import helper
+import httpx
+import pytest
+import requests
+from async_pipeline import AsyncPipeline
+from config import settings
+from content_hash import BlockHasher, combine_block_hashes
+from file_metadata import FileMetadata
+from helper import Helper, RuntimeConfig
+
+LAST_RUNTIME = "2025-01-01T00:00:00+00:00"
+SEGMENT = 1024 * 1024
+CONTENT = bytes(range(256)) * (SEGMENT * 3 // 256) + b"tail"  # 4 segments
+
+
+def hash_content() -> str:  # as if downloaded in one stream
+    hasher = BlockHasher()
+    hasher.update(CONTENT)
+    return combine_block_hashes(hasher.finish())
+
+
+def read_config() -> dict[str, Any]:
+    config: dict[str, Any] = json.loads(settings.CONFIG_FILE.read_text())
+    return config
+
+
+@pytest.fixture
+def runtime_config(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> RuntimeConfig:
+    monkeypatch.setattr(settings, "CONFIG_FILE", tmp_path / "config.json")
+    settings.CONFIG_FILE.write_text(
+        json.dumps({"last_runtime": LAST_RUNTIME, "current_tumblr_blogs": ["a"]})
+    )
+    return RuntimeConfig()
+
+
+def test_a_blog_is_checkpointed_once_its_files_are_done(runtime_config: RuntimeConfig):
+    runtime_config.add_pending_file("b")
+    runtime_config.complete_blog("b")
+    assert "blog_checkpoints" not in read_config()
+
+    runtime_config.finish_pending_file("b")
+    config = read_config()
+    assert config["blog_checkpoints"] == {
+        "b": {"last_runtime": runtime_config.started_at.isoformat()}
+    }
+    assert config["current_tumblr_blogs"] == ["a", "b"]
+
+
+def test_a_checkpoint_is_the_blog_resume_time(runtime_config: RuntimeConfig):
+    runtime_config.complete_blog("a")
+
+    assert runtime_config.get_last_runtime_in_unix("a") == int(
+        runtime_config.started_at.timestamp()
+    )
+    assert runtime_config.get_last_runtime_in_unix("b") == int(
+        datetime.datetime.fromisoformat(LAST_RUNTIME).timestamp()
+    )
+
+
+def test_save_replaces_the_checkpoints(runtime_config: RuntimeConfig):
+    runtime_config.complete_blog("a")
+    runtime_config.save({"a", "b"}, dashboard_since_id=5)
+
+    config = read_config()
+    assert config == {
+        "last_runtime": runtime_config.started_at.isoformat(),
+        "current_tumblr_blogs": config["current_tumblr_blogs"],
+        "dashboard_since_id": 5,
+    }
+    assert sorted(config["current_tumblr_blogs"]) == ["a", "b"]
+    assert not list(settings.CONFIG_FILE.parent.glob("*.tmp"))
+
+
+def test_save_keeps_the_checkpoints_of_failed_blogs(runtime_config: RuntimeConfig):
+    checkpoint = {"last_runtime": "2025-01-02T00:00:00+00:00"}  # a stopped run
+    runtime_config.config_data["blog_checkpoints"] = {"a": checkpoint}
+    runtime_config.fail_blog("a")
+    runtime_config.fail_blog("new")
+    runtime_config.save({"a", "new"})
+
+    config = read_config()
+    assert config["last_runtime"] == runtime_config.started_at.isoformat()
+    # The new blog is still crawled as new
+    assert config["current_tumblr_blogs"] == ["a"]
+    assert config["blog_checkpoints"] == {"a": checkpoint}
+
+
+def test_a_failed_blog_is_crawled_from_its_last_run(runtime_config: RuntimeConfig):
+    runtime_config.fail_blog("a")
+    runtime_config.save({"a"})
+    runtime_config.start_run()
+
+    assert runtime_config.get_last_runtime_in_unix("a") == int(
+        datetime.datetime.fromisoformat(LAST_RUNTIME).timestamp()
+    )
+    assert runtime_config.is_blog_behind("a")
+    assert runtime_config.get_failed_blogs() == []
+
+    runtime_config.save({"a"})
+    assert "blog_checkpoints" not in read_config()
+    assert not runtime_config.is_blog_behind("a")
+
+
+class FakeMedia:  # serves CONTENT, with or without Range requests
+    def __init__(self) -> None:
+        self.has_ranges = True
+        self.failed_start: int | None = None
+        self.requested_ranges: list[str | None] = []
+        self.lock = threading.Lock()
+
+    def get(
+        self, _url: str, headers: dict[str, str] | None = None, **_: object
+    ) -> Mock:
+        requested_range = (headers or {}).get("Range")
+        with self.lock:
+            self.requested_ranges.append(requested_range)
+        if requested_range is None or not self.has_ranges:
+            return self._respond(200, CONTENT)
+
+        start, end = map(int, requested_range.removeprefix("bytes=").split("-"))
+        if start == self.failed_start:
+            raise requests.ConnectionError
+        return self._respond(206, CONTENT[start : end + 1])
+
+    def _respond(self, status_code: int, body: bytes) -> Mock:
+        return Mock(
+            status_code=status_code,
+            iter_content=lambda chunk_size: [
+                body[i : i + chunk_size] for i in range(0, len(body), chunk_size)
+            ],
+        )
+
+
+@pytest.fixture
+def media(monkeypatch: pytest.MonkeyPatch) -> FakeMedia:
+    monkeypatch.setattr(settings, "DOWNLOAD_SEGMENT_THRESHOLD_MB", 1)
+    monkeypatch.setattr(settings, "DOWNLOAD_SEGMENT_MB", 1)
+    monkeypatch.setattr(settings, "DOWNLOAD_SEGMENT_WORKERS", 1)
+    media = FakeMedia()
+    monkeypatch.setattr(helper, "session_pool", Mock(media=media))
+    return media
+
+
+@pytest.fixture
+def file(tmp_path: Path) -> FileMetadata:
+    return FileMetadata(
+        url="https://media.example/a.mp4",
+        blog_name="a",
+        etag="v1",
+        local_path=tmp_path / "a.mp4",
+        mega_path=Path("/Root/a/a.mp4"),
+        size=len(CONTENT),
+    )
+
+
+def test_an_interrupted_download_is_resumed(media: FakeMedia, file: FileMetadata):
+    media.failed_start = SEGMENT
+    with pytest.raises(requests.ConnectionError):
+        Helper().download_file(file)
+
+    progress_path = file.local_path.with_name("a.mp4.part.json")
+    assert list(json.loads(progress_path.read_text())["done_segments"]) == ["0"]
+    assert not file.local_path.exists()
+
+    media.failed_start = None
+    media.requested_ranges.clear()
+    Helper().download_file(file)
+
+    assert file.local_path.read_bytes() == CONTENT
+    assert file.content_hash == hash_content()
+    assert sorted(media.requested_ranges) == [
+        f"bytes={SEGMENT}-{2 * SEGMENT - 1}",
+        f"bytes={2 * SEGMENT}-{3 * SEGMENT - 1}",
+        f"bytes={3 * SEGMENT}-{len(CONTENT) - 1}",
+    ]
+    assert [path.name for path in file.local_path.parent.iterdir()] == ["a.mp4"]
+
+
+def test_a_changed_file_is_downloaded_from_the_start(
+    media: FakeMedia, file: FileMetadata
+):
+    media.failed_start = SEGMENT
+    with pytest.raises(requests.ConnectionError):
+        Helper().download_file(file)
+
+    media.failed_start = None
+    media.requested_ranges.clear()
+    changed_file = file.model_copy(update={"etag": "v2"})
+    Helper().download_file(changed_file)
+
+    assert file.local_path.read_bytes() == CONTENT
+    assert changed_file.content_hash == hash_content()
+    assert len(media.requested_ranges) == 4
+    assert media.requested_ranges[0] == f"bytes=0-{SEGMENT - 1}"
+
+
+def test_a_file_is_streamed_if_the_server_ignores_ranges(
+    media: FakeMedia, file: FileMetadata
+):
+    media.has_ranges = False
+    Helper().download_file(file)
+
+    assert file.local_path.read_bytes() == CONTENT
+    assert file.content_hash == hash_content()
+    assert media.requested_ranges == [f"bytes=0-{SEGMENT - 1}", None]
+    assert [path.name for path in file.local_path.parent.iterdir()] == ["a.mp4"]
+
+
+def test_a_download_is_resumed_by_the_other_engine(
+    media: FakeMedia, file: FileMetadata
+):
+    def serve_content(request: httpx.Request) -> httpx.Response:
+        requested_range = request.headers["Range"]
+        media.requested_ranges.append(requested_range)
+        start, end = map(int, requested_range.removeprefix("bytes=").split("-"))
+        return httpx.Response(206, content=CONTENT[start : end + 1])
+
+    async def download() -> None:
+        pipeline = AsyncPipeline(Mock(), Mock(helper=Helper()))
+        pipeline.media_client = httpx.AsyncClient(
+            transport=httpx.MockTransport(serve_content)
+        )
+        async with pipeline.media_client:
+            await pipeline._download_file(file)  # noqa: SLF001
+
+    media.failed_start = SEGMENT
+    with pytest.raises(requests.ConnectionError):
+        Helper().download_file(file)
+
+    media.requested_ranges.clear()
+    asyncio.run(download())
+
+    assert file.local_path.read_bytes() == CONTENT
+    assert file.content_hash == hash_content()
+    assert len(media.requested_ranges) == 3
+    assert f"bytes=0-{SEGMENT - 1}" not in media.requested_ranges
+    assert [path.name for path in file.local_path.parent.iterdir()] == ["a.mp4"]
@@ -0,0 +1,226 @@
+import subprocess
+import threading
+from pathlib import Path
+from unittest.mock import Mock
+
+import pytest
+from config import settings
+from file_metadata import FileMetadata
+from helper import Helper
+from mega import MegaFolderLedger, MegaRemoteManifest, MegaUploader
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def ledger(monkeypatch: pytest.MonkeyPatch) -> MegaFolderLedger:
+    monkeypatch.setattr(settings, "SAVE_TO_MEGA", True)
+    monkeypatch.setattr(settings, "MEGA_FOLDER_SIZE_LIMIT_MB", 10)
+    mega = Mock(helper=Helper())
+    mega.get_mega_folder_size.return_value = 4 * MB
+    ledger = MegaFolderLedger(mega)
+    ledger.seed()
+    return ledger
+
+
+def test_reserve_holds_bytes_until_the_limit(ledger: MegaFolderLedger):
+    assert ledger.reserve(5 * MB)
+    assert not ledger.reserve(2 * MB)
+    assert ledger.reserve(1 * MB)
+    assert ledger.is_full()
+
+    ledger.release(1 * MB)
+    assert not ledger.is_full()
+    assert ledger.reserve(1 * MB)
+
+
+def test_commit_moves_reserved_bytes_to_used(ledger: MegaFolderLedger):
+    ledger.reserve(3 * MB)
+    ledger.commit(3 * MB)
+    assert ledger.used_bytes == 7 * MB
+    assert ledger.reserved_bytes == 0
+    ledger.mega.get_mega_folder_size.assert_called_once()  # only by `seed`
+
+
+def test_commit_reconciles_when_it_is_due(ledger: MegaFolderLedger):
+    ledger.mega.get_mega_folder_size.return_value = 8 * MB
+    ledger.last_reconciled_at -= settings.MEGA_LEDGER_RECONCILE_INTERVAL_S
+    ledger.reserve(3 * MB)
+    ledger.commit(3 * MB)
+    assert ledger.used_bytes == 8 * MB
+
+
+def test_reconcile_takes_the_size_from_mega(ledger: MegaFolderLedger):
+    ledger.reserve(1 * MB)
+    ledger.mega.get_mega_folder_size.return_value = 5 * MB
+    ledger.reconcile()
+    assert ledger.used_bytes == 5 * MB
+    assert ledger.reserved_bytes == 1 * MB  # files still being processed
+
+
+def test_reconcile_is_skipped_if_a_file_is_committed_meanwhile(
+    ledger: MegaFolderLedger,
+):
+    ledger.reserve(1 * MB)
+
+    def get_mega_folder_size() -> int:
+        ledger.commit(1 * MB)
+        return 4 * MB  # may or may not count the committed file
+
+    ledger.mega.get_mega_folder_size.side_effect = get_mega_folder_size
+    ledger.reconcile()
+    assert ledger.used_bytes == 5 * MB
+
+
+def test_reconcile_does_nothing_without_mega(
+    ledger: MegaFolderLedger, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "SAVE_TO_MEGA", False)
+    ledger.reconcile()
+    ledger.mega.get_mega_folder_size.assert_called_once()
+
+
+def test_the_manifest_lists_the_upload_folder_once(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, "SAVE_TO_MEGA", True)
+    mega = Mock(**{"list_remote_files.return_value": {"a.jpg"}})
+    remote_manifest = MegaRemoteManifest(mega)
+    remote_manifest.load()
+    remote_manifest.add("b.jpg")
+
+    assert remote_manifest.contains("a.jpg")
+    assert remote_manifest.contains("b.jpg")
+    assert not remote_manifest.contains("c.jpg")
+    mega.list_remote_files.assert_called_once()
+
+
+def test_the_manifest_is_empty_without_mega(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, "SAVE_TO_MEGA", False)
+    mega = Mock()
+    remote_manifest = MegaRemoteManifest(mega)
+    remote_manifest.load()
+
+    assert not remote_manifest.contains("a.jpg")
+    mega.list_remote_files.assert_not_called()
+
+
+class UploadResults:
+    # The `on_done` callback, records whether every file was uploaded
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.results: dict[str, bool] = {}
+
+    def __call__(self, file: FileMetadata, is_uploaded: bool) -> None:
+        with self.lock:
+            self.results[str(file.mega_path)] = is_uploaded
+
+
+def get_file(mega_path: str) -> FileMetadata:
+    return FileMetadata(
+        url=f"https://64.media.tumblr.com/{mega_path}",
+        blog_name=mega_path.split("/")[0],
+        etag=None,
+        local_path=Path(mega_path.split("/")[-1]),
+        mega_path=Path(mega_path),
+        size=1,
+    )
+
+
+@pytest.fixture
+def uploader(monkeypatch: pytest.MonkeyPatch) -> MegaUploader:
+    monkeypatch.setattr(settings, "SAVE_TO_MEGA", True)
+    monkeypatch.setattr(settings, "MEGA_UPLOAD_BATCH_FILES", 3)
+    monkeypatch.setattr(settings, "MEGA_UPLOAD_BATCH_TIMEOUT_S", 60.0)
+    uploader = MegaUploader(Mock())
+    uploader.start()
+    return uploader
+
+
+def test_files_are_uploaded_in_a_batch_per_folder(uploader: MegaUploader):
+    on_done = UploadResults()
+    for mega_path in ("a/1.jpg", "a/2.jpg", "b/1.jpg"):
+        uploader.submit(get_file(mega_path), on_done)
+    uploader.close()
+
+    uploader.mega.upload_local_files.assert_called_once()
+    uploader.mega.upload_local_file.assert_called_once()  # alone in its folder
+    assert on_done.results == {"a/1.jpg": True, "a/2.jpg": True, "b/1.jpg": True}
+
+
+def test_a_file_submitted_after_close_is_uploaded_on_its_own(uploader: MegaUploader):
+    on_done = UploadResults()
+    uploader.close()
+    uploader.submit(get_file("a/1.jpg"), on_done)
+
+    uploader.mega.upload_local_file.assert_called_once()
+    assert on_done.results == {"a/1.jpg": True}
+    assert uploader.batch == []
+
+
+def test_a_batch_is_sent_after_the_timeout(
+    uploader: MegaUploader, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "MEGA_UPLOAD_BATCH_TIMEOUT_S", 0.05)
+    uploaded = threading.Event()
+    uploader.mega.upload_local_files.side_effect = lambda *_: uploaded.set()
+    on_done = UploadResults()
+    uploader.submit(get_file("a/1.jpg"), on_done)
+    uploader.submit(get_file("a/2.jpg"), on_done)
+
+    assert uploaded.wait(timeout=5)
+    uploader.close()
+
+
+def test_a_failed_batch_is_checked_file_by_file(uploader: MegaUploader):
+    uploader.mega.upload_local_files.side_effect = subprocess.CalledProcessError(
+        1, "mega-put"
+    )
+    uploader.mega.remote_file_exists.side_effect = lambda path: path.name == "1.jpg"
+    uploader.mega.upload_local_file.side_effect = OSError
+    on_done = UploadResults()
+    for mega_path in ("a/1.jpg", "a/2.jpg"):
+        uploader.submit(get_file(mega_path), on_done)
+    uploader.close()
+
+    assert on_done.results == {"a/1.jpg": True, "a/2.jpg": False}
+
+
+def test_submit_waits_while_uploads_fall_behind(uploader: MegaUploader):
+    upload_started = threading.Event()
+    can_upload = threading.Event()
+
+    def upload_local_files(*_: object) -> None:
+        upload_started.set()
+        can_upload.wait(timeout=5)
+
+    uploader.mega.upload_local_files.side_effect = upload_local_files
+    on_done = UploadResults()
+    for i in range(3):  # the first batch, stuck in the upload
+        uploader.submit(get_file(f"a/{i}.jpg"), on_done)
+    assert upload_started.wait(timeout=5)
+    for i in range(3, 9):  # 2 more batches wait
+        uploader.submit(get_file(f"a/{i}.jpg"), on_done)
+
+    submitter = threading.Thread(
+        target=uploader.submit, args=(get_file("a/9.jpg"), on_done)
+    )
+    submitter.start()
+    submitter.join(timeout=0.2)
+    assert submitter.is_alive()
+
+    can_upload.set()
+    submitter.join(timeout=5)
+    assert not submitter.is_alive()
+    uploader.close()
+    assert len(on_done.results) == 10
+
+
+def test_files_are_uploaded_one_by_one_without_batching(
+    uploader: MegaUploader, monkeypatch: pytest.MonkeyPatch
+):
+    uploader.close()
+    monkeypatch.setattr(settings, "MEGA_UPLOAD_BATCH_FILES", 1)
+    on_done = UploadResults()
+    uploader.submit(get_file("a/1.jpg"), on_done)
+
+    uploader.mega.upload_local_file.assert_called_once()
+    assert on_done.results == {"a/1.jpg": True}
@@ -0,0 +1,53 @@
+import json
+from pathlib import Path
+from typing import Any
+
+import pytest
+from config import settings
+from metrics import Metrics
+
+
+@pytest.fixture
+def metrics(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Metrics:
+    monkeypatch.setattr(settings, "METRICS_REPORT_FILE", tmp_path / "report.json")
+    monkeypatch.setattr(settings, "METRICS_SAMPLE_INTERVAL_S", 0.0)
+    return Metrics()
+
+
+def read_report() -> dict[str, Any]:
+    assert settings.METRICS_REPORT_FILE is not None
+    report: dict[str, Any] = json.loads(settings.METRICS_REPORT_FILE.read_text())
+    return report
+
+
+def collect(metrics: Metrics, blog_name: str) -> None:
+    metrics.observe("download", 0.1, 100)
+    metrics.count_collected(blog_name, 100)
+    metrics.count_skip("duplicate", blog_name)
+    metrics.sample_queue_depth(5)
+
+
+def test_every_run_is_reported_on_its_own(metrics: Metrics):
+    metrics.observe("mega_du", 0.2)  # at startup, before the first run
+    for blog_name in ("a", "b"):
+        metrics.start_run()
+        collect(metrics, blog_name)
+        metrics.write_report()
+        metrics.reset()
+
+    report = read_report()
+    assert list(report["stages"]) == ["download"]
+    assert report["stages"]["download"]["count"] == 1
+    assert report["skipped"] == {"duplicate": 1}
+    assert list(report["blogs"]) == ["b"]
+    assert len(report["queue_depth"]["samples"]) == 1
+
+
+def test_calls_before_a_run_count_towards_it(metrics: Metrics):
+    metrics.observe("mega_du", 0.2)
+    metrics.start_run()
+    collect(metrics, "a")
+
+    report = metrics.get_report()
+    assert sorted(report["stages"]) == ["download", "mega_du"]
+    assert report["runtime_s"] < 1
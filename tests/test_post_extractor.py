@@ -0,0 +1,146 @@
+from typing import Any
+
+import pytest
+from config import settings
+from post_extractor import NpfPostExtractor, PostExtractor
+
+MEDIA = "https://64.media.tumblr.com"
+
+
+def get_image_block(name: str) -> dict[str, Any]:
+    return {
+        "type": "image",
+        "media": [
+            {"url": f"{MEDIA}/{name}_400.jpg", "width": 400, "height": 300},
+            {"url": f"{MEDIA}/{name}_1280.jpg", "width": 1280, "height": 960},
+            {"url": f"{MEDIA}/{name}_640.jpg", "width": 640, "height": 480},
+        ],
+    }
+
+
+def get_video_block(name: str) -> dict[str, Any]:
+    return {
+        "type": "video",
+        "provider": "tumblr",
+        "media": {"url": f"{MEDIA}/{name}.mp4", "width": 720, "height": 1280},
+    }
+
+
+@pytest.fixture
+def extractor(monkeypatch: pytest.MonkeyPatch) -> NpfPostExtractor:
+    monkeypatch.setattr(settings, "TUMBLR_COLLECT_VIDEOS", True)
+    return NpfPostExtractor()
+
+
+def test_the_largest_image_is_picked(extractor: NpfPostExtractor):
+    post = {"type": "text", "slug": "cat", "content": [get_image_block("a")]}
+
+    candidates = extractor.get_post_candidates(post, "blog")
+    assert [str(candidate.url) for candidate in candidates] == [f"{MEDIA}/a_1280.jpg"]
+    assert candidates[0].post_slug == "cat"
+    assert candidates[0].numeric_suffix is None
+
+
+def test_images_and_videos_are_numbered_apart(extractor: NpfPostExtractor):
+    post = {
+        "type": "text",
+        "slug": "cats",
+        "content": [
+            get_image_block("a"),
+            {"type": "text", "text": "Two cats"},
+            get_video_block("v"),
+            get_image_block("b"),
+            {"type": "video", "provider": "youtube", "url": "https://youtu.be/x"},
+        ],
+    }
+
+    candidates = extractor.get_post_candidates(post, "blog")
+    assert [(str(c.url), c.numeric_suffix) for c in candidates] == [
+        (f"{MEDIA}/a_1280.jpg", 1),
+        (f"{MEDIA}/b_1280.jpg", 2),
+        (f"{MEDIA}/v.mp4", None),
+    ]
+
+
+def test_videos_are_skipped_unless_collected(
+    extractor: NpfPostExtractor, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "TUMBLR_COLLECT_VIDEOS", False)
+    post = {"type": "video", "slug": "v", "content": [get_video_block("v")]}
+
+    assert extractor.get_post_candidates(post, "blog") == []
+
+
+@pytest.mark.parametrize(
+    "post",
+    [
+        {"parent_post_url": "https://blog/1", "content": [get_image_block("a")]},
+        {"trail": [{"content": [get_image_block("a")]}], "content": []},
+        {"content": [get_image_block("a")], "layout": [{"type": "ask", "blocks": [0]}]},
+    ],
+    ids=["repost", "reblog", "answer"],
+)
+def test_posts_of_other_blogs_and_answers_are_skipped(
+    extractor: NpfPostExtractor, post: dict[str, Any]
+):
+    assert extractor.get_post_candidates({"type": "text", **post}, "blog") == []
+
+
+def test_a_post_gets_the_names_of_the_legacy_format(extractor: NpfPostExtractor):
+    # A blog collected before switching formats keeps its file names
+    image_block = get_image_block("a")
+    legacy_post = {
+        "type": "photo",
+        "slug": "cat",
+        "photos": [
+            {
+                "original_size": image_block["media"][1],
+                "alt_sizes": image_block["media"],
+            }
+        ],
+    }
+    npf_post = {"type": "photo", "slug": "cat", "content": [image_block]}
+
+    assert PostExtractor().get_post_candidates(
+        legacy_post, "blog"
+    ) == extractor.get_post_candidates(npf_post, "blog")
+
+
+def test_the_widest_image_within_the_max_width_is_picked(
+    extractor: NpfPostExtractor, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "TUMBLR_IMAGE_MAX_WIDTH", 1000)
+    post = {"type": "photo", "slug": "cat", "content": [get_image_block("a")]}
+
+    (candidate,) = extractor.get_post_candidates(post, "blog")
+    assert str(candidate.url) == f"{MEDIA}/a_640.jpg"
+    assert candidate.variant_width == 640
+    assert [variant.width for variant in candidate.smaller_variants] == [400]
+
+
+def test_the_narrowest_image_is_picked_if_none_fits(
+    extractor: NpfPostExtractor, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "TUMBLR_IMAGE_MAX_WIDTH", 100)
+    post = {"type": "photo", "slug": "cat", "content": [get_image_block("a")]}
+
+    (candidate,) = extractor.get_post_candidates(post, "blog")
+    assert str(candidate.url) == f"{MEDIA}/a_400.jpg"
+    assert candidate.smaller_variants == []
+
+
+def test_the_sizes_of_a_text_post_come_from_its_srcset():
+    srcset = f"{MEDIA}/a_400.jpg 400w, {MEDIA}/a_1280.jpg 1280w"
+    post = {
+        "type": "text",
+        "slug": "cat",
+        "trail": [{"content_raw": f'<img srcset="{srcset}">'}],
+    }
+
+    (candidate,) = PostExtractor().get_post_candidates(post, "blog")
+    assert str(candidate.url) == f"{MEDIA}/a_1280.jpg"
+    assert candidate.variant_width is None
+    assert [str(c.url) for c in candidate.get_variants()] == [
+        f"{MEDIA}/a_1280.jpg",
+        f"{MEDIA}/a_400.jpg",
+    ]
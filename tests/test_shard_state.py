@@ -0,0 +1,172 @@
+import datetime
+import json
+import subprocess
+import sys
+from pathlib import Path
+from unittest.mock import Mock
+
+import pipeline
+import pytest
+from config import settings
+from shard_state import ShardRun, ShardState, get_blog_shard
+from tumblr import TumblrCollector
+
+BLOG_NAMES = [f"blog{i}" for i in range(200)]
+
+
+@pytest.fixture
+def shard_states(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> tuple[ShardState, ShardState]:
+    monkeypatch.setattr(settings, "SHARD_COUNT", 2)
+    states = []
+    for shard_index in range(2):
+        monkeypatch.setattr(settings, "SHARD_INDEX", shard_index)
+        states.append(ShardState(tmp_path / "shard_state.sqlite3"))
+    return states[0], states[1]
+
+
+def finish(shard_state: ShardState) -> list[ShardRun] | None:
+    return shard_state.finish_round(
+        ShardRun(
+            shard_index=shard_state.shard_index,
+            started_at=datetime.datetime.now(datetime.UTC),
+            is_complete=True,
+            blogs=[],
+            failed_blogs=[],
+            dashboard_since_id=None,
+            report={},
+        )
+    )
+
+
+def test_every_blog_belongs_to_one_shard():
+    shards = [get_blog_shard(blog_name, 4) for blog_name in BLOG_NAMES]
+
+    assert set(shards) == {0, 1, 2, 3}
+    assert min(shards.count(shard) for shard in range(4)) > len(BLOG_NAMES) / 8
+
+
+def test_the_shard_of_a_blog_does_not_depend_on_the_process():
+    # `hash` would give every process its own split
+    code = (
+        "from shard_state import get_blog_shard; "
+        f"print([get_blog_shard(name, 4) for name in {BLOG_NAMES!r}])"
+    )
+    scripts_dir = Path(__file__).resolve().parent.parent / "scripts"
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=scripts_dir,
+        env={"PYTHONHASHSEED": "1"},
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+    assert output.strip() == str([get_blog_shard(name, 4) for name in BLOG_NAMES])
+
+
+def test_the_last_shard_to_finish_gets_the_round(
+    shard_states: tuple[ShardState, ShardState],
+):
+    started_at = datetime.datetime.now(datetime.UTC)
+    for shard_state in shard_states:
+        shard_state.start_round(started_at)
+
+    assert finish(shard_states[0]) is None
+    shard_runs = finish(shard_states[1])
+    assert shard_runs is not None
+    assert sorted(shard_run.shard_index for shard_run in shard_runs) == [0, 1]
+
+
+def test_a_key_is_claimed_by_one_shard(shard_states: tuple[ShardState, ShardState]):
+    started_at = datetime.datetime.now(datetime.UTC)
+    for shard_state in shard_states:
+        shard_state.start_round(started_at)
+
+    assert shard_states[0].claim("url", "etag")
+    assert not shard_states[1].claim("etag")
+    assert shard_states[1].is_claimed("url")
+
+
+@pytest.mark.usefixtures("shard_states")
+def test_the_shard_count_cannot_change(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, "SHARD_COUNT", 3)
+
+    with pytest.raises(ValueError, match="created for 2 shards"):
+        ShardState(tmp_path / "shard_state.sqlite3")
+
+
+class FakeShardProcess:
+    # Stands in for `subprocess.Popen`, reads the blogs its shard would get
+    def __init__(self, _: list[str], env: dict[str, str], **__: object) -> None:
+        self.shard_index = int(env["SHARD_INDEX"])
+        self.blog_names = json.loads(Path(env["SHARD_BLOGS_FILE"]).read_text())
+        self.returncode = self.shard_index
+
+    def wait(self, _: float | None = None) -> int:
+        return self.returncode
+
+
+def test_the_followed_blogs_are_read_once_for_all_shards(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(settings, "SHARD_COUNT", 2)
+    get_followed_blogs = Mock(return_value={"a", "b"})
+    mega_saver = Mock()
+    shards: list[FakeShardProcess] = []
+
+    def start_shard(
+        args: list[str], env: dict[str, str], **_: object
+    ) -> FakeShardProcess:
+        shards.append(FakeShardProcess(args, env))
+        return shards[-1]
+
+    monkeypatch.setattr(
+        pipeline.FollowedBlogReader, "get_followed_blogs", get_followed_blogs
+    )
+    monkeypatch.setattr(pipeline.subprocess, "Popen", start_shard)
+    monkeypatch.setattr(pipeline.signal, "signal", Mock())
+    monkeypatch.setattr(pipeline, "MegaSaver", mega_saver)
+
+    assert pipeline.run_shards() == 1
+    get_followed_blogs.assert_called_once()
+    assert [shard.blog_names for shard in shards] == [["a", "b"], ["a", "b"]]
+    mega_saver.return_value.logout.assert_called_once()
+
+
+def test_a_shard_splits_the_blogs_read_by_run_shards(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    blogs_file = tmp_path / "followed_blogs.json"
+    blogs_file.write_text(json.dumps(BLOG_NAMES))
+    monkeypatch.setattr(settings, "SHARD_COUNT", 2)
+    monkeypatch.setattr(settings, "SHARD_INDEX", 1)
+    monkeypatch.setattr(settings, "SHARD_BLOGS_FILE", blogs_file)
+    collector = TumblrCollector(Mock(), Mock(), Mock(), Mock())
+    collector.followed_blog_reader = Mock()
+
+    blog_names = collector.get_followed_blogs()
+
+    collector.followed_blog_reader.get_followed_blogs.assert_not_called()
+    assert blog_names == {blog for blog in BLOG_NAMES if get_blog_shard(blog, 2) == 1}
+
+
+@pytest.mark.parametrize(
+    ("blogs_file", "is_logged_out"),
+    [(None, True), (Path("followed_blogs.json"), False)],
+)
+def test_only_a_standalone_shard_logs_out(
+    monkeypatch: pytest.MonkeyPatch, blogs_file: Path | None, is_logged_out: bool
+):
+    monkeypatch.setattr(settings, "SHARD_COUNT", 2)
+    monkeypatch.setattr(settings, "SHARD_INDEX", 0)
+    monkeypatch.setattr(settings, "SHARD_BLOGS_FILE", blogs_file)
+    shard = pipeline.Pipeline.__new__(pipeline.Pipeline)
+    shard.async_runner = None
+    for name in ("uploader", "consumer", "dedup_store", "shard_state", "mega"):
+        setattr(shard, name, Mock())
+
+    shard.close()
+
+    assert shard.mega.logout.called == is_logged_out
@@ -0,0 +1,99 @@
+from pathlib import Path
+from unittest.mock import Mock
+
+import pytest
+from config import settings
+from consumer import Consumer
+from file_metadata import FileMetadata
+from spool import MemorySpool
+
+MB = 1024 * 1024
+
+
+def get_file(name: str, size: int) -> FileMetadata:
+    return FileMetadata(
+        url=f"https://64.media.tumblr.com/{name}",
+        blog_name="a",
+        etag=None,
+        local_path=settings.LOCAL_TEMP_UPLOAD_DIR / name,
+        mega_path=Path("/Root/a") / name,
+        size=size,
+    )
+
+
+@pytest.fixture
+def spool(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> MemorySpool:
+    monkeypatch.setattr(settings, "SAVE_TO_MEGA", True)
+    monkeypatch.setattr(settings, "SPOOL_DIR", tmp_path / "spool")
+    monkeypatch.setattr(settings, "SPOOL_MAX_MB", 2)
+    monkeypatch.setattr(settings, "SPOOL_FILE_MAX_MB", 1)
+    spool = MemorySpool()
+    spool.open()
+    return spool
+
+
+def test_small_files_are_spooled_within_the_budget(spool: MemorySpool):
+    files = [get_file(name, MB) for name in ("a", "b", "c")]
+    for file in files:
+        spool.assign(file)
+
+    assert [file.local_path.parent for file in files] == [
+        spool.spool_dir,
+        spool.spool_dir,
+        settings.LOCAL_TEMP_UPLOAD_DIR,
+    ]
+    assert spool.used_bytes == 2 * MB
+
+    for file in files:
+        spool.release(file)
+    assert spool.used_bytes == 0
+
+
+def test_a_large_file_goes_to_the_disk(spool: MemorySpool):
+    file = get_file("a", MB + 1)
+    spool.assign(file)
+
+    assert file.local_path.parent == settings.LOCAL_TEMP_UPLOAD_DIR
+    assert spool.used_bytes == 0
+
+
+def test_close_removes_the_folder_of_the_run(spool: MemorySpool):
+    spool_dir = spool.spool_dir
+    assert spool_dir is not None
+    assert spool_dir.is_dir()
+
+    spool.close()
+    assert not spool_dir.exists()
+    assert settings.SPOOL_DIR.is_dir()
+
+
+def test_the_spool_is_off_by_default():
+    spool = MemorySpool()
+    spool.open()
+    file = get_file("a", 1)
+    spool.assign(file)
+
+    assert settings.SPOOL_DIR is None
+    assert file.local_path.parent == settings.LOCAL_TEMP_UPLOAD_DIR
+
+
+@pytest.mark.parametrize("is_uploaded", [True, False])
+def test_a_finished_file_gives_its_bytes_back(spool: MemorySpool, *, is_uploaded: bool):
+    consumer = Consumer(Mock(), Mock(), Mock(), Mock(), Mock())
+    consumer.spool = spool
+    file = get_file("a", MB)
+    spool.assign(file)
+
+    consumer.finish_file(file, is_uploaded=is_uploaded)
+    assert spool.used_bytes == 0
+
+
+def test_an_abandoned_file_gives_its_bytes_back(spool: MemorySpool):
+    consumer = Consumer(Mock(), Mock(), Mock(), Mock(), Mock())
+    consumer.spool = spool
+    file = get_file("a", MB)
+    spool.assign(file)
+
+    consumer.abandon_file(file)
+    assert spool.used_bytes == 0
+    consumer.ledger.release.assert_called_once_with(MB)
@@ -0,0 +1,556 @@
+import asyncio
+import concurrent.futures
+import json
+import queue
+import threading
+import time
+from collections import Counter
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+from unittest.mock import Mock
+
+import httpx
+import pytest
+import tumblr
+from async_pipeline import AsyncPipeline
+from config import settings
+from file_metadata import FileCandidate, FileMetadata, MediaVariant
+from helper import RuntimeConfig
+from tumblr import BlogCursor, TumblrCollector
+
+LAST_RUNTIME = 1735689600  # 2025-01-01 in `config.json`
+
+
+class FakeBlogPages:
+    # Stands in for `_add_blog_page`, every blog has a number of pages to crawl
+    def __init__(
+        self, page_cnts: dict[str, int], failed_blogs: tuple[str, ...] = ()
+    ) -> None:
+        self.page_cnts = dict(page_cnts)
+        self.failed_blogs = failed_blogs  # their second page fails
+        self.crawled: list[str] = []
+        self.held_blogs: set[str] = set()
+        self.shared_blogs: list[str] = []  # held by two crawlers at once
+        self.lock = threading.Lock()
+
+    def __call__(self, *, cursor: BlogCursor, **_: object) -> bool:
+        with self.lock:
+            if cursor.blog_name in self.held_blogs:
+                self.shared_blogs.append(cursor.blog_name)
+            self.held_blogs.add(cursor.blog_name)
+            self.crawled.append(cursor.blog_name)
+
+        time.sleep(0.001)
+        with self.lock:
+            self.held_blogs.discard(cursor.blog_name)
+            self.page_cnts[cursor.blog_name] -= 1
+            if (
+                cursor.blog_name in self.failed_blogs
+                and self.crawled.count(cursor.blog_name) == 2
+            ):
+                msg = f"{cursor.blog_name} is gone"
+                raise RuntimeError(msg)
+            return self.page_cnts[cursor.blog_name] > 0
+
+
+class FakeResolver:
+    # Every HEAD request succeeds unless its URL is in `failed_urls`
+    def __init__(self, failed_urls: tuple[str, ...] = ()) -> None:
+        self.failed_urls = failed_urls
+        self.resolved_urls: list[str] = []
+
+    def submit(
+        self, candidate: FileCandidate
+    ) -> concurrent.futures.Future[FileMetadata | None]:
+        url = str(candidate.url)
+        self.resolved_urls.append(url)
+        future: concurrent.futures.Future[FileMetadata | None] = (
+            concurrent.futures.Future()
+        )
+        future.set_result(
+            None
+            if url in self.failed_urls
+            else FileMetadata(
+                url=url,
+                blog_name=candidate.blog_name,
+                etag=f'"{url}"',
+                local_path=Path(url.rsplit("/", 1)[-1]),
+                mega_path=Path(candidate.blog_name, url.rsplit("/", 1)[-1]),
+                size=1,
+            )
+        )
+        return future
+
+    def get_filename(self, candidate: FileCandidate) -> str:
+        return str(candidate.url).rsplit("/", 1)[-1]
+
+
+class FakeApi:
+    # Stands in for `tumblr_api`, pages the posts of every API path
+    def __init__(
+        self, posts_by_path: dict[str, list[dict[str, Any]]], *, has_links: bool = False
+    ) -> None:
+        self.posts_by_path = posts_by_path  # the newest first
+        self.has_links = has_links  # `_links.next` is returned with a page number
+        self.requests: list[tuple[str, dict[str, Any]]] = []
+
+    @property
+    def paths(self) -> list[str]:
+        return [path for path, _ in self.requests]
+
+    def get(self, path: str, params: dict[str, Any]) -> dict[str, Any]:
+        self.requests.append((path, params))
+        posts = [
+            post
+            for post in self.posts_by_path.get(path, [])
+            if post["timestamp"] < params.get("before", float("inf"))
+            and post["timestamp"] > params.get("after", 0)
+        ]
+        offset = int(params.get("page_number", params.get("offset", 0)))
+        limit = params["limit"]
+        response: dict[str, Any] = {"posts": posts[offset : offset + limit]}
+        if self.has_links and offset + limit < len(posts):
+            next_params = {"limit": limit, "page_number": str(offset + limit)}
+            response["_links"] = {"next": {"query_params": next_params}}
+        return response
+
+
+def get_photo_post(post_id: int, blog_name: str) -> dict[str, Any]:
+    url = f"https://64.media.tumblr.com/{blog_name}{post_id}.jpg"
+    return {
+        "id": post_id,
+        "timestamp": LAST_RUNTIME + post_id,
+        "blog_name": blog_name,
+        "type": "photo",
+        "slug": None,
+        "photos": [{"original_size": {"url": url}}],
+    }
+
+
+def get_candidates(*names: str, blog_name: str = "blog") -> list[FileCandidate]:
+    return [
+        FileCandidate(
+            url=f"https://64.media.tumblr.com/{name}",
+            blog_name=blog_name,
+            post_slug=None,
+            numeric_suffix=None,
+        )
+        for name in names
+    ]
+
+
+def add_files(
+    collector: TumblrCollector, candidates: list[FileCandidate]
+) -> list[FileMetadata | None]:
+    file_queue: queue.Queue[FileMetadata | None] = queue.Queue()
+    cursor = BlogCursor(blog_name="blog", is_new_blog=False)
+    collector._add_files(file_queue, {"blog": set()}, cursor, candidates)  # noqa: SLF001
+    return list(file_queue.queue)
+
+
+def write_config(collector: TumblrCollector, **config: object) -> None:
+    settings.CONFIG_FILE.write_text(
+        json.dumps({
+            "last_runtime": "2025-01-01T00:00:00+00:00",
+            "current_tumblr_blogs": [],
+            **config,
+        })
+    )
+    collector.runtime_config = RuntimeConfig()
+
+
+@pytest.fixture
+def collector(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> TumblrCollector:
+    monkeypatch.setattr(settings, "CONFIG_FILE", tmp_path / "config.json")
+    ledger = Mock(**{"is_full.return_value": False})
+    dedup_store = Mock(**{"is_collected.return_value": False})
+    remote_manifest = Mock(**{"contains.return_value": False})
+    collector = TumblrCollector(
+        ledger=ledger,
+        dedup_store=dedup_store,
+        remote_manifest=remote_manifest,
+        runtime_config=Mock(),
+    )
+    write_config(collector)
+    return collector
+
+
+def crawl(
+    collector: TumblrCollector,
+    monkeypatch: pytest.MonkeyPatch,
+    page_cnts: dict[str, int],
+    failed_blogs: tuple[str, ...] = (),
+) -> FakeBlogPages:
+    blog_pages = FakeBlogPages(page_cnts, failed_blogs)
+    monkeypatch.setattr(collector, "_add_blog_page", blog_pages)
+    collector.produce_files_from_blogs(set(page_cnts), queue.Queue())
+    return blog_pages
+
+
+def test_a_large_blog_does_not_hold_up_the_others(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "TUMBLR_CRAWLER_WORKERS", 2)
+    blog_pages = crawl(collector, monkeypatch, {"large": 10, "a": 1, "b": 1})
+
+    # Every blog gets a crawler while the large blog is paged in turn
+    assert set(blog_pages.crawled[:4]) == {"large", "a", "b"}
+    assert Counter(blog_pages.crawled) == {"large": 10, "a": 1, "b": 1}
+
+
+def test_a_blog_is_held_by_one_crawler_at_a_time(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "TUMBLR_CRAWLER_WORKERS", 4)
+    page_cnts = {f"blog{i}": i + 1 for i in range(8)}
+    blog_pages = crawl(collector, monkeypatch, page_cnts)
+
+    assert Counter(blog_pages.crawled) == page_cnts
+    assert blog_pages.shared_blogs == []
+
+
+def test_blogs_are_crawled_one_by_one_by_default(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "TUMBLR_CRAWLER_WORKERS", 1)
+    blog_pages = crawl(collector, monkeypatch, {"a": 3, "b": 2})
+
+    assert blog_pages.crawled in (["a"] * 3 + ["b"] * 2, ["b"] * 2 + ["a"] * 3)
+
+
+@pytest.mark.parametrize("crawler_cnt", [1, 2])
+def test_a_failed_blog_does_not_stop_the_others(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch, crawler_cnt: int
+):
+    monkeypatch.setattr(settings, "TUMBLR_CRAWLER_WORKERS", crawler_cnt)
+    page_cnts = {"a": 3, "gone": 3, "b": 2}
+    blog_pages = crawl(collector, monkeypatch, page_cnts, failed_blogs=("gone",))
+
+    assert Counter(blog_pages.crawled) == {"a": 3, "gone": 2, "b": 2}
+    assert collector.runtime_config.get_failed_blogs() == ["gone"]
+    config = json.loads(settings.CONFIG_FILE.read_text())
+    assert sorted(config["blog_checkpoints"]) == ["a", "b"]
+
+
+def test_a_failed_blog_does_not_stop_the_asyncio_crawlers(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "TUMBLR_CRAWLER_WORKERS", 2)
+    blog_pages = FakeBlogPages({"a": 3, "gone": 3}, failed_blogs=("gone",))
+    pipeline = AsyncPipeline(collector, Mock())
+
+    async def add_blog_page(_: object, cursor: BlogCursor, *__: object) -> bool:
+        return blog_pages(cursor=cursor)
+
+    monkeypatch.setattr(pipeline, "_add_blog_page", add_blog_page)
+    asyncio.run(pipeline._produce_files({"a", "gone"}))  # noqa: SLF001
+
+    assert Counter(blog_pages.crawled) == {"a": 3, "gone": 2}
+    assert collector.runtime_config.get_failed_blogs() == ["gone"]
+
+
+def test_heads_are_only_sent_for_free_slots(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "TUMBLR_FILE_LIMIT_PER_BLOG", 2)
+    collector.resolver = FakeResolver()
+    files = add_files(collector, get_candidates("a", "b", "c", "d"))
+
+    assert [file and file.mega_path.name for file in files] == ["a", "b"]
+    assert len(collector.resolver.resolved_urls) == 2
+
+
+def test_the_next_batch_replaces_rejected_files(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "TUMBLR_FILE_LIMIT_PER_BLOG", 2)
+    collector.resolver = FakeResolver(failed_urls=("https://64.media.tumblr.com/a",))
+    files = add_files(collector, get_candidates("a", "b", "c", "d"))
+
+    assert [file and file.mega_path.name for file in files] == ["b", "c"]
+    assert len(collector.resolver.resolved_urls) == 3
+
+
+def test_duplicate_urls_are_not_resolved(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "DEDUP_ACROSS_BLOGS", True)
+    collector.dedup_store.is_claimed.side_effect = lambda url: url.endswith("/c")
+    collector.resolver = FakeResolver()
+    add_files(collector, get_candidates("a", "b", "a", "c"))
+
+    assert collector.resolver.resolved_urls == [
+        "https://64.media.tumblr.com/a",
+        "https://64.media.tumblr.com/b",
+    ]
+
+
+def test_files_on_mega_are_skipped_without_a_head(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "TUMBLR_FILE_LIMIT_PER_BLOG", 2)
+    collector.remote_manifest.contains.side_effect = lambda name: name == "a"
+    collector.resolver = FakeResolver()
+    files = add_files(collector, get_candidates("a", "b", "c"))
+
+    # The file on MEGA still counts towards the blog limit
+    assert [file and file.mega_path.name for file in files] == ["b"]
+    assert collector.resolver.resolved_urls == ["https://64.media.tumblr.com/b"]
+
+
+def test_files_downsized_by_an_earlier_run_are_skipped_without_a_head(
+    collector: TumblrCollector,
+):
+    candidate = get_candidates("a_1280.jpg")[0].model_copy(
+        update={
+            "smaller_variants": [
+                MediaVariant(url="https://64.media.tumblr.com/a_640.jpg", width=640)
+            ]
+        }
+    )
+    collector.remote_manifest.contains.side_effect = lambda name: name == "a_640.jpg"
+    collector.resolver = FakeResolver()
+    files = add_files(collector, [candidate])
+
+    assert files == []
+    assert collector.resolver.resolved_urls == []
+
+
+def read_dashboard(
+    collector: TumblrCollector,
+    monkeypatch: pytest.MonkeyPatch,
+    api: FakeApi,
+    blog_names: set[str],
+) -> list[str]:  # the names of the queued files
+    monkeypatch.setattr(settings, "TUMBLR_USE_DASHBOARD", True)
+    monkeypatch.setattr(tumblr, "tumblr_api", api)
+    collector.resolver = FakeResolver()
+    file_queue: queue.Queue[FileMetadata | None] = queue.Queue()
+    collector.produce_files_from_blogs(blog_names, file_queue)
+    return sorted(file.mega_path.name for file in file_queue.queue if file)
+
+
+def test_dashboard_posts_are_routed_to_their_blogs(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    write_config(collector, current_tumblr_blogs=["a", "b"], dashboard_since_id=100)
+    api = FakeApi({
+        "user/dashboard": [
+            get_photo_post(101, "a"),
+            get_photo_post(102, "b"),
+            get_photo_post(103, "filtered"),
+        ],
+        "blog/new.tumblr.com/posts": [get_photo_post(1, "new")],
+    })
+    filenames = read_dashboard(collector, monkeypatch, api, {"a", "b", "new"})
+
+    # Only the new blog is crawled on its own
+    assert filenames == ["a101.jpg", "b102.jpg", "new1.jpg"]
+    assert sorted(set(api.paths)) == ["blog/new.tumblr.com/posts", "user/dashboard"]
+    assert collector.dashboard_since_id == 103
+
+
+def test_blogs_are_crawled_if_the_dashboard_is_too_deep(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "TUMBLR_FILE_LIMIT_PER_BLOG", 1000)
+    write_config(collector, current_tumblr_blogs=["a", "b"], dashboard_since_id=100)
+    api = FakeApi({
+        "user/dashboard": [get_photo_post(i, "a") for i in range(1000, 1300)],
+        "blog/b.tumblr.com/posts": [get_photo_post(1, "b")],
+    })
+    filenames = read_dashboard(collector, monkeypatch, api, {"a", "b"})
+
+    assert "b1.jpg" in filenames
+    assert "blog/a.tumblr.com/posts" in api.paths
+
+
+def test_a_blog_that_failed_before_is_crawled_on_its_own(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    write_config(
+        collector,
+        current_tumblr_blogs=["a", "b"],
+        dashboard_since_id=100,
+        blog_checkpoints={"b": {"last_runtime": "2024-12-31T00:00:00+00:00"}},
+    )
+    api = FakeApi({
+        "user/dashboard": [get_photo_post(101, "a"), get_photo_post(102, "b")],
+        # Published after its last crawl, before the dashboard position
+        "blog/b.tumblr.com/posts": [get_photo_post(102, "b"), get_photo_post(-60, "b")],
+    })
+    filenames = read_dashboard(collector, monkeypatch, api, {"a", "b"})
+
+    assert filenames == ["a101.jpg", "b-60.jpg", "b102.jpg"]
+
+
+def test_the_dashboard_head_is_saved_by_the_first_run_with_it(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    write_config(collector, current_tumblr_blogs=["a"])
+    api = FakeApi({
+        "user/dashboard": [get_photo_post(200, "a")],
+        "blog/a.tumblr.com/posts": [get_photo_post(1, "a")],
+    })
+    filenames = read_dashboard(collector, monkeypatch, api, {"a"})
+
+    assert filenames == ["a1.jpg"]
+    assert collector.dashboard_since_id == 200
+
+
+def test_the_asyncio_pipeline_reads_the_dashboard_the_same_way(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "TUMBLR_FILE_LIMIT_PER_BLOG", 1000)
+    posts_by_path = {
+        "user/dashboard": [get_photo_post(i, "a") for i in range(1000, 1300)],
+        "blog/b.tumblr.com/posts": [get_photo_post(1, "b")],
+        "blog/a.tumblr.com/posts": [get_photo_post(2, "a")],
+    }
+    pipeline = AsyncPipeline(collector, Mock())
+    write_config(collector, current_tumblr_blogs=["a", "b"], dashboard_since_id=100)
+    api = FakeApi(posts_by_path)
+    filenames = read_dashboard(collector, monkeypatch, api, {"a", "b"})
+
+    write_config(collector, current_tumblr_blogs=["a", "b"], dashboard_since_id=100)
+    async_api = FakeApi(posts_by_path)
+    added_urls: list[str] = []
+
+    async def get_api(path: str, params: dict[str, Any]) -> dict[str, Any]:
+        return async_api.get(path, params)
+
+    async def add_files(
+        _: object, __: BlogCursor, candidates: list[FileCandidate]
+    ) -> None:
+        added_urls.extend(str(candidate.url) for candidate in candidates)
+
+    monkeypatch.setattr(pipeline, "_get_api", get_api)
+    monkeypatch.setattr(pipeline, "_add_files", add_files)
+    asyncio.run(pipeline._produce_files({"a", "b"}))  # noqa: SLF001
+
+    # Both engines fall back to the blogs at the same depth
+    assert sorted(map(json.dumps, async_api.requests)) == sorted(
+        map(json.dumps, api.requests)
+    )
+    assert sorted({url.rsplit("/", 1)[-1] for url in added_urls}) == filenames
+
+
+def test_the_asyncio_pipeline_retries_like_the_threaded_one(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(tumblr.tumblr_api, "buckets", {})
+    responses = [
+        httpx.Response(429, headers={"Retry-After": "0"}),
+        httpx.Response(200, json={"response": {"posts": []}}),
+    ]
+    pipeline = AsyncPipeline(collector, Mock())
+    pipeline.api_client = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda _: responses.pop(0))
+    )
+
+    response = asyncio.run(pipeline._get_api("user/dashboard"))  # noqa: SLF001
+
+    assert response == {"posts": []}
+    assert responses == []
+
+
+def test_planned_files_are_read_off_the_event_loop(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    pipeline = AsyncPipeline(collector, Mock())
+    reader_threads: list[int] = []
+    queued_files: list[FileMetadata] = []
+
+    def read_plan() -> Iterator[FileMetadata]:
+        for url in ("a1.jpg", "a2.jpg"):
+            reader_threads.append(threading.get_ident())
+            yield FileMetadata(
+                url=f"https://64.media.tumblr.com/{url}",
+                blog_name="a",
+                etag=f'"{url}"',
+                local_path=Path(url),
+                mega_path=Path("a", url),
+                size=1,
+            )
+
+    async def put(file: FileMetadata) -> None:
+        queued_files.append(file)
+
+    monkeypatch.setattr(pipeline.file_queue, "put", put)
+    asyncio.run(pipeline._produce_planned_files(read_plan()))  # noqa: SLF001
+
+    assert [file.mega_path.name for file in queued_files] == ["a1.jpg", "a2.jpg"]
+    assert threading.get_ident() not in reader_threads
+
+
+def crawl_blog(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch, api: FakeApi
+) -> tuple[list[dict[str, Any]], int]:  # the params of every page, the file count
+    monkeypatch.setattr(settings, "TUMBLR_FILE_LIMIT_PER_BLOG", 1000)
+    monkeypatch.setattr(tumblr, "tumblr_api", api)
+    collector.resolver = FakeResolver()
+    file_queue: queue.Queue[FileMetadata | None] = queue.Queue()
+    collector.produce_files_from_blogs({"a"}, file_queue)
+    return [params for _, params in api.requests], file_queue.qsize()
+
+
+def test_blog_pages_follow_the_next_link(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    posts = [get_photo_post(i, "a") for i in range(45, 0, -1)]
+    api = FakeApi({"blog/a.tumblr.com/posts": posts}, has_links=True)
+    pages, file_cnt = crawl_blog(collector, monkeypatch, api)
+
+    assert [params.get("page_number") for params in pages] == [None, "20", "40"]
+    assert file_cnt == 45
+
+
+def test_blog_pages_fall_back_to_the_oldest_post_time(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    posts = [get_photo_post(i, "a") for i in range(45, 0, -1)]
+    api = FakeApi({"blog/a.tumblr.com/posts": posts})
+    pages, file_cnt = crawl_blog(collector, monkeypatch, api)
+
+    assert [(params.get("before"), params.get("offset")) for params in pages] == [
+        (None, None),
+        (posts[19]["timestamp"] + 1, 1),
+        (posts[39]["timestamp"] + 1, 1),
+    ]
+    assert file_cnt == 45
+
+
+def test_posts_published_in_the_same_second_are_not_skipped(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    # A queue of posts published at once spans the pages
+    posts = [
+        {**get_photo_post(i, "a"), "timestamp": LAST_RUNTIME + max(i, 30)}
+        for i in range(45, 0, -1)
+    ]
+    api = FakeApi({"blog/a.tumblr.com/posts": posts})
+    pages, file_cnt = crawl_blog(collector, monkeypatch, api)
+
+    assert [(params.get("before"), params.get("offset")) for params in pages] == [
+        (None, None),
+        (LAST_RUNTIME + 31, 5),
+        (LAST_RUNTIME + 31, 25),
+    ]
+    assert file_cnt == 45
+
+
+def test_new_posts_are_paged_by_offset(
+    collector: TumblrCollector, monkeypatch: pytest.MonkeyPatch
+):
+    write_config(collector, current_tumblr_blogs=["a"])
+    posts = [get_photo_post(i, "a") for i in range(25, -5, -1)]  # 5 before the run
+    api = FakeApi({"blog/a.tumblr.com/posts": posts})
+    pages, file_cnt = crawl_blog(collector, monkeypatch, api)
+
+    # `before` and `after` can't be combined
+    assert [(params["after"], params.get("offset")) for params in pages] == [
+        (LAST_RUNTIME, None),
+        (LAST_RUNTIME, 20),
+    ]
+    assert file_cnt == 25
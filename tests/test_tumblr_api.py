@@ -0,0 +1,80 @@
+import time
+from unittest.mock import Mock
+
+import pytest
+import tumblr_api
+from config import settings
+from tumblr_api import TokenBucket, TumblrApiClient
+
+
+def test_token_bucket_waits_once_the_tokens_run_out():
+    bucket = TokenBucket(capacity=2, refill_period_s=10)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(5, abs=0.1)
+    assert bucket.wait_time() == pytest.approx(10, abs=0.1)
+
+
+def test_token_bucket_refills_up_to_its_capacity():
+    bucket = TokenBucket(capacity=2, refill_period_s=10)
+    bucket.updated_at -= 100
+    bucket.refill()
+    assert bucket.tokens == 2
+
+
+def test_token_bucket_sync_never_adds_tokens():
+    bucket = TokenBucket(capacity=10, refill_period_s=10)
+    bucket.sync(3)
+    assert bucket.tokens == pytest.approx(3, abs=0.1)
+    bucket.sync(100)
+    assert bucket.tokens == pytest.approx(3, abs=0.1)
+
+
+def test_record_response_syncs_the_budget():
+    client = TumblrApiClient()
+    headers = {
+        "X-Ratelimit-Perhour-Remaining": "5",
+        "X-Ratelimit-Perday-Remaining": "7",
+    }
+    assert client.record_response(200, headers) is None
+    assert client.budget == {"hour": 5, "day": 7}
+    assert client.wait_time == 0
+
+
+def test_record_response_waits_for_an_exhausted_limit():
+    client = TumblrApiClient()
+    headers = {"X-Ratelimit-Perhour-Remaining": "0", "X-Ratelimit-Perhour-Reset": "60"}
+    assert client.record_response(200, headers) is None
+    assert client.wait_time == pytest.approx(60, abs=1)
+
+
+def test_record_response_follows_retry_after():
+    client = TumblrApiClient()
+    assert client.record_response(429, {"Retry-After": "30"}) == 30
+    assert client.blocked_until == pytest.approx(time.monotonic() + 30, abs=1)
+
+
+def test_record_response_backs_off_exponentially(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, "TUMBLR_API_MAX_BACKOFF_S", 6.0)
+    client = TumblrApiClient()
+    backoffs = [client.record_response(503, {}) for _ in range(4)]
+    for backoff_s, max_backoff_s in zip(backoffs, [2, 4, 6, 6], strict=True):
+        assert backoff_s is not None
+        assert max_backoff_s / 2 <= backoff_s <= max_backoff_s
+
+    assert client.record_response(200, {}) is None
+    assert client.failure_cnt == 0
+
+
+def test_get_retries_a_rate_limited_call(monkeypatch: pytest.MonkeyPatch):
+    responses = [
+        Mock(status_code=429, headers={"Retry-After": "0"}),
+        Mock(status_code=200, headers={}, **{"json.return_value": {"response": {}}}),
+    ]
+    session = Mock(**{"get.side_effect": responses})
+    monkeypatch.setattr(tumblr_api.session_pool, "api", session)
+    client = TumblrApiClient()
+
+    assert client.get("user/info") == {}
+    assert session.get.call_count == 2
+    responses[-1].raise_for_status.assert_called_once()
@@ -0,0 +1,134 @@
+import json
+import queue
+import threading
+from pathlib import Path
+from typing import Any
+from unittest.mock import Mock
+
+import pytest
+from config import settings
+from dedup_store import DedupStore
+from file_metadata import FileMetadata
+from helper import RuntimeConfig
+from work_plan import WorkPlan, WorkPlanWriter
+
+LAST_RUNTIME = "2025-01-01T00:00:00+00:00"
+
+
+def get_file(blog_name: str, name: str) -> FileMetadata:
+    return FileMetadata(
+        url=f"https://64.media.tumblr.com/{name}",
+        blog_name=blog_name,
+        etag=None,
+        local_path=settings.LOCAL_TEMP_UPLOAD_DIR / name,
+        mega_path=Path("/Root") / blog_name / name,
+        size=100,
+    )
+
+
+def read_config() -> dict[str, Any]:
+    config: dict[str, Any] = json.loads(settings.CONFIG_FILE.read_text())
+    return config
+
+
+@pytest.fixture(autouse=True)
+def config_file(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(settings, "CONFIG_FILE", tmp_path / "config.json")
+    monkeypatch.setattr(settings, "WORK_PLAN_FILE", tmp_path / "work_plan.jsonl")
+    settings.CONFIG_FILE.write_text(
+        json.dumps({"last_runtime": LAST_RUNTIME, "current_tumblr_blogs": []})
+    )
+
+
+@pytest.fixture
+def files() -> list[FileMetadata]:
+    return [get_file("a", "a1"), get_file("a", "a2"), get_file("b", "b1")]
+
+
+def write_plan(files: list[FileMetadata], monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(settings, "PIPELINE_MODE", "plan")
+    runtime_config = RuntimeConfig()
+    writer = WorkPlanWriter(settings.WORK_PLAN_FILE, Mock(check_file=lambda _: True))
+    file_queue: queue.Queue[FileMetadata | None] = queue.Queue()
+    for file in [*files, None]:
+        file_queue.put(file)
+    writer.writer_worker(file_queue)
+    for blog_name in ("a", "b"):
+        runtime_config.complete_blog(blog_name)
+    writer.close(runtime_config, {"a", "b"}, 7, is_complete=True)
+    monkeypatch.setattr(settings, "PIPELINE_MODE", "execute")
+
+
+def test_the_planner_does_not_checkpoint(
+    files: list[FileMetadata], monkeypatch: pytest.MonkeyPatch
+):
+    write_plan(files, monkeypatch)
+
+    assert "blog_checkpoints" not in read_config()
+
+
+def test_a_plan_is_read_back_as_written(
+    files: list[FileMetadata], monkeypatch: pytest.MonkeyPatch
+):
+    write_plan(files, monkeypatch)
+    work_plan = WorkPlan.load(settings.WORK_PLAN_FILE)
+
+    assert work_plan.files == files
+    assert work_plan.is_whole
+    assert work_plan.summary is not None
+    assert work_plan.summary.followed_blogs == ["a", "b"]
+    assert work_plan.summary.dashboard_since_id == 7
+    assert work_plan.summary.crawled_blogs == ["a", "b"]
+    assert work_plan.summary.blogs["a"].bytes == 200
+
+
+def test_the_executor_skips_collected_files_and_checkpoints_finished_blogs(
+    files: list[FileMetadata], tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    write_plan(files, monkeypatch)
+    work_plan = WorkPlan.load(settings.WORK_PLAN_FILE)
+    assert work_plan.summary is not None
+    runtime_config = RuntimeConfig()
+    runtime_config.start_run(work_plan.summary.started_at)
+    dedup_store = DedupStore(tmp_path / "dedup.db")
+    dedup_store.add(files[0])
+
+    queued = list(work_plan.iter_files(dedup_store, runtime_config, threading.Event()))
+    assert [file.mega_path.name for file in queued] == ["a2", "b1"]
+    assert "blog_checkpoints" not in read_config()
+
+    runtime_config.finish_pending_file("a")
+    assert read_config()["blog_checkpoints"] == {
+        "a": {"last_runtime": work_plan.summary.started_at.isoformat()}
+    }
+
+
+def test_a_split_plan_only_checkpoints_blogs_with_all_their_files(
+    files: list[FileMetadata], monkeypatch: pytest.MonkeyPatch
+):
+    write_plan(files, monkeypatch)
+    lines = settings.WORK_PLAN_FILE.read_text().splitlines()
+    del lines[1]  # a2 goes to another executor
+    settings.WORK_PLAN_FILE.write_text("\n".join(lines) + "\n")
+    work_plan = WorkPlan.load(settings.WORK_PLAN_FILE)
+
+    assert not work_plan.is_whole
+    assert work_plan.get_complete_blogs() == ["b"]
+
+
+def test_a_stopped_executor_checkpoints_nothing(
+    files: list[FileMetadata], tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    write_plan(files, monkeypatch)
+    work_plan = WorkPlan.load(settings.WORK_PLAN_FILE)
+    runtime_config = RuntimeConfig()
+    stop_event = threading.Event()
+    stop_event.set()
+
+    queued = list(
+        work_plan.iter_files(
+            DedupStore(tmp_path / "dedup.db"), runtime_config, stop_event
+        )
+    )
+    assert queued == []
+    assert runtime_config.get_crawled_blogs() == []